@@ -0,0 +1,74 @@
+import json
+import os
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+# Пулы для импорта: процессы под парсинг CSV, потоки под хэширование и запись на диск
+INGEST_PROCESS_WORKERS = _env_int('INGEST_PROCESS_WORKERS', max(1, (os.cpu_count() or 2) - 1))
+INGEST_THREAD_WORKERS = _env_int('INGEST_THREAD_WORKERS', 4)
+# Сколько фоновых задач импорта обрабатывается одновременно
+IMPORT_JOB_WORKERS = _env_int('IMPORT_JOB_WORKERS', 2)
+# Сколько тренировок пересчитывается за одну транзакцию при смене FTP
+RECOMPUTE_BATCH_SIZE = _env_int('RECOMPUTE_BATCH_SIZE', 1000)
+
+# SQLite
+DB_ECHO = os.getenv('DB_ECHO', '').lower() in ('1', 'true', 'yes')  # печать всех SQL-запросов, только для отладки
+DB_POOL_SIZE = _env_int('DB_POOL_SIZE', 10)
+DB_MAX_OVERFLOW = _env_int('DB_MAX_OVERFLOW', 20)
+DB_BUSY_TIMEOUT = _env_int('DB_BUSY_TIMEOUT', 15)  # секунд ожидания блокировки записи
+SQLITE_CACHE_SIZE_KB = _env_int('SQLITE_CACHE_SIZE_KB', 64 * 1024)
+SQLITE_MMAP_SIZE = _env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)
+
+# Ollama
+OLLAMA_URL = os.getenv('OLLAMA_URL', 'http://localhost:11434')
+OLLAMA_MODEL = os.getenv('OLLAMA_MODEL', 'llama3.1')
+OLLAMA_MAX_CONNECTIONS = _env_int('OLLAMA_MAX_CONNECTIONS', 10)
+# Открытыми держим все соединения пула: лишние сверх этого числа httpx закрывает после каждого ответа,
+# и при параллельных вызовах почти каждый открывает новое TCP-соединение
+OLLAMA_KEEPALIVE_CONNECTIONS = _env_int('OLLAMA_KEEPALIVE_CONNECTIONS', OLLAMA_MAX_CONNECTIONS)
+# Сколько модель остается в памяти Ollama после запроса и нужно ли загружать ее при старте приложения
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+OLLAMA_WARMUP = os.getenv('OLLAMA_WARMUP', '1').lower() in ('1', 'true', 'yes')
+
+# Провайдеры модели в порядке переключения при отказе, JSON-список. Пример:
+# [{"type": "openai", "url": "http://localhost:8080", "model": "qwen2.5-3b", "tier": "fast", "timeout": 20},
+#  {"type": "ollama", "url": "http://localhost:11434", "model": "llama3.1", "tier": "large"},
+#  {"type": "llama_cpp", "model_path": "models/llama-3.1-8b.gguf"}]
+# По умолчанию — один Ollama из OLLAMA_URL / OLLAMA_MODEL для всех запросов
+LLM_PROVIDERS = json.loads(os.getenv('LLM_PROVIDERS') or 'null') or [
+    {'type': 'ollama', 'url': OLLAMA_URL, 'model': OLLAMA_MODEL}]
+LLM_ROUTING = os.getenv('LLM_ROUTING', 'latency')  # latency или order
+LLM_FAILOVER_COOLDOWN = _env_int('LLM_FAILOVER_COOLDOWN', 30)  # секунд, сколько не выбирать упавший провайдер
+# Допуск запросов к модели: одновременные генерации, очередь и лимит на пользователя
+LLM_MAX_CONCURRENCY = _env_int('LLM_MAX_CONCURRENCY', 2)
+LLM_MAX_QUEUE = _env_int('LLM_MAX_QUEUE', 20)
+LLM_QUEUE_TIMEOUT = _env_int('LLM_QUEUE_TIMEOUT', 120)  # секунд ожидания в очереди
+LLM_USER_RATE_PER_MINUTE = _env_int('LLM_USER_RATE_PER_MINUTE', 6)
+# Кэш ответов тренера; похожие вопросы сравниваются по эмбеддингам, если это включено
+COACH_CACHE_SIZE = _env_int('COACH_CACHE_SIZE', 512)
+COACH_CACHE_TTL = _env_int('COACH_CACHE_TTL', 6 * 3600)  # секунд
+COACH_CACHE_EMBEDDINGS = os.getenv('COACH_CACHE_EMBEDDINGS', '').lower() in ('1', 'true', 'yes')
+COACH_CACHE_SIMILARITY = _env_float('COACH_CACHE_SIMILARITY', 0.95)
+OLLAMA_EMBED_MODEL = os.getenv('OLLAMA_EMBED_MODEL', 'nomic-embed-text')
+# Контекст модели в токенах: окно, резерв под ответ и сколько последних сообщений брать из истории
+COACH_CONTEXT_TOKENS = _env_int('COACH_CONTEXT_TOKENS', 8192)
+COACH_RESPONSE_TOKENS = _env_int('COACH_RESPONSE_TOKENS', 1024)
+COACH_HISTORY_MESSAGES = _env_int('COACH_HISTORY_MESSAGES', 20)
+COACH_SUMMARY_WORDS = _env_int('COACH_SUMMARY_WORDS', 200)
+# Сколько секунд пользователь с профилями живет в кэше процесса после загрузки
+USER_CACHE_TTL = _env_int('USER_CACHE_TTL', 60)
+# Пароли: стоимость bcrypt (2^rounds итераций) и сколько хэшей считается одновременно
+BCRYPT_ROUNDS = _env_int('BCRYPT_ROUNDS', 12)
+PASSWORD_HASH_WORKERS = _env_int('PASSWORD_HASH_WORKERS', 2)
+# Email администраторов через запятую, которым доступен /metrics. Пустой список — маршрут выключен:
+# счетчики SQL-запросов и статистика LLM не для всех пользователей
+METRICS_ADMINS = {email.strip().lower() for email in os.getenv('METRICS_ADMINS', '').split(',') if email.strip()}
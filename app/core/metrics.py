@@ -0,0 +1,55 @@
+import threading
+from collections import deque
+
+WINDOW = 1000  # сколько последних наблюдений хранить для перцентилей
+
+
+class _Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=WINDOW)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+
+    def snapshot(self) -> dict:
+        ordered = sorted(self.recent)
+
+        def percentile(p):
+            return ordered[min(int(len(ordered) * p), len(ordered) - 1)] if ordered else None
+
+        return {'count': self.count, 'avg': self.total / self.count if self.count else None,
+                'p50': percentile(0.5), 'p95': percentile(0.95), 'p99': percentile(0.99)}
+
+
+class Metrics:
+    """Простые метрики в памяти процесса: счетчики, текущие значения и распределения"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: dict[str, int] = {}
+        self._gauges: dict[str, float] = {}
+        self._histograms: dict[str, _Histogram] = {}
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            self._histograms.setdefault(name, _Histogram()).observe(value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {'counters': dict(self._counters), 'gauges': dict(self._gauges),
+                    'histograms': {name: histogram.snapshot() for name, histogram in self._histograms.items()}}
+
+
+metrics = Metrics()
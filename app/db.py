@@ -1,17 +1,146 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
 from pathlib import Path
+from sqlalchemy import Connection, event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
 from sqlmodel import SQLModel, Session, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.config import (
+    DB_ECHO,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_BUSY_TIMEOUT,
+    SQLITE_CACHE_SIZE_KB,
+    SQLITE_MMAP_SIZE
+)
 
 DB_PATH = Path('data/app.db')
 DB_PATH.parent.mkdir(parents=True, exist_ok=True)
 
 DATABASE_URL = f'sqlite:///{DB_PATH}'
-engine = create_engine(DATABASE_URL, echo=True, connect_args={'check_same_thread': False})
+engine = create_engine(DATABASE_URL, echo=DB_ECHO, poolclass=QueuePool, pool_size=DB_POOL_SIZE,
+                       max_overflow=DB_MAX_OVERFLOW,
+                       connect_args={'check_same_thread': False, 'timeout': DB_BUSY_TIMEOUT})
+
+# Асинхронный движок для обработчиков запросов: запросы не блокируют цикл событий.
+# Фоновые задачи (импорт, миграции) продолжают работать через синхронный engine.
+ASYNC_DATABASE_URL = f'sqlite+aiosqlite:///{DB_PATH}'
+async_engine = create_async_engine(ASYNC_DATABASE_URL, echo=DB_ECHO, poolclass=AsyncAdaptedQueuePool,
+                                   pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                                   connect_args={'timeout': DB_BUSY_TIMEOUT})
+
+
+@event.listens_for(engine, 'connect')
+@event.listens_for(async_engine.sync_engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    # WAL: читатели не блокируют писателя, NORMAL в WAL безопасен и не делает fsync на каждый коммит
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT * 1000}')
+    cursor.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}')
+    cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
+
+# Счетчик SQL-запросов текущего HTTP-запроса, задается middleware через count_queries()
+_query_counter: ContextVar[list[int] | None] = ContextVar('query_counter', default=None)
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+@event.listens_for(async_engine.sync_engine, 'before_cursor_execute')
+def _count_query(*args) -> None:
+    counter = _query_counter.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+@contextmanager
+def count_queries():
+    """Считает SQL-запросы внутри блока, в том числе в задачах, запущенных из него"""
+    counter = [0]
+    token = _query_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _query_counter.reset(token)
+
+
+def _fill_workout_user_id(connection: Connection) -> None:
+    # До появления Workout.user_id владелец тренировки хранился только в исходном файле.
+    # Роллапы, ряд нагрузки, пересчет IF/TSS и удаление ищут тренировки по user_id.
+    connection.exec_driver_sql("""
+        UPDATE workout SET user_id = (SELECT user_id FROM uploadedfile WHERE id = workout.source_file_id)
+        WHERE user_id IS NULL""")
+
+
+def _create_missing_indexes(connection: Connection) -> None:
+    # create_all создает индексы только вместе с новыми таблицами, в старых базах их нужно догнать
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+    connection.exec_driver_sql('ANALYZE')
+
+
+def _clear_missing_metrics(connection: Connection) -> None:
+    # Строка 'нет данных' в числовых колонках заменяется на NULL
+    for column in ('normalized_power', 'intensity_factor', 'training_stress_score'):
+        connection.exec_driver_sql(f"UPDATE workout SET {column} = NULL WHERE typeof({column}) = 'text'")
+    # История FTP начинается с текущего значения профиля
+    connection.exec_driver_sql("""
+        INSERT INTO ftphistory (user_id, ftp, effective_from, created_at)
+        SELECT id, current_ftp, date('now', 'localtime'), datetime('now', 'localtime') FROM athleteprofile
+        WHERE current_ftp > 0 AND id NOT IN (SELECT user_id FROM ftphistory)""")
+    # Тренировкам без IF/TSS они досчитываются фоновой задачей, NP при необходимости берется из потоков
+    connection.exec_driver_sql("""
+        INSERT INTO recomputejob (user_id, status, total, done, last_workout_id, created_at)
+        SELECT DISTINCT workout.user_id, 'queued', 0, 0, 0, datetime('now', 'localtime') FROM workout
+        JOIN ftphistory ON ftphistory.user_id = workout.user_id
+        WHERE workout.intensity_factor IS NULL""")
+
+
+def _add_athlete_max_heartrate(connection: Connection) -> None:
+    # Новая база уже создана create_all с этой колонкой, старой ее нужно добавить
+    columns = {row[1] for row in connection.exec_driver_sql('PRAGMA table_info(athleteprofile)')}
+    if 'max_heartrate' not in columns:
+        connection.exec_driver_sql('ALTER TABLE athleteprofile ADD COLUMN max_heartrate INTEGER')
+
+
+# Миграции схемы по порядку, номер последней примененной хранится в PRAGMA user_version
+MIGRATIONS = [
+    _fill_workout_user_id,
+    _create_missing_indexes,
+    _clear_missing_metrics,
+    _add_athlete_max_heartrate,
+]
+
+
+def run_migrations() -> None:
+    with engine.begin() as connection:
+        version = connection.exec_driver_sql('PRAGMA user_version').scalar()
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            migration(connection)
+            connection.exec_driver_sql(f'PRAGMA user_version = {number}')
 
 
 def create_db_and_tables() -> None:
     SQLModel.metadata.create_all(engine)
+    run_migrations()
+
+
+def write_and_commit(session: Session, write, *args):
+    """Для AsyncSession.run_sync: запись и коммит одним вызовом. Между первой записью и коммитом
+    нет await, поэтому транзакция записи SQLite не остается открытой, пока цикл событий занят другим."""
+    result = write(session, *args)
+    session.commit()
+    return result
 
 
-def get_session():
-    with Session(engine) as session:
+async def get_async_session():
+    # expire_on_commit=False: после коммита объекты остаются доступны без повторной загрузки,
+    # поэтому коммит можно делать сразу после чтения и не держать соединение во время ожидания модели
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
         yield session
@@ -1,178 +1,230 @@
+import json
+import time
+from contextlib import asynccontextmanager
 from math import ceil
 from typing import Optional
 
-import jwt
 import uvicorn
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 
-from app.services.ai_coach import get_ollama_service, OllamaService
-from app.services.file_service import (
-    validate_file_type,
-    save_file_with_hash,
-    FileValidationError,
-    FileAlreadyExistsError
-)
-from app.db import create_db_and_tables, get_session
+from app.core.config import METRICS_ADMINS
+from app.core.metrics import metrics
+from app.services.ai_coach import get_ollama_service, close_ollama_service, OllamaService
+from app.services.llm_limiter import llm_limiter
+from app.services.llm_providers import choose_tier
+from app.services.response_cache import response_cache
+from app.services.user_cache import user_cache, select_user
+from app.services.chat_context import load_history, schedule_summary, stop_summaries
+from app.services.import_jobs import enqueue_import, import_queue, job_status
+from app.services.file_service import uploaded_hashes
+from app.services import ftp_recompute
+from app.services.ftp_recompute import recompute_queue
+from app.services.ingest import shutdown_executors
+from app.services import blob_store, rollups, fitness
+from app.services.pagination import encode_cursor, decode_cursor, CursorError
+from app.services.stream_store import delete_streams, load_streams, StreamNotFoundError
+from app.services import analytics
+from app.db import create_db_and_tables, get_async_session, async_engine, engine, count_queries, write_and_commit
 from fastapi import FastAPI, UploadFile, File, Depends, Form, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from app.models.models import UploadedFile, Workout, UserProfile, ChatMessage, AthleteProfile, Users, UserCreate, \
-    UserLogin
+    UserLogin, ImportJob, RecomputeJob, ImportCheck
+from starlette.background import BackgroundTask
 from starlette.requests import Request
-from pathlib import Path
 from sqlmodel import Session, select
-from datetime import datetime, UTC, date, timedelta
-from sqlalchemy import desc, func
-
-from app.services.parse_cvs import parse_csv_to_workout, ParseCsvError
-from app.services.security import get_password_hash, verify_password, create_access_token, SECRET_KEY, ALGORITHM
-
-app = FastAPI(title="Bike Tracker")
+from sqlmodel.ext.asyncio.session import AsyncSession
+from datetime import datetime, date, timedelta
+from sqlalchemy import desc, tuple_
+from sqlalchemy.orm import contains_eager, selectinload
+
+from app.services.security import hash_password_async, verify_and_update_password, create_access_token, \
+    shutdown_password_pool
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    get_ollama_service().start_warm_up()
+    await import_queue.start()
+    await recompute_queue.start()
+    yield
+    await import_queue.stop()
+    await recompute_queue.stop()
+    await stop_summaries()
+    await close_ollama_service()
+    shutdown_executors()
+    shutdown_password_pool()
+
+
+app = FastAPI(title="Bike Tracker", lifespan=lifespan)
+
+
+@app.middleware('http')
+async def track_db_queries(request: Request, call_next):
+    # Сколько SQL-запросов делает один HTTP-запрос: видно в /metrics (для METRICS_ADMINS)
+    with count_queries() as counter:
+        response = await call_next(request)
+    metrics.observe('db_queries_per_request', counter[0])
+    return response
 
 templates = Jinja2Templates(directory='app/templates')
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='login')
 
 
-def get_current_user(request: Request, session=Depends(get_session)):
+async def get_optional_user(request: Request) -> Users | None:
+    """Пользователь по cookie или None. Загружается один раз за запрос, между запросами берется из кэша."""
+    if not hasattr(request.state, 'user'):
+        request.state.user = await user_cache.from_token(request.cookies.get('access_token'))
+    return request.state.user
+
+
+async def get_current_user(user: Users | None = Depends(get_optional_user)) -> Users:
     """"Проверяет токен на соответствие"""
-    token = request.cookies.get('access_token')
-    if not token:
-        raise HTTPException(status_code=401, detail='Ошибка авторизации')
-    try:
-        # Пробует декодировать подпись токена с помощью секретного ключа
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user = session.exec(select(Users).where(Users.email == payload['sub'])).first()
-        if not user:
-            raise HTTPException(status_code=401, detail='Ошибка авторизации')
-        return user
-    except jwt.InvalidTokenError as e:
+    if user is None:
         raise HTTPException(status_code=401, detail='Ошибка авторизации')
+    return user
+
+
+def ensure_data_store() -> None:
+    blob_store.BLOBS_DIR.mkdir(parents=True, exist_ok=True)
 
 
 def on_startup() -> None:
     create_db_and_tables()
+    ensure_data_store()
+    with Session(engine) as session:
+        blob_store.backfill(session)
+        blob_store.collect_garbage(session)
+        rollups.backfill(session)
+        fitness.backfill(session)
 
 
 on_startup()
 
 
-def ensure_data_store() -> None:
-    Path('data/csv').mkdir(parents=True, exist_ok=True)
-
-
 @app.get('/', response_class=HTMLResponse)
-async def hello_root(request: Request, session=Depends(get_session)):
+async def hello_root(request: Request, user: Users | None = Depends(get_optional_user)):
     # Пытаемся узнать имя пользователя для приветствия
-    token = request.cookies.get('access_token')
-    user_profile = None
-    if token:
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            user = session.exec(select(Users).where(Users.email == payload['sub'])).first()
-            user_profile = user.user_profile
-        except jwt.InvalidTokenError:
-            pass
+    user_profile = user.user_profile if user else None
 
     return templates.TemplateResponse('index.html', {'request': request, 'user_profile': user_profile})
 
 
 @app.get('/workouts', response_class=HTMLResponse)
-async def list_workouts(request: Request, session: Session = Depends(get_session),
+async def list_workouts(request: Request, session: AsyncSession = Depends(get_async_session),
                         user: Users = Depends(get_current_user), page: int = 1, period: int = 0,
-                        limit: int = 10):
+                        limit: int = 10, after: Optional[str] = None, before: Optional[str] = None):
     if page < 1:
         page = 1
     if limit > 100 or limit < 1:
         limit = 10
-    offset = (page - 1) * limit
     user_id = user.id
+    sort_key = tuple_(UploadedFile.uploaded_at, Workout.id)
 
-    # 1. Чистый запрос
-    query_workouts = select(Workout).where(Workout.user_id == user_id)
-    query_count = select(func.count(Workout.id)).where(Workout.user_id == user_id)
+    # 1. Чистый запрос, дата загрузки подтягивается тем же JOIN
+    query_workouts = (select(Workout).join(UploadedFile).options(contains_eager(Workout.source_file))
+                      .where(UploadedFile.user_id == user_id))
 
     # 2. Формируем запрос из роута статистики
+    since = None
     if period:
-        target_date = datetime.now() - timedelta(days=period)
-        query_workouts = query_workouts.join(UploadedFile).where(UploadedFile.uploaded_at >= target_date)
-        query_count = query_count.join(UploadedFile).where(UploadedFile.uploaded_at >= target_date)
-
-    # 3. Формируем запрос для простого просмотра тренировок
-    query_workouts = (query_workouts.order_by(desc(Workout.id)).limit(limit).offset(offset))
+        since = date.today() - timedelta(days=period)
+        query_workouts = query_workouts.where(UploadedFile.uploaded_at >= datetime.combine(since, datetime.min.time()))
 
-    # 4. Делаем запрос в базу
-    workouts = session.exec(query_workouts).all()
-    total_count = session.exec(query_count).one()
-    total_pages = ceil(total_count / limit)
+    # 3. Keyset-пагинация: продолжаем от граничной тренировки вместо OFFSET
+    try:
+        if before:
+            query_workouts = query_workouts.where(sort_key > tuple_(*decode_cursor(before))).order_by(
+                UploadedFile.uploaded_at, Workout.id)
+        else:
+            if after:
+                query_workouts = query_workouts.where(sort_key < tuple_(*decode_cursor(after)))
+            query_workouts = query_workouts.order_by(desc(UploadedFile.uploaded_at), desc(Workout.id))
+    except CursorError:
+        raise HTTPException(status_code=400, detail='Некорректная ссылка на страницу')
+
+    # 4. Делаем запрос в базу, лишняя строка показывает, есть ли страница дальше
+    workouts = list((await session.exec(query_workouts.limit(limit + 1))).all())
+    has_more = len(workouts) > limit
+    workouts = workouts[:limit]
+    if before:
+        workouts.reverse()
+    total_count = await session.run_sync(rollups.workout_count, user_id, since)
+    total_pages = max(ceil(total_count / limit), 1)
+
+    next_cursor = prev_cursor = None
+    if workouts:
+        if has_more or before:
+            next_cursor = encode_cursor(workouts[-1].source_file.uploaded_at, workouts[-1].id)
+        if page > 1 and (has_more or not before):
+            prev_cursor = encode_cursor(workouts[0].source_file.uploaded_at, workouts[0].id)
 
     return templates.TemplateResponse('workouts.html', {'request': request, 'workouts': workouts,
                                                         'current_page': page,
                                                         'total_pages': total_pages, 'period': period,
-                                                        'limit': limit})
+                                                        'limit': limit, 'next_cursor': next_cursor,
+                                                        'prev_cursor': prev_cursor})
 
 
 @app.get('/imports', response_class=HTMLResponse)
-async def imports(request: Request, user: Users = Depends(get_current_user)):
-    success_count = int(request.query_params.get('success')) if request.query_params.get('success') else 0
-    dup_count = int(request.query_params.get('dup')) if request.query_params.get('dup') else 0
-    err_count = int(request.query_params.get('err')) if request.query_params.get('err') else 0
-    message = None
-    if 'success' in request.query_params or 'dup' in request.query_params or 'err' in request.query_params:
-        message = f'Успешно загружено: {success_count}, Пропущено дубликатов: {dup_count}, Ошибок: {err_count}'
-    return templates.TemplateResponse('imports.html', {'request': request, 'message': message})
+async def imports(request: Request, user: Users = Depends(get_current_user), job: Optional[int] = None):
+    # Ход импорта страница получает сама через GET /imports/{job_id}
+    return templates.TemplateResponse('imports.html', {'request': request, 'job_id': job})
+
+
+@app.post('/imports/check')
+async def check_imports(check: ImportCheck, session: AsyncSession = Depends(get_async_session),
+                        user: Users = Depends(get_current_user)) -> dict:
+    # Страница импорта считает хэши в браузере и не отправляет файлы, которые пользователь уже загружал
+    known = await session.run_sync(uploaded_hashes, user.id, check.hashes)
+    return {'known': sorted(known)}
 
 
 @app.post('/imports')
-async def import_csv(files: list[UploadFile] = File(...), session: Session = Depends(get_session),
-                     user: Users = Depends(get_current_user)):
+async def import_csv(files: list[UploadFile] = File([]), known: str = Form('[]'),
+                     session: AsyncSession = Depends(get_async_session), user: Users = Depends(get_current_user)):
     user_profile = user.user_profile
-    success_count = 0
-    dup_count = 0
-    type_err_count = 0
-
     if not user_profile:
         return RedirectResponse(url='/profile/create', status_code=303)
-    for file in files:
-        try:
-            validate_file_type(filename=file.filename, content_type=file.content_type)
-            content = await file.read()
-            file_path, hash_value = save_file_with_hash(content, session, user.id)
-            uploaded_file = UploadedFile(original_name=file.filename, sha256=hash_value, uploaded_at=datetime.now(UTC),
-                                         user_id=user.id)
-            session.add(uploaded_file)
-            session.flush()
-            parse_csv_to_workout(file_path=file_path, uf_id=uploaded_file.id, session=session, user_id=user_profile.id)
-            session.commit()
-            success_count += 1
-
-        except ParseCsvError:
-            session.rollback()
-            type_err_count += 1
-        except FileValidationError:
-            session.rollback()
-            type_err_count += 1
-        except FileAlreadyExistsError:
-            session.rollback()
-            dup_count += 1
-        except OSError:
-            session.rollback()
-            type_err_count += 1
-
-        except Exception as e:
-            session.rollback()
-            type_err_count += 1
-            print(f"Неизвестная ошибка при загрузке {file.filename}: {e}")  # Для дебага в консоли
-    return RedirectResponse(url=f'/imports?success={success_count}&dup={dup_count}&err={type_err_count}',
-                            status_code=303)
+    # known: [{"sha256": ..., "name": ...}] — файлы, которые не отправлялись: пользователь их уже загружал
+    try:
+        known_files = [(str(item['sha256']), str(item['name'])) for item in json.loads(known)]
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail='Некорректный список известных файлов')
+    if not files and not known_files:
+        return RedirectResponse(url='/imports', status_code=303)
+    # Файлы только сохраняются, парсинг и запись в базу идут в фоновой задаче
+    job = await enqueue_import(files, session, user.id, known_files)
+    return RedirectResponse(url=f'/imports?job={job.id}', status_code=303)
+
+
+@app.get('/imports/{job_id}')
+async def import_status(job_id: int, session: AsyncSession = Depends(get_async_session),
+                        user: Users = Depends(get_current_user)) -> dict:
+    job = await session.get(ImportJob, job_id, options=[selectinload(ImportJob.files)])
+    if not job or job.user_id != user.id:
+        raise HTTPException(status_code=404, detail='Задача импорта не найдена')
+    return job_status(job)
 
 
 @app.get('/profile', response_class=HTMLResponse)
-def show_profile(request: Request, user: Users = Depends(get_current_user)):
+async def show_profile(request: Request, user: Users = Depends(get_current_user), recompute: Optional[int] = None):
     if user.user_profile is None:
         return RedirectResponse(url='/profile/create', status_code=303)
+    # Ход пересчета после смены FTP страница получает сама через GET /recompute/{job_id}
     return templates.TemplateResponse('profile.html', {'request': request, 'user_profile': user.user_profile,
-                                                       'athlete_profile': user.athlete_profile})
+                                                       'athlete_profile': user.athlete_profile,
+                                                       'recompute_job_id': recompute})
+
+
+@app.get('/recompute/{job_id}')
+async def recompute_status(job_id: int, session: AsyncSession = Depends(get_async_session),
+                           user: Users = Depends(get_current_user)) -> dict:
+    job = await session.get(RecomputeJob, job_id)
+    if not job or job.user_id != user.id:
+        raise HTTPException(status_code=404, detail='Задача пересчета не найдена')
+    return ftp_recompute.job_status(job)
 
 
 @app.get('/profile/create', response_class=HTMLResponse)
@@ -193,15 +245,18 @@ async def create_profile(
         environment_location: str = Form(...),
         birth_date: Optional[date] = Form(None),
         height_cm: Optional[int] = Form(None),
-        session: Session = Depends(get_session),
+        max_heartrate: Optional[int] = Form(None),
+        session: AsyncSession = Depends(get_async_session),
         user: Users = Depends(get_current_user)):
     user_profile = UserProfile(id=user.id, name=name, birth_date=birth_date, height_cm=height_cm)
     session.add(user_profile)
     athlete_profile = AthleteProfile(id=user.id, weight_kg=weight_kg, current_ftp=current_ftp, gear=gear,
                                      environment_location=environment_location, limitations=limitations,
-                                     weekly_hours=weekly_hours)
+                                     weekly_hours=weekly_hours, max_heartrate=max_heartrate)
     session.add(athlete_profile)
-    session.commit()
+    await session.run_sync(write_and_commit, ftp_recompute.record_ftp, user.id, current_ftp, date.today())
+    user_cache.invalidate(user.id)
+    response_cache.invalidate_user(user.id)
 
     return RedirectResponse(url='/profile', status_code=303)
 
@@ -230,12 +285,14 @@ async def edit_profile(
         limitations: str = Form(...),
         birth_date: Optional[date] = Form(None),
         height_cm: Optional[int] = Form(None),
-        session: Session = Depends(get_session),
+        max_heartrate: Optional[int] = Form(None),
+        ftp_effective_from: Optional[date] = Form(None),
+        session: AsyncSession = Depends(get_async_session),
         user: Users = Depends(get_current_user)
 ):
-    # Получаем данные из профиля
-    user_profile = user.user_profile
-    athlete_profile = user.athlete_profile
+    # Получаем данные из профиля: объекты из кэша пользователей только для чтения, меняем загруженные в сессию
+    user_profile = await session.get(UserProfile, user.id)
+    athlete_profile = await session.get(AthleteProfile, user.id)
 
     # Обновляем UserProfile
     user_profile.name = name
@@ -244,9 +301,11 @@ async def edit_profile(
     user_profile.updated_at = datetime.now()
 
     # Обновляем AthleteProfile
+    ftp_changed = current_ftp != athlete_profile.current_ftp or ftp_effective_from is not None
     athlete_profile.weight_kg = weight_kg
     athlete_profile.current_ftp = current_ftp
     athlete_profile.weekly_hours = weekly_hours
+    athlete_profile.max_heartrate = max_heartrate
     athlete_profile.gear = gear
     athlete_profile.environment_location = environment_location
     athlete_profile.limitations = limitations
@@ -254,140 +313,234 @@ async def edit_profile(
     # Сохраняем, отправляем в базу
     session.add(user_profile)
     session.add(athlete_profile)
-    session.commit()
+    recompute_job = None
+    if ftp_changed:
+        # Новый FTP попадает в историю, IF/TSS тренировок с даты его действия пересчитываются в фоне
+        recompute_job = await session.run_sync(write_and_commit, ftp_recompute.change_ftp, user.id, current_ftp,
+                                               ftp_effective_from or date.today())
+    else:
+        await session.commit()
+    user_cache.invalidate(user.id)
+    response_cache.invalidate_user(user.id)
+    if recompute_job is not None:
+        recompute_queue.put(recompute_job.id)
+        return RedirectResponse(url=f'/profile?recompute={recompute_job.id}', status_code=303)
     return RedirectResponse(url='/profile', status_code=303)
 
 
 @app.get('/workouts/{workout_id}', response_class=HTMLResponse)
-async def workout_detail(workout_id: int, request: Request, session: Session = Depends(get_session)):
-    workout = session.exec(select(Workout).where(Workout.id == workout_id)).first()
-    if not workout:
+async def workout_detail(workout_id: int, request: Request, session: AsyncSession = Depends(get_async_session)):
+    # Максимальный пульс владельца для пульсовых зон приходит тем же запросом
+    row = (await session.exec(select(Workout, AthleteProfile.max_heartrate).options(selectinload(Workout.source_file))
+                              .outerjoin(AthleteProfile, AthleteProfile.id == Workout.user_id)
+                              .where(Workout.id == workout_id))).first()
+    if not row:
         raise HTTPException(status_code=404, detail='Тренировка не найдена')
-    return templates.TemplateResponse('workout_detail.html', {'request': request, 'workout': workout})
+    workout, max_heartrate = row
+    # Расширенная аналитика по сохраненным посекундным рядам, у старых тренировок их может не быть
+    ride_analytics = None
+    try:
+        streams = load_streams(workout_id, columns=['watts', 'heartrate', 'moving'])
+        # Зоны строятся от FTP, который действовал в день тренировки
+        day = workout.source_file.uploaded_at.date() if workout.source_file else date.today()
+        ftp = await session.run_sync(ftp_recompute.ftp_on, workout.user_id, day)
+        ride_analytics = analytics.analyze_ride(streams, ftp, max_heartrate)
+    except StreamNotFoundError:
+        pass
+    return templates.TemplateResponse('workout_detail.html', {'request': request, 'workout': workout,
+                                                              'analytics': ride_analytics,
+                                                              'key_durations': analytics.KEY_DURATIONS,
+                                                              'power_zone_names': analytics.POWER_ZONE_NAMES,
+                                                              'hr_zone_names': analytics.HR_ZONE_NAMES})
+
+
+def delete_workout_records(session: Session, workout: Workout) -> None:
+    # Удаляем и исходный файл, чтобы тренировку можно было загрузить заново
+    uploaded_file = workout.source_file
+    session.delete(workout)
+    if uploaded_file:
+        session.delete(uploaded_file)
+        blob_store.release(session, uploaded_file.sha256)
+        rollups.remove_workout(session, workout.user_id, uploaded_file.uploaded_at.date())
+        fitness.recompute_from(session, workout.user_id, uploaded_file.uploaded_at.date())
+
+
+@app.post('/workouts/{workout_id}/delete')
+async def delete_workout(workout_id: int, session: AsyncSession = Depends(get_async_session),
+                         user: Users = Depends(get_current_user)):
+    workout = await session.get(Workout, workout_id, options=[selectinload(Workout.source_file)])
+    if not workout or workout.user_id != user.id:
+        raise HTTPException(status_code=404, detail='Тренировка не найдена')
+    await session.run_sync(write_and_commit, delete_workout_records, workout)
+    delete_streams(workout_id)
+    response_cache.invalidate_user(user.id)
+    return RedirectResponse(url='/workouts', status_code=303)
 
 
 @app.get('/coach', response_class=HTMLResponse)
-async def coach_page(request: Request, session: Session = Depends(get_session),
+async def coach_page(request: Request, session: AsyncSession = Depends(get_async_session),
                      user: Users = Depends(get_current_user)):
     if not user.user_profile:
         return RedirectResponse(url="/profile/create", status_code=303)
-    message_history = session.exec(select(ChatMessage).where(user.id == ChatMessage.user_id).order_by(
-        ChatMessage.created_at)).all()
+    message_history = (await session.exec(select(ChatMessage).where(user.id == ChatMessage.user_id).order_by(
+        ChatMessage.created_at))).all()
 
     return templates.TemplateResponse('coach.html', {'request': request, 'message_history': message_history})
 
 
-@app.post('/coach/chat', response_class=HTMLResponse)
-async def chat(request: Request, user_question: str = Form(...), session: Session = Depends(get_session),
-               ollama_service=Depends(get_ollama_service), user: Users = Depends(get_current_user)):
-    # Получаем данные
-    if not user.user_profile:
-        return RedirectResponse(url="/profile/create", status_code=303)
+async def prepare_chat(session: AsyncSession, user: Users, user_question: str, ollama_service: OllamaService):
+    """Собирает промпт для модели, ищет готовый ответ в кэше и, если его нет, занимает место в очереди к модели.
+    Вопрос не сохраняется здесь: обработчик записывает его вместе с ответом, поэтому отказ 429
+    в очереди или ошибка модели не оставляют в истории вопрос без ответа.
+    Транзакции короткие: соединение с базой не занято, пока идут запросы к модели."""
     week_ago = datetime.now() - timedelta(days=7)
-    workouts = session.exec(select(Workout).join(UploadedFile).where(UploadedFile.uploaded_at >= week_ago,
-                                                                     UploadedFile.user_id == user.id)).all()
-    summary = ollama_service.format_workouts(workouts)
-    message_history = session.exec(select(ChatMessage).where(ChatMessage.user_id == user.id).where(
-        ChatMessage.created_at >= week_ago)).all()
+    workouts = (await session.exec(select(Workout).join(UploadedFile).where(UploadedFile.uploaded_at >= week_ago,
+                                                                            UploadedFile.user_id == user.id))).all()
+    fitness_today = await session.run_sync(fitness.current, user.id)
+    summary = ollama_service.format_workouts(workouts) + ollama_service.format_fitness(fitness_today)
+    # Старая часть диалога приходит одним резюме, из свежей SQL отдает только последние сообщения
+    conversation_summary, message_history = await session.run_sync(load_history, user.id)
+    # Чтение закончено: закрываем транзакцию и возвращаем соединение в пул до обращений к модели
+    await session.commit()
     prompt = await ollama_service.build_chat_messages(user_profile=user.user_profile,
                                                       athlete_profile=user.athlete_profile,
                                                       user_message=user_question,
                                                       summary=summary,
-                                                      message_history=message_history)
-
-    # Сохраняем вопрос пользователя
+                                                      message_history=message_history,
+                                                      conversation_summary=conversation_summary)
+    # Контекст для кэша — то, что не меняется от реплики к реплике: персона с профилем (первое системное
+    # сообщение) и сводка тренировок с CTL/ATL/TSB. Уточняющие вопросы кэш пропускает сам.
+    context = [prompt[0], {'role': 'user', 'content': summary}]
+    cached = await response_cache.lookup(user.id, context, user_question, ollama_service)
+    # Время вопроса фиксируем сейчас, чтобы в истории он шел раньше ответа
     user_message = ChatMessage(user_id=user.id, role='user', content=user_question)
-    session.add(user_message)
-    session.commit()
-    # Вызываем ИИ и передаем старую историю + новый вопрос
-    answer = await ollama_service.chat(messages=prompt)
-    # Сохраняем новый ответ в контекст
+    ticket = None if cached.answer is not None else llm_limiter.admit(user.id)
+    return prompt, cached, ticket, user_message
+
+
+@app.post('/coach/chat', response_class=HTMLResponse)
+async def chat(request: Request, user_question: str = Form(...), session: AsyncSession = Depends(get_async_session),
+               ollama_service=Depends(get_ollama_service), user: Users = Depends(get_current_user)):
+    # Получаем данные
+    if not user.user_profile:
+        return RedirectResponse(url="/profile/create", status_code=303)
+    prompt, cached, ticket, user_message = await prepare_chat(session, user, user_question, ollama_service)
+    answer = cached.answer
+    if ticket is not None:
+        try:
+            await ticket.wait()
+            # Вызываем ИИ и передаем старую историю + новый вопрос
+            answer = await ollama_service.chat(messages=prompt, tier=choose_tier(user_question))
+        finally:
+            ticket.release()
+        cached.store(answer)
+    # Сохраняем вопрос и ответ в контекст
     assistant_message = ChatMessage(user_id=user.id, role='assistant', content=answer)
-    session.add(assistant_message)
-    session.commit()
+    session.add_all([user_message, assistant_message])
+    await session.commit()
+    schedule_summary(user.id, ollama_service)
 
     return RedirectResponse(url='/coach', status_code=303)
 
 
+def sse_event(event: str, data: dict) -> str:
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+@app.post('/coach/chat/stream')
+async def chat_stream(request: Request, user_question: str = Form(...),
+                      session: AsyncSession = Depends(get_async_session), ollama_service=Depends(get_ollama_service),
+                      user: Users = Depends(get_current_user)):
+    started = time.perf_counter()
+    if not user.user_profile:
+        raise HTTPException(status_code=400, detail='Сначала заполните профиль')
+    prompt, cached, ticket, user_message = await prepare_chat(session, user, user_question, ollama_service)
+    user_id = user.id
+
+    async def events():
+        # Сессия запроса здесь уже не используется: вопрос и ответ сохраняем отдельной короткой сессией
+        parts = []
+        if ticket is None:
+            # Ответ из кэша отдаем одним событием, модель не вызывается
+            parts.append(cached.answer)
+            yield sse_event('token', {'content': cached.answer})
+        else:
+            try:
+                # Пока ждем свободную модель, сообщаем клиенту место в очереди
+                async for position in ticket.positions():
+                    yield sse_event('queue', {'position': position})
+                async for token in ollama_service.chat_stream(messages=prompt, tier=choose_tier(user_question)):
+                    if not parts:
+                        metrics.observe('chat_time_to_first_token_seconds', time.perf_counter() - started)
+                    parts.append(token)
+                    yield sse_event('token', {'content': token})
+            except HTTPException as e:
+                metrics.increment('chat_stream_errors')
+                yield sse_event('error', {'detail': e.detail})
+                return
+            finally:
+                ticket.release()
+        answer = ''.join(parts)
+        if ticket is not None:
+            cached.store(answer)
+        async with AsyncSession(async_engine) as answer_session:
+            answer_session.add_all([user_message, ChatMessage(user_id=user_id, role='assistant', content=answer)])
+            await answer_session.commit()
+        schedule_summary(user_id, ollama_service)
+        metrics.observe('chat_total_seconds', time.perf_counter() - started)
+        yield sse_event('done', {})
+
+    # Фоновая задача освобождает место, даже если клиент ушел до начала потока
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             background=BackgroundTask(ticket.release) if ticket is not None else None,
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.get('/statistics')
-async def main_stat(request: Request, session: Session = Depends(get_session), user: Users = Depends(get_current_user)
-                    , period: int = 7):
-    # Делаем запрос к базе данных
-    week_ago = datetime.now() - timedelta(days=period)
-    workouts_for_range = session.exec(
-        select(Workout).join(UploadedFile).where(UploadedFile.uploaded_at >= week_ago,
-                                                 UploadedFile.user_id == user.id)).all()
-
-    # Списки с сырыми данными
-    count_workouts = len(workouts_for_range)
-    raw_distance = []
-    raw_tss = []
-    total_moving_time = timedelta(days=0)
-    raw_watts = []
-    raw_speed = []
-    raw_heartrate = []
-    raw_cadence = []
-    raw_in_factor = []
-    raw_norm_power = []
-    raw_max_hr = []
-    raw_ccall = []
-    raw_chart_dates = []
-
-    # Собираем все данные
-    for workout in workouts_for_range:
-        raw_chart_dates.append(workout.source_file.uploaded_at.strftime('%d.%m'))
-        raw_distance.append(workout.distance_km)
-        raw_ccall.append(workout.calories_burned)
-        raw_tss.append(workout.training_stress_score)
-        total_moving_time += workout.duration
-        raw_max_hr.append(workout.max_heartrate)
-        raw_norm_power.append(workout.normalized_power)
-        raw_in_factor.append(workout.intensity_factor)
-        raw_cadence.append(workout.avg_cadence)
-        raw_watts.append(workout.avg_watts)
-        raw_speed.append(workout.avg_speed)
-        raw_heartrate.append(workout.avg_heartrate)
-
-    # Очищаем данные от None
-    cleaned_in_factor = [el for el in raw_in_factor if el is not None]
-    cleaned_np = [el for el in raw_norm_power if el is not None]
-    cleaned_tss = [el for el in raw_tss if el is not None]
-    cleaned_watts = [el for el in raw_watts if el is not None]
-    cleaned_speed = [el for el in raw_speed if el is not None]
-    cleaned_heartrate = [el for el in raw_heartrate if el is not None]
-    cleaned_cadence = [el for el in raw_cadence if el is not None]
-    cleaned_max_hr = [el for el in raw_max_hr if el is not None]
-    cleaned_ccall = [el for el in raw_ccall if el is not None]
-
-    # Рассчитываем значения
-    max_in_factor = max(cleaned_in_factor) if cleaned_in_factor else 0
-    max_distance = max(raw_distance) if raw_distance else 0
-    max_np = max(cleaned_np) if cleaned_np else 0
-    max_heartrate = max(cleaned_max_hr) if cleaned_max_hr else 0
-    max_ccall = max(cleaned_ccall) if cleaned_ccall else 0
-    avg_heartrate_num = sum(cleaned_heartrate) / len(cleaned_heartrate) if cleaned_heartrate else 0
-    avg_speed_num = sum(cleaned_speed) / len(cleaned_speed) if cleaned_speed else 0
-    avg_watts_num = sum(cleaned_watts) / len(cleaned_watts) if cleaned_watts else 0
-    avg_cadence_num = sum(cleaned_cadence) / len(cleaned_cadence) if cleaned_cadence else 0
-    total_ccall = sum(cleaned_ccall) if cleaned_ccall else 0
-    total_tss_num = sum(cleaned_tss) if cleaned_tss else 0
-    return templates.TemplateResponse('statistics.html', {'request': request, 'count_workouts': count_workouts,
-                                                          'raw_total_distance': raw_distance,
-                                                          'total_tss_num': total_tss_num,
-                                                          'total_moving_time': total_moving_time,
-                                                          'avg_watts_num': avg_watts_num,
-                                                          'avg_speed_num': avg_speed_num,
-                                                          'avg_heartrate_num': avg_heartrate_num,
-                                                          'max_in_factor': max_in_factor, 'max_distance': max_distance,
-                                                          'max_np': max_np, 'max_heartrate': max_heartrate,
-                                                          'avg_cadence_num': avg_cadence_num, 'period': period,
-                                                          'total_ccall': total_ccall, 'max_ccall': max_ccall,
-                                                          'raw_distance': raw_distance, 'raw_tss': raw_tss,
-                                                          'raw_watts': raw_watts, 'raw_speed': raw_speed,
-                                                          'raw_heartrate': raw_heartrate, 'raw_cadence': raw_cadence,
-                                                          'raw_in_factor': raw_in_factor,
-                                                          'raw_norm_power': raw_norm_power, 'raw_max_hr': raw_max_hr,
-                                                          'raw_ccall': raw_ccall, 'raw_chart_dates': raw_chart_dates})
+async def main_stat(request: Request, session: AsyncSession = Depends(get_async_session),
+                    user: Users = Depends(get_current_user), period: int = 7):
+    # Два запроса к роллапам: агрегаты за период и ряды для графиков
+    since = date.today() - timedelta(days=period)
+    totals = await session.run_sync(rollups.period_totals, user.id, since)
+    # Для длинных периодов график строим по неделям / месяцам
+    chart_period = 'day' if period <= 90 else 'week' if period <= 730 else 'month'
+    series = await session.run_sync(rollups.period_series, user.id, chart_period, since)
+
+    raw_chart_dates = [row.period_start.strftime('%d.%m' if chart_period != 'month' else '%m.%Y') for row in series]
+    raw_tss = [row.training_stress_score for row in series]
+    raw_watts = [row.avg_watts for row in series]
+    raw_speed = [row.avg_speed for row in series]
+    raw_heartrate = [row.avg_heartrate for row in series]
+    raw_cadence = [row.avg_cadence for row in series]
+    return templates.TemplateResponse('statistics.html', {'request': request, 'count_workouts': totals['count'],
+                                                          'total_distance': totals['distance_km'],
+                                                          'total_tss_num': totals['training_stress_score'],
+                                                          'total_moving_time': timedelta(
+                                                              seconds=totals['moving_seconds']),
+                                                          'avg_watts_num': totals['avg_watts'],
+                                                          'avg_speed_num': totals['avg_speed'],
+                                                          'avg_heartrate_num': totals['avg_heartrate'],
+                                                          'max_in_factor': totals['max_intensity_factor'],
+                                                          'max_distance': totals['max_distance_km'],
+                                                          'max_np': totals['max_normalized_power'],
+                                                          'max_heartrate': totals['max_heartrate'],
+                                                          'avg_cadence_num': totals['avg_cadence'], 'period': period,
+                                                          'total_ccall': totals['calories_burned'],
+                                                          'max_ccall': totals['max_calories'],
+                                                          'raw_tss': raw_tss, 'raw_watts': raw_watts,
+                                                          'raw_speed': raw_speed, 'raw_heartrate': raw_heartrate,
+                                                          'raw_cadence': raw_cadence,
+                                                          'raw_chart_dates': raw_chart_dates})
+
+
+@app.get('/fitness')
+async def fitness_series(session: AsyncSession = Depends(get_async_session), user: Users = Depends(get_current_user),
+                         days: int = 90) -> dict:
+    """CTL / ATL / TSB по дням за последние days дней и значения на сегодня"""
+    days = min(max(days, 1), 3650)
+    since = date.today() - timedelta(days=days - 1)
+    rows = await session.run_sync(fitness.series, user.id, since)
+    return {'current': rows[-1] if rows else None, 'series': rows}
 
 
 @app.get('/register', response_class=HTMLResponse)
@@ -397,28 +550,37 @@ async def get_register_page(request: Request):
 
 
 @app.post('/register')
-def register(request: Request, email: str = Form(...), password: str = Form(...), session=Depends(get_session)):
+async def register(request: Request, email: str = Form(...), password: str = Form(...),
+                   session: AsyncSession = Depends(get_async_session)):
     # Делаем запрос в БД и проверяем существует данный пользователь или нет
-    query = session.exec(select(Users).where(Users.email == email)).first()
+    query = (await session.exec(select(Users).where(Users.email == email))).first()
     if query:
         raise HTTPException(status_code=400, detail='Этот email уже зарегистрирован')
     # Создаем хэш пароля и добавляем новую запись в БД
-    hashed_pas = get_password_hash(password)
+    # bcrypt считается долго: в отдельном пуле, чтобы не останавливать цикл событий
+    hashed_pas = await hash_password_async(password)
     new_user = Users(email=email, hashed_password=hashed_pas)
     session.add(new_user)
-    session.commit()
+    await session.commit()
     return RedirectResponse(url='/login', status_code=303)
 
 
 @app.post('/login')
-def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), session=Depends(get_session)):
+async def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends(),
+                session: AsyncSession = Depends(get_async_session)):
     # Ищем пользователя в БД
-    query = session.exec(select(Users).where(Users.email == form_data.username)).first()
+    query = (await session.exec(select_user().where(Users.email == form_data.username))).first()
     if not query:
         raise HTTPException(status_code=400, detail='Пользователь не найден или не верный пароль')
     # Проверяем пароль
-    if verify_password(plain_password=form_data.password, hashed_password=query.hashed_password):
-        jwt_token = create_access_token(data={'sub': form_data.username})
+    verified, new_hash = await verify_and_update_password(form_data.password, query.hashed_password)
+    if verified:
+        if new_hash:
+            # Изменилась стоимость bcrypt: незаметно для пользователя сохраняем хэш с новыми параметрами
+            query.hashed_password = new_hash
+            session.add(query)
+            await session.commit()
+        jwt_token = create_access_token(data={'sub': str(query.id)})
         if query.user_profile is None:
             redirect_url = '/profile/create'
         else:
@@ -435,6 +597,14 @@ def get_login_page(request: Request):
     return templates.TemplateResponse('login.html', {'request': request})
 
 
+@app.get('/metrics')
+def get_metrics(user: Users = Depends(get_current_user)) -> dict:
+    # Остальным пользователям маршрута как будто нет
+    if user.email.lower() not in METRICS_ADMINS:
+        raise HTTPException(status_code=404, detail='Not Found')
+    return metrics.snapshot()
+
+
 @app.get('/me')
 def me(user=Depends(get_current_user)) -> dict:
     return {'id': user.id, 'email': user.email}
@@ -451,7 +621,5 @@ def get_logout(request: Request, user: Users = Depends(get_current_user)):
 def error(request: Request, exc: HTTPException):
     status_code = exc.status_code
     detail = exc.detail
-    return templates.TemplateResponse('error.html', {'request': request, 'detail': detail, 'status_code': status_code})
-
-
-
+    return templates.TemplateResponse('error.html', {'request': request, 'detail': detail, 'status_code': status_code},
+                                      status_code=status_code, headers=exc.headers)
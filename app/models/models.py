@@ -1,12 +1,18 @@
 from datetime import date, datetime, timedelta
 from pathlib import Path
-from typing import Optional, List, Text
+from typing import Annotated, Optional, List, Text
 
-from pydantic import BaseModel
+from pydantic import BaseModel, StringConstraints, conlist
+from sqlalchemy import Index, UniqueConstraint
 from sqlmodel import SQLModel, Field, Relationship
 
 
 class UploadedFile(SQLModel, table=True):
+    __table_args__ = (
+        Index('ix_uploadedfile_user_id_sha256', 'user_id', 'sha256'),  # проверка дубликатов
+        Index('ix_uploadedfile_user_id_uploaded_at', 'user_id', 'uploaded_at'),  # выборки за период
+    )
+
     id: int = Field(default=None, primary_key=True)
     original_name: str
     sha256: str
@@ -16,6 +22,11 @@ class UploadedFile(SQLModel, table=True):
 
 
 class Workout(SQLModel, table=True):
+    __table_args__ = (
+        Index('ix_workout_user_id_id', 'user_id', 'id'),  # список тренировок пользователя
+        Index('ix_workout_source_file_id', 'source_file_id'),
+    )
+
     id: int = Field(primary_key=True, default=None)
     duration: timedelta
     moving_time: timedelta
@@ -49,6 +60,7 @@ class AthleteProfile(SQLModel, table=True):
     id: Optional[int] = Field(primary_key=True, foreign_key='users.id')
     weight_kg: Optional[float]
     current_ftp: Optional[int]
+    max_heartrate: Optional[int] = None  # от него строятся пульсовые зоны заездов
     limitations: Optional[str]
     weekly_hours: Optional[int]  # Сколько времени есть на тренировки в неделю
     gear: Optional[str]  # какое оборудование есть у пользователя(велосипед, станки..)
@@ -57,6 +69,8 @@ class AthleteProfile(SQLModel, table=True):
 
 
 class ChatMessage(SQLModel, table=True):
+    __table_args__ = (Index('ix_chatmessage_user_id_created_at', 'user_id', 'created_at'),)
+
     id: Optional[int] = Field(primary_key=True, default=None)
     user_id: int = Field(foreign_key='users.id')
     role: str  # user или assistant
@@ -65,6 +79,15 @@ class ChatMessage(SQLModel, table=True):
     user: Optional['Users'] = Relationship(back_populates='messages')
 
 
+class ChatSummary(SQLModel, table=True):
+    """Сжатое резюме старой части диалога: сообщения с id <= last_message_id в промпт целиком не попадают"""
+    id: Optional[int] = Field(primary_key=True, default=None)
+    user_id: int = Field(foreign_key='users.id', unique=True)
+    content: str = ''
+    last_message_id: int = 0
+    updated_at: datetime = Field(default_factory=datetime.now)
+
+
 class Users(SQLModel, table=True):
     id: Optional[int] = Field(primary_key=True, default=None)
     email: str = Field(unique=True)
@@ -82,3 +105,126 @@ class UserCreate(BaseModel):
 class UserLogin(BaseModel):
     email: str
     password: str
+
+
+class ImportCheck(BaseModel):
+    """Хэши SHA-256 файлов, которые клиент собирается загрузить"""
+    hashes: conlist(Annotated[str, StringConstraints(pattern=r'^[0-9a-f]{64}$')], max_length=1000)
+
+
+class ImportJob(SQLModel, table=True):
+    id: Optional[int] = Field(primary_key=True, default=None)
+    user_id: int = Field(foreign_key='users.id')
+    status: str = 'queued'  # queued, running или done
+    created_at: datetime = Field(default_factory=datetime.now)
+    finished_at: Optional[datetime] = None
+    files: List['ImportJobFile'] = Relationship(back_populates='job')
+
+
+class ImportJobFile(SQLModel, table=True):
+    __table_args__ = (Index('ix_importjobfile_job_id_position', 'job_id', 'position'),)
+
+    id: Optional[int] = Field(primary_key=True, default=None)
+    job_id: int = Field(foreign_key='importjob.id')
+    position: int  # порядок файла в загрузке, в нем же сохраняются результаты
+    original_name: str
+    sha256: Optional[str] = None
+    file_path: Optional[str] = None
+    status: str = 'pending'  # pending, success, dup или err
+    error: Optional[str] = None
+    job: Optional['ImportJob'] = Relationship(back_populates='files')
+
+
+class Blob(SQLModel, table=True):
+    """Исходный файл в хранилище data/blobs, одна сжатая копия на содержимое.
+    refcount — сколько UploadedFile на него ссылается, блобы с нулем удаляются при запуске."""
+    id: Optional[int] = Field(primary_key=True, default=None)
+    sha256: str = Field(unique=True)
+    size: int  # байт до сжатия
+    stored_size: int  # байт на диске
+    refcount: int = 0
+    created_at: datetime = Field(default_factory=datetime.now)
+
+
+class FtpHistory(SQLModel, table=True):
+    """FTP атлета действует с effective_from до следующей записи. Самая ранняя запись
+    применяется и к тренировкам до нее: других данных о FTP в то время нет."""
+    __table_args__ = (UniqueConstraint('user_id', 'effective_from'),)
+
+    id: Optional[int] = Field(primary_key=True, default=None)
+    user_id: int = Field(foreign_key='users.id')
+    ftp: int
+    effective_from: date
+    created_at: datetime = Field(default_factory=datetime.now)
+
+
+class RecomputeJob(SQLModel, table=True):
+    """Пересчет IF/TSS тренировок после смены FTP. last_workout_id — контрольная точка:
+    после перезапуска задача продолжается со следующей пачки."""
+    id: Optional[int] = Field(primary_key=True, default=None)
+    user_id: int = Field(foreign_key='users.id')
+    since: Optional[date] = None  # с какой даты тренировки затронуты, None — вся история
+    status: str = 'queued'  # queued, running или done
+    total: int = 0
+    done: int = 0
+    last_workout_id: int = 0
+    created_at: datetime = Field(default_factory=datetime.now)
+    finished_at: Optional[datetime] = None
+
+
+class ReingestRun(SQLModel, table=True):
+    """Повторный разбор исходных файлов из командной строки (python -m app.reingest).
+    last_file_id — контрольная точка: прерванный запуск продолжается со следующего файла."""
+    id: Optional[int] = Field(primary_key=True, default=None)
+    status: str = 'running'  # running, done или cancelled (--restart)
+    user_id: Optional[int] = None  # только файлы одного пользователя, None — все
+    last_file_id: int = 0
+    files: int = 0
+    errors: int = 0
+    samples: int = 0  # строк CSV разобрано
+    seconds: float = 0  # время работы всех запусков, для отчета о скорости
+    started_at: datetime = Field(default_factory=datetime.now)
+    finished_at: Optional[datetime] = None
+
+
+class WorkoutRollup(SQLModel, table=True):
+    """Предрассчитанные итоги тренировок пользователя за день / неделю / месяц"""
+    __table_args__ = (UniqueConstraint('user_id', 'period', 'period_start'),)
+
+    id: Optional[int] = Field(primary_key=True, default=None)
+    user_id: int = Field(foreign_key='users.id')
+    period: str  # day, week или month
+    period_start: date
+    count: int = 0
+    distance_km: float = 0
+    moving_seconds: int = 0
+    training_stress_score: float = 0
+    calories_burned: int = 0
+    # Суммы и количества для средних по тренировкам
+    watts_sum: float = 0
+    watts_count: int = 0
+    speed_sum: float = 0
+    speed_count: int = 0
+    heartrate_sum: float = 0
+    heartrate_count: int = 0
+    cadence_sum: float = 0
+    cadence_count: int = 0
+    # Максимумы
+    max_distance_km: Optional[float] = None
+    max_heartrate: Optional[float] = None
+    max_normalized_power: Optional[float] = None
+    max_intensity_factor: Optional[float] = None
+    max_calories: Optional[int] = None
+
+
+class FitnessDay(SQLModel, table=True):
+    """Модель нагрузки по дням: CTL (форма, 42 дня), ATL (усталость, 7 дней) и TSB (свежесть)"""
+    __table_args__ = (UniqueConstraint('user_id', 'day'),)
+
+    id: Optional[int] = Field(primary_key=True, default=None)
+    user_id: int = Field(foreign_key='users.id')
+    day: date
+    tss: float = 0
+    ctl: float = 0
+    atl: float = 0
+    tsb: float = 0
@@ -0,0 +1,222 @@
+"""Повторный разбор исходных файлов из хранилища после изменений парсера.
+
+    python -m app.reingest [--user ID] [--workers N] [--batch-size N] [--restart]
+
+Файлы находятся по sha256 из UploadedFile (data/blobs или старый data/csv), разбираются в пуле процессов
+на всех ядрах, метрики пишутся пачками в одной транзакции. Прерванный запуск продолжается
+с последней записанной пачки.
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+from sqlalchemy import func, update
+from sqlmodel import Session, select
+
+from app.db import engine, create_db_and_tables
+from app.models.models import ReingestRun, UploadedFile, Workout
+from app.services import blob_store, fitness, rollups
+from app.services.ftp_recompute import ftp_schedule, ftp_for_days
+from app.services.parse_cvs import parse_ride
+from app.services.stream_store import save_streams
+
+
+class ReingestTask(NamedTuple):
+    file_id: int
+    user_id: int
+    workout_id: int | None  # None, если при загрузке тренировка не сохранилась
+    path: str
+    ftp: int | None
+
+
+def _ignore_interrupt() -> None:
+    # Ctrl+C обрабатывает основной процесс: он отменяет очередь, записанные пачки остаются
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def reparse_file(path: str, ftp: int | None, workout_id: int | None) -> tuple[dict, dict | None, int]:
+    """Выполняется в процессе пула. Потоки известной тренировки сохраняются здесь же,
+    чтобы не гонять массивы обратно в основной процесс."""
+    metrics, streams = parse_ride(Path(path), ftp)
+    samples = max((values.size for values in streams.values()), default=0)
+    if workout_id is not None:
+        save_streams(workout_id, streams)
+        streams = None
+    return metrics, streams, samples
+
+
+def _pending_tasks(session: Session, run: ReingestRun) -> tuple[list[ReingestTask], int]:
+    """Файлы после контрольной точки, которые есть в хранилище, и число записей без файла"""
+    statement = (select(UploadedFile.id, UploadedFile.sha256, UploadedFile.user_id, UploadedFile.uploaded_at)
+                 .where(UploadedFile.id > run.last_file_id).order_by(UploadedFile.id))
+    if run.user_id is not None:
+        statement = statement.where(UploadedFile.user_id == run.user_id)
+    workout_ids = dict(session.exec(select(Workout.source_file_id, func.min(Workout.id))
+                                    .group_by(Workout.source_file_id)).all())
+
+    tasks = []
+    missing = 0
+    schedules = {}
+    for file_id, sha256, user_id, uploaded_at in session.exec(statement).all():
+        path = blob_store.find(sha256)
+        if path is None:
+            missing += 1
+            continue
+        if user_id not in schedules:
+            schedules[user_id] = ftp_schedule(session, user_id)
+        schedule = schedules[user_id]
+        ftp = None
+        if schedule[0].size:
+            ftp = int(ftp_for_days(schedule, np.array([uploaded_at.date()], dtype='datetime64[D]'))[0])
+        tasks.append(ReingestTask(file_id, user_id, workout_ids.get(file_id), str(path), ftp))
+    return tasks, missing
+
+
+def _write_batch(session: Session, run: ReingestRun, batch: list[tuple[ReingestTask, tuple | None]]) -> None:
+    """Вся пачка и контрольная точка в одной транзакции, обновления — одним executemany"""
+    updates = []
+    for task, result in batch:
+        run.last_file_id = task.file_id
+        if result is None:
+            run.errors += 1
+            continue
+        metrics, streams, samples = result
+        run.files += 1
+        run.samples += samples
+        if task.workout_id is None:
+            workout = Workout(source_file_id=task.file_id, user_id=task.user_id, **metrics)
+            session.add(workout)
+            session.flush()
+            save_streams(workout.id, streams)
+        else:
+            updates.append({'id': task.workout_id, **metrics})
+    if updates:
+        session.execute(update(Workout), updates)
+    session.add(run)
+    session.commit()
+
+
+def _report(run: ReingestRun, total: int | None = None) -> str:
+    seconds = max(run.seconds, 1e-9)
+    done = run.files + run.errors
+    progress = f'{done}/{total} файлов' if total is not None else f'{done} файлов'
+    return (f'{progress}, ошибок {run.errors}, {run.files / seconds:.1f} файлов/с, '
+            f'{run.samples / seconds:.0f} строк/с')
+
+
+def _new_pool(workers: int) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_ignore_interrupt)
+
+
+def run_reingest(run_id: int, workers: int, batch_size: int) -> ReingestRun:
+    started = time.perf_counter()
+    with Session(engine) as session:
+        run = session.get(ReingestRun, run_id)
+        seconds_before = run.seconds
+        tasks, missing = _pending_tasks(session, run)
+        session.commit()
+        total = run.files + run.errors + len(tasks)
+        print(f'Запуск {run.id}: к разбору {len(tasks)} файлов, без файла в хранилище {missing}')
+
+        # Окно заданий ограничено: результаты берутся по порядку id, память не растет с размером архива
+        pool = _new_pool(workers)
+
+        def submit(task: ReingestTask):
+            return pool.submit(reparse_file, task.path, task.ftp, task.workout_id)
+
+        try:
+            queued = iter(tasks)
+            in_flight = deque((task, submit(task)) for task in islice(queued, workers * 4))
+            batch = []
+            while in_flight:
+                task, future = in_flight.popleft()
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    # Процесс разбора упал (например, по памяти), вместе с пулом пропали все задания окна.
+                    # Текущий файл считается ошибкой, остальные отправляются в новый пул
+                    print(f'Процесс разбора упал на {task.path}: {e}')
+                    result = None
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = _new_pool(workers)
+                    in_flight = deque((pending, submit(pending)) for pending, _ in in_flight)
+                except Exception as e:
+                    # Как в import_jobs.process_job: ошибка одного файла не останавливает запуск
+                    print(f'Ошибка разбора {task.path}: {e}')
+                    result = None
+                next_task = next(queued, None)
+                if next_task is not None:
+                    in_flight.append((next_task, submit(next_task)))
+                batch.append((task, result))
+                if len(batch) >= batch_size or not in_flight:
+                    run.seconds = seconds_before + time.perf_counter() - started
+                    _write_batch(session, run, batch)
+                    batch = []
+                    print(_report(run, total))
+        except KeyboardInterrupt:
+            pool.shutdown(wait=False, cancel_futures=True)
+            session.rollback()
+            print(f'Прервано после файла {run.last_file_id}, повторный запуск продолжит с этого места')
+            raise SystemExit(1)
+        pool.shutdown()
+
+        # Роллапы и ряд нагрузки строятся заново один раз: метрики могли измениться у любой тренировки
+        statement = select(UploadedFile.user_id).distinct()
+        if run.user_id is not None:
+            statement = statement.where(UploadedFile.user_id == run.user_id)
+        for user_id in session.exec(statement).all():
+            rollups.rebuild_user(session, user_id)
+            fitness.rebuild_user(session, user_id)
+        run.status = 'done'
+        run.seconds = seconds_before + time.perf_counter() - started
+        run.finished_at = datetime.now()
+        session.add(run)
+        session.commit()
+        session.refresh(run)
+        print(f'Готово: {_report(run)} за {run.seconds:.1f} с')
+        return run
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description='Повторный разбор исходных файлов тренировок')
+    parser.add_argument('--user', type=int, default=None, help='только файлы пользователя с этим id')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='процессов для разбора')
+    parser.add_argument('--batch-size', type=int, default=500, help='файлов в одной транзакции')
+    parser.add_argument('--restart', action='store_true', help='начать заново, а не продолжить прерванный запуск')
+    args = parser.parse_args(argv)
+
+    create_db_and_tables()
+    with Session(engine) as session:
+        run = None
+        if args.restart:
+            for unfinished in session.exec(select(ReingestRun).where(ReingestRun.status == 'running',
+                                                                      ReingestRun.user_id == args.user)).all():
+                unfinished.status = 'cancelled'
+                session.add(unfinished)
+        else:
+            run = session.exec(select(ReingestRun).where(ReingestRun.status == 'running',
+                                                         ReingestRun.user_id == args.user)
+                               .order_by(ReingestRun.id.desc())).first()
+        if run is None:
+            run = ReingestRun(user_id=args.user)
+            session.add(run)
+            session.commit()
+        else:
+            print(f'Продолжаем запуск {run.id} после файла {run.last_file_id}')
+        run_id = run.id
+    run_reingest(run_id, max(1, args.workers), max(1, args.batch_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,77 +1,108 @@
+import asyncio
+import math
 from datetime import date
-import httpx
 from typing import List
-from fastapi import HTTPException
+
+from app.core.config import OLLAMA_WARMUP, COACH_CONTEXT_TOKENS, COACH_RESPONSE_TOKENS
+from app.services.llm_providers import LLMRouter, build_router
 from app.models.models import ChatMessage, AthleteProfile
 from pathlib import Path
 
+PROMPTS_DIR = Path(__file__).parent.parent / 'prompts'
+CHARS_PER_TOKEN = 3  # грубая оценка для русского текста с числами, токенизатора модели у нас нет
 
-def get_ollama_service():
-    return OllamaService()
+_service: 'OllamaService | None' = None
 
 
-class OllamaService:
-    """Сервис для работы с Ollama API"""
+def count_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
 
-    def __init__(self, base_url: str = "http://localhost:11434"):
-        self.base_url = base_url
-        self.model = "llama3.1"
-        self.system_prompt = self._load_prompt('System_Persona.txt')
-        self.user_profile = self._load_prompt('User_Profile.txt')
-        self.current_content = self._load_prompt('Current_Content.txt')
 
-    @staticmethod
-    def _load_prompt(filename: str) -> str:
-        current_file = Path(__file__)
-        prompt_path = current_file.parent.parent / 'prompts' / filename
+def _or_missing(value):
+    """IF/TSS без FTP и NP без данных мощности хранятся как NULL"""
+    return 'нет данных' if value is None else value
+
+
+def get_ollama_service() -> 'OllamaService':
+    """Один сервис на все время жизни приложения: общий пул соединений и загруженные промпты"""
+    global _service
+    if _service is None:
+        _service = OllamaService()
+    return _service
+
+
+async def close_ollama_service() -> None:
+    global _service
+    if _service is not None:
+        await _service.aclose()
+        _service = None
+
+
+class PromptTemplate:
+    """Шаблон промпта из файла. Файл перечитывается, только если изменилось время его модификации."""
+
+    def __init__(self, filename: str):
+        self.path = PROMPTS_DIR / filename
+        self._mtime = None
+        self._text = ''
+
+    @property
+    def text(self) -> str:
         try:
-            return prompt_path.read_text(encoding='utf-8')
+            mtime = self.path.stat().st_mtime_ns
+            if mtime != self._mtime:
+                self._text = self.path.read_text(encoding='utf-8')
+                self._mtime = mtime
         except Exception as e:
             print(f'Ошибка загрузки промта: {e}')
-            return 'Произошла ошибка файл промпта не найден'
+            return self._text or 'Произошла ошибка файл промпта не найден'
+        return self._text
 
-    async def generate(self, prompt: str, timeout: int = 60) -> str:
-        """Отправляет промпт в Ollama и возвращает ответ модели """
-        try:
-            # Создаём асинхронный HTTP-клиент с таймаутом
-            async with httpx.AsyncClient(timeout=timeout) as client:
-                # Отправляем POST-запрос к Ollama API
-                response = await client.post(
-                    f"{self.base_url}/api/generate",  # URL эндпоинта
-                    json={
-                        "model": self.model,  # Название модели
-                        "prompt": prompt,  # Промпт для модели
-                        "stream": False,  # Без потоковой передачи
-                        "options": {
-                            "num_ctx": 8192  # Контекстное окно 8k
-                        }
-                    }
-                )
-                # Проверяем, что запрос успешен (код 200)
-                response.raise_for_status()
-                # Парсим JSON-ответ
-                data = response.json()
-                # Извлекаем текст ответа модели
-                return data.get("response", "")
-        except httpx.ConnectError:
-            # Ollama не запущен или недоступен
-            raise HTTPException(
-                status_code=503,
-                detail="Сервис ИИ недоступен. Убедитесь, что Ollama запущен."
-            )
-        except httpx.TimeoutException:
-            # Превышено время ожидания
-            raise HTTPException(
-                status_code=504,
-                detail="Превышено время ожидания ответа от ИИ."
-            )
-        except Exception as e:
-            # Любая другая ошибка
-            print(f"Ошибка при вызове Ollama: {e}")
-            raise HTTPException(
-                status_code=500,
-                detail="Внутренняя ошибка при обращении к ИИ."
-            )
+
+class OllamaService:
+    """Сервис ИИ-тренера: промпты и обращения к модели. Какой бэкенд отвечает, решает роутер провайдеров."""
+
+    def __init__(self, router: LLMRouter | None = None):
+        self.router = router or build_router()
+        self._system_prompt = PromptTemplate('System_Persona.txt')
+        self._user_profile = PromptTemplate('User_Profile.txt')
+        self._current_content = PromptTemplate('Current_Content.txt')
+        self._conversation_summary = PromptTemplate('Conversation_Summary.txt')
+        self._warm_up_task: asyncio.Task | None = None
+
+    @property
+    def system_prompt(self) -> str:
+        return self._system_prompt.text
+
+    @property
+    def user_profile(self) -> str:
+        return self._user_profile.text
+
+    @property
+    def current_content(self) -> str:
+        return self._current_content.text
+
+    @property
+    def conversation_summary(self) -> str:
+        return self._conversation_summary.text
+
+    def start_warm_up(self) -> None:
+        """Загружает модель в фоне при старте, чтобы первый вопрос не ждал холодной загрузки"""
+        if OLLAMA_WARMUP:
+            self._warm_up_task = asyncio.create_task(self.warm_up())
+
+    async def warm_up(self) -> None:
+        await self.router.warm_up()
+
+    async def aclose(self) -> None:
+        if self._warm_up_task is not None:
+            self._warm_up_task.cancel()
+            await asyncio.gather(self._warm_up_task, return_exceptions=True)
+        await self.router.aclose()
+
+    async def generate(self, prompt: str, timeout: int | None = None, tier: str | None = None) -> str:
+        """Отправляет промпт модели и возвращает ответ. Без timeout действует таймаут провайдера из настроек."""
+        return await self.router.generate(prompt, tier=tier, timeout=timeout)
 
     @staticmethod
     def format_workouts(workouts: List) -> str:
@@ -88,8 +119,9 @@ class OllamaService:
             line = (f'{i}. '
                     f'{workout.distance_km} км'
                     f'{workout.duration}, '
-                    f'TSS {workout.training_stress_score}, '
-                    f'{workout.avg_watts} Вт (NP {workout.normalized_power} ВТ, IF {workout.intensity_factor})')
+                    f'TSS {_or_missing(workout.training_stress_score)}, '
+                    f'{workout.avg_watts} Вт (NP {_or_missing(workout.normalized_power)} ВТ, '
+                    f'IF {_or_missing(workout.intensity_factor)})')
             if workout.avg_heartrate:
                 line += f', {workout.avg_heartrate} уд/мин'
             if workout.avg_cadence:
@@ -97,6 +129,14 @@ class OllamaService:
             result += line + '\n'
         return result
 
+    @staticmethod
+    def format_fitness(fitness: dict | None) -> str:
+        """Текущие форма, усталость и свежесть для промпта, дописываются к списку тренировок"""
+        if not fitness:
+            return ''
+        return (f'\nНагрузка на сегодня: CTL (форма) {fitness["ctl"]:.1f}, ATL (усталость) {fitness["atl"]:.1f}, '
+                f'TSB (свежесть) {fitness["tsb"]:.1f}')
+
     async def get_training_advice(self, profile, workouts: List) -> str:
         """Получает рекомендации от ИИ-тренера
         Args:
@@ -114,38 +154,27 @@ class OllamaService:
                   f' а так же составь список тренировок на неделю. Вот мои '
                   f'данные: мой FTP: {ftp}, 'f'вес: {weight_kg}. Вот мой список тренировок:')
         prompt += result
-        advice = await self.generate(prompt)
+        advice = await self.generate(prompt, tier='large')
         return advice
 
-    async def chat(self, messages: List[dict], timeout: int = 60) -> str:
-        try:
-            async with httpx.AsyncClient(timeout=timeout) as client:
-                response = await client.post(f"{self.base_url}/api/chat", json={'model': self.model,
-                                                                                'messages': messages, 'stream': False,
-                                                                                'options': {'num_ctx': 8192}})
-            response.raise_for_status()
-            data = response.json()
-            return data.get('message', {}).get('content', "")
-
-        except httpx.ConnectError:
-            raise HTTPException(503, detail='Сервис ИИ не доступен')
-        except httpx.TimeoutException:
-            raise HTTPException(504, detail='Превышено время ожидания')
-        except Exception as e:
-            print(f'Ошибка Chat: {e}')
-            raise HTTPException(500, detail='Внутренняя ошибка ИИ')
-
-    async def get_chat_response(self, history: List['ChatMessage'], user_question: str):
-        system_instruction = self.system_prompt.format(sport='cycling')
-        message_list = [{'role': 'system', 'content': system_instruction}]
+    async def chat(self, messages: List[dict], timeout: int | None = None, tier: str | None = None) -> str:
+        return await self.router.chat(messages, tier=tier, timeout=timeout)
 
-        for msg in history:
-            message_list.append({'role': msg.role, 'content': msg.content})
-        message_list.append({'role': 'user', 'content': user_question})
+    async def chat_stream(self, messages: List[dict], timeout: int | None = None, tier: str | None = None):
+        """Отдает ответ модели по частям по мере генерации"""
+        async for token in self.router.chat_stream(messages, tier=tier, timeout=timeout):
+            yield token
 
-        return await self.chat(message_list)
+    async def embed(self, text: str) -> list[float] | None:
+        """Эмбеддинг текста локальной моделью. Нужен только кэшу, поэтому ошибки не пробрасываются."""
+        return await self.router.embed(text)
 
-    async def build_chat_messages(self, user_profile, athlete_profile, user_message, summary, message_history):
+    async def build_chat_messages(self, user_profile, athlete_profile, user_message, summary, message_history,
+                                  conversation_summary: str | None = None):
+        """Порядок сообщений рассчитан на KV-кэш Ollama: от стабильного к изменчивому.
+        Персона и профиль не меняются между репликами, история только дописывается в конец,
+        дата, сводка тренировок и вопрос идут последним сообщением. Так от хода к ходу совпадает
+        длинный префикс, и модель не пересчитывает его заново."""
         # Достаем данные атлета
         # Объединяем данные
         athlete_data = user_profile.model_dump()
@@ -157,26 +186,32 @@ class OllamaService:
             if value is None:
                 athlete_data[key] = "Не указано"
 
-        # Формируем историю
-        history_text = self.format_history(message_history)
-
         # Заполняем шаблоны
+        system_prompt = self.system_prompt.format(sport='cycling')
         profile_section = self.user_profile.format(**athlete_data)
         content_section = self.current_content.format(current_date=date.today().isoformat(),
                                                       recent_workouts_summary=summary,
                                                       user_message=user_message)
-        # Собираем все вместе
-        user_prompt = f'{profile_section}\n\n{history_text}\n\n{content_section}'
-
-        return [{'role': 'system', 'content': self.system_prompt},
-                {'role': 'user', 'content': user_prompt}]
-
-    def format_history(self, history: List[ChatMessage]) -> str:
-        # Берем последние 10 объектов
-        recent_msgs = history[-10:]
-        result = '### ПРЕДЫДУЩИЕ СООБЩЕНИЯ\n'
-        # Перебираем последние сообщения
-        for mess in recent_msgs:
-            dump_mess = mess.model_dump(include={'role', 'content'})
-            result += f'{dump_mess["role"]}: {dump_mess["content"]}\n'
-        return result
+        messages = [{'role': 'system', 'content': f'{system_prompt}\n\n{profile_section}'}]
+        if conversation_summary:
+            messages.append({'role': 'system', 'content': f'### РЕЗЮМЕ ПРЕДЫДУЩЕГО ДИАЛОГА\n{conversation_summary}'})
+
+        # Профиль, сводка и вопрос обязательны, история получает то, что осталось от окна за вычетом ответа
+        budget = COACH_CONTEXT_TOKENS - COACH_RESPONSE_TOKENS - sum(
+            count_tokens(message['content']) for message in messages) - count_tokens(content_section)
+        messages.extend({'role': mess.role, 'content': mess.content}
+                        for mess in self.fit_history(message_history, budget))
+        messages.append({'role': 'user', 'content': content_section})
+        return messages
+
+    @staticmethod
+    def fit_history(history: List[ChatMessage], budget: int) -> List[ChatMessage]:
+        """Последние сообщения, начиная с новых, пока помещаются в бюджет токенов"""
+        fitted = []
+        used = 0
+        for mess in reversed(history):
+            used += count_tokens(mess.content)
+            if used > budget:
+                break
+            fitted.append(mess)
+        return fitted[::-1]
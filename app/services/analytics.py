@@ -0,0 +1,146 @@
+import numpy as np
+
+from app.services.parse_cvs import NP_WINDOW
+
+# Верхние границы зон Коггана в долях FTP: Z1 Recovery ... Z7 Neuromuscular
+POWER_ZONES = (0.55, 0.75, 0.90, 1.05, 1.20, 1.50)
+POWER_ZONE_NAMES = ('Z1 Recovery', 'Z2 Endurance', 'Z3 Tempo', 'Z4 Threshold', 'Z5 VO2max', 'Z6 Anaerobic',
+                    'Z7 Neuromuscular')
+# Верхние границы пульсовых зон в долях максимального пульса спортсмена из профиля
+HR_ZONES = (0.60, 0.70, 0.80, 0.90)
+HR_ZONE_NAMES = ('Z1', 'Z2', 'Z3', 'Z4', 'Z5')
+W_PRIME = 20_000  # Дж, типичный W' любителя, если не задан
+# Длительности, которые показываем в таблице кривой мощности
+KEY_DURATIONS = (5, 15, 30, 60, 300, 600, 1200, 1800, 3600)
+
+
+def _as_array(values) -> np.ndarray:
+    """Ряд мощности/пульса в float64, пропуски датчика считаем нулем"""
+    return np.nan_to_num(np.asarray(values, dtype=np.float64), nan=0.0)
+
+
+def curve_durations(length: int, step: float = 1.03) -> np.ndarray:
+    """Длительности для кривой мощности: каждая секунда до минуты, дальше геометрическая сетка до всего заезда.
+    Сетка дает O(log n) точек, поэтому вся кривая считается за O(n log n)."""
+    if length < 1:
+        return np.empty(0, dtype=np.int64)
+    dense = np.arange(1, min(length, 60) + 1)
+    sparse = np.unique(np.geomspace(60, length, num=max(int(np.log(length / 60) / np.log(step)), 2)).astype(np.int64))
+    durations = np.unique(np.concatenate([dense, sparse[sparse <= length], [length]]))
+    return durations
+
+
+def power_curve(watts, durations=None) -> dict[int, float]:
+    """Mean-maximal power: лучшая средняя мощность для каждой длительности.
+    Средние всех окон одной длительности берутся из разности кумулятивных сумм за O(n)."""
+    watts = _as_array(watts)
+    if durations is None:
+        durations = curve_durations(watts.size)
+    cumsum = np.concatenate([[0.0], np.cumsum(watts)])
+    curve = {}
+    for duration in durations:
+        duration = int(duration)
+        if 0 < duration <= watts.size:
+            curve[duration] = float((cumsum[duration:] - cumsum[:-duration]).max() / duration)
+    return curve
+
+
+def normalized_power(watts, window: int = NP_WINDOW) -> float | None:
+    """NP как в parse_cvs.RideAggregator: окно с пропуском (NaN) не считается, как rolling().mean() pandas,
+    поэтому значение совпадает с сохраненным Workout.normalized_power"""
+    watts = np.asarray(watts, dtype=np.float64)
+    if watts.size < window:
+        return None
+    gaps = np.isnan(watts)
+    cumsum = np.concatenate([[0.0], np.cumsum(np.where(gaps, 0.0, watts))])
+    gap_count = np.concatenate([[0], np.cumsum(gaps)])
+    full = (gap_count[window:] - gap_count[:-window]) == 0
+    if not full.any():
+        return None
+    rolling = (cumsum[window:] - cumsum[:-window])[full] / window
+    return float(np.mean(rolling ** 4) ** 0.25)
+
+
+def variability_index(watts) -> float | None:
+    """VI = NP / средняя мощность, среднее без пропусков, как avg_watts при импорте"""
+    watts = np.asarray(watts, dtype=np.float64)
+    np_value = normalized_power(watts)
+    average = np.nanmean(watts) if np.any(~np.isnan(watts)) else 0
+    return float(np_value / average) if np_value and average else None
+
+
+def time_in_zones(values, bounds) -> list[int]:
+    """Секунды (сэмплы при 1 Гц) в каждой зоне, bounds — абсолютные верхние границы зон"""
+    zones = np.searchsorted(np.asarray(bounds, dtype=np.float64), _as_array(values), side='right')
+    return np.bincount(zones, minlength=len(bounds) + 1).tolist()
+
+
+def power_zones(watts, ftp: int) -> list[int]:
+    return time_in_zones(watts, [ftp * bound for bound in POWER_ZONES])
+
+
+def heartrate_zones(heartrate, max_heartrate: float) -> list[int]:
+    heartrate = np.asarray(heartrate, dtype=np.float64)
+    return time_in_zones(heartrate[heartrate > 0], [max_heartrate * bound for bound in HR_ZONES])
+
+
+def aerobic_decoupling(watts, heartrate) -> float | None:
+    """Pw:HR в процентах: насколько упала эффективность (мощность / пульс) во второй половине заезда"""
+    watts = _as_array(watts)
+    heartrate = np.asarray(heartrate, dtype=np.float64)
+    valid = ~np.isnan(heartrate) & (heartrate > 0)
+    watts, heartrate = watts[valid], heartrate[valid]
+    half = watts.size // 2
+    if half == 0:
+        return None
+    first = watts[:half].mean() / heartrate[:half].mean()
+    second = watts[half:].mean() / heartrate[half:].mean()
+    return float((first - second) / first * 100) if first else None
+
+
+def w_prime_balance(watts, cp: float, w_prime: float = W_PRIME) -> np.ndarray:
+    """W' balance по дифференциальной модели Скибы (Froncioni/Clarke).
+    Недостаток d = W' - баланс меняется аффинно: выше CP растет на P - CP, ниже умножается на
+    1 - (CP - P) / W'. Рекурсия d_i = a_i * d_(i-1) + c_i решается кумулятивными суммами:
+    d_n = A_n * sum(c_k / A_k), где A — произведение a. Чтобы 1 / A_k не переполнялся, ряд делится на блоки,
+    внутри которых A падает не более чем в e^600 раз; при обычных CP и W' весь заезд — один блок."""
+    watts = _as_array(watts)
+    above = watts > cp
+    growth = np.where(above, watts - cp, 0.0)
+    # Множитель восстановления ниже CP; при CP >= W' он мог бы стать неположительным — это полное восстановление
+    log_factor = np.where(above, 0.0, np.log(np.clip(1 - (cp - watts) / w_prime, 1e-12, 1.0)))
+    log_product = np.cumsum(log_factor)
+    deficit = np.empty(watts.size)
+    start, carried, base = 0, 0.0, 0.0
+    while start < watts.size:
+        end = max(int(np.searchsorted(-log_product, 600 - base, side='right')), start + 1)
+        product = np.exp(log_product[start:end] - base)
+        deficit[start:end] = product * (carried + np.cumsum(growth[start:end] / product))
+        start, carried, base = end, deficit[end - 1], log_product[end - 1]
+    return w_prime - deficit
+
+
+def analyze_ride(streams, ftp: int | None, max_heartrate: float | None = None, w_prime: float = W_PRIME) -> dict:
+    """Все метрики заезда по посекундным рядам из хранилища потоков (или DataFrame с теми же колонками).
+    Зоны и мощность считаются по сэмплам в движении. Пульсовые зоны строятся от максимального пульса
+    из профиля: от максимума самого заезда спокойная поездка выглядела бы как работа в высоких зонах,
+    и зоны разных заездов нельзя было бы сравнить. Без max_heartrate пульсовые зоны не считаются."""
+    watts = _as_array(streams['watts'])
+    if 'moving' in streams:
+        watts = watts[np.asarray(streams['moving'], dtype=bool)]
+    result = {'power_curve': power_curve(watts), 'variability_index': variability_index(watts),
+              'power_zones': None, 'heartrate_zones': None, 'aerobic_decoupling': None, 'w_prime_balance_min': None}
+    if ftp:
+        result['power_zones'] = power_zones(watts, ftp)
+        balance = w_prime_balance(watts, cp=ftp, w_prime=w_prime)
+        result['w_prime_balance_min'] = float(balance.min()) if balance.size else None
+
+    if 'heartrate' in streams:
+        heartrate = np.asarray(streams['heartrate'], dtype=np.float64)
+        if 'moving' in streams:
+            heartrate = heartrate[np.asarray(streams['moving'], dtype=bool)]
+        if np.any(heartrate > 0):
+            if max_heartrate:
+                result['heartrate_zones'] = heartrate_zones(heartrate, max_heartrate)
+            result['aerobic_decoupling'] = aerobic_decoupling(watts, heartrate)
+    return result
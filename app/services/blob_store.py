@@ -0,0 +1,134 @@
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from typing import BinaryIO, NamedTuple
+
+from sqlalchemy import func, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import Session, select
+
+from app.core.metrics import metrics
+from app.models.models import Blob, ImportJobFile, UploadedFile
+
+# Исходные файлы по содержимому, сжатые: data/blobs/ab/cd/<sha256>.csv.gz
+BLOBS_DIR = Path('data/blobs')
+STAGING_DIR = BLOBS_DIR / '.staging'
+# Старый плоский архив без сжатия: data/csv/<sha256>.csv, переносится в хранилище при запуске
+LEGACY_DIR = Path('data/csv')
+CHUNK_SIZE = 1024 * 1024  # столько байт загрузки одновременно в памяти
+COMPRESS_LEVEL = 1  # быстрый уровень: на CSV тренировок 6-й сжимает лишь на ~4% лучше, но в 4-5 раз медленнее
+
+
+class StoredBlob(NamedTuple):
+    sha256: str
+    size: int
+    stored_size: int
+
+
+def is_sha256(value: str) -> bool:
+    return re.fullmatch(r'[0-9a-f]{64}', value or '') is not None
+
+
+def blob_path(sha256: str) -> Path:
+    return BLOBS_DIR / sha256[:2] / sha256[2:4] / f'{sha256}.csv.gz'
+
+
+def find(sha256: str) -> Path | None:
+    """Путь для парсера: .gz pandas распаковывает потоком по чанкам, старые файлы читаются как есть"""
+    if not is_sha256(sha256):
+        # Хэш может прийти из базы старой версии, из него строится путь
+        return None
+    path = blob_path(sha256)
+    if path.is_file():
+        return path
+    legacy = LEGACY_DIR / f'{sha256}.csv'
+    return legacy if legacy.is_file() else None
+
+
+def write_stream(source: BinaryIO, chunk_size: int = CHUNK_SIZE) -> StoredBlob:
+    """Копирует поток в хранилище кусками, хэш считается на лету. Имя известно только в конце,
+    поэтому сначала пишется временный файл. Выполняется в пуле потоков."""
+    STAGING_DIR.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    descriptor, temp_name = tempfile.mkstemp(dir=STAGING_DIR, suffix='.gz')
+    try:
+        # Без имени и времени в заголовке gzip одинаковое содержимое дает одинаковый файл
+        with os.fdopen(descriptor, 'wb') as raw, \
+                gzip.GzipFile(filename='', fileobj=raw, mode='wb', compresslevel=COMPRESS_LEVEL, mtime=0) as packed:
+            while chunk := source.read(chunk_size):
+                digest.update(chunk)
+                packed.write(chunk)
+                size += len(chunk)
+        target = blob_path(digest.hexdigest())
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # Замена атомарна: парсер, уже открывший этот блоб, дочитает старую копию
+        os.replace(temp_name, target)
+    except BaseException:
+        Path(temp_name).unlink(missing_ok=True)
+        raise
+    blob = StoredBlob(digest.hexdigest(), size, target.stat().st_size)
+    metrics.increment('blob_bytes_received', blob.size)
+    metrics.increment('blob_bytes_stored', blob.stored_size)
+    return blob
+
+
+def register(session: Session, blob: StoredBlob) -> None:
+    """Запись о блобе без ссылок, если ее еще нет. Ссылку добавляет acquire() вместе с UploadedFile."""
+    session.execute(insert(Blob).values(sha256=blob.sha256, size=blob.size, stored_size=blob.stored_size,
+                                        refcount=0, created_at=datetime.now())
+                    .on_conflict_do_nothing(index_elements=['sha256']))
+
+
+def acquire(session: Session, sha256: str) -> None:
+    session.execute(update(Blob).where(Blob.sha256 == sha256).values(refcount=Blob.refcount + 1))
+
+
+def release(session: Session, sha256: str) -> None:
+    """Файл не удаляется сразу: то же содержимое может ждать разбора в чужой задаче импорта"""
+    session.execute(update(Blob).where(Blob.sha256 == sha256, Blob.refcount > 0)
+                    .values(refcount=Blob.refcount - 1))
+
+
+def collect_garbage(session: Session) -> int:
+    """Удаляет блобы без ссылок при запуске, когда загрузок в процессе нет"""
+    pending = select(ImportJobFile.sha256).where(ImportJobFile.status == 'pending',
+                                                 ImportJobFile.sha256.is_not(None))
+    unused = session.exec(select(Blob).where(Blob.refcount <= 0, Blob.sha256.not_in(pending),
+                                             Blob.sha256.not_in(select(UploadedFile.sha256)))).all()
+    for blob in unused:
+        blob_path(blob.sha256).unlink(missing_ok=True)
+        session.delete(blob)
+    session.commit()
+    # Недописанные загрузки прерванного процесса
+    shutil.rmtree(STAGING_DIR, ignore_errors=True)
+    return len(unused)
+
+
+def backfill(session: Session) -> None:
+    """Переносит файлы старого архива в хранилище. Файлы, на которые никто не ссылается, остаются на месте."""
+    if not LEGACY_DIR.is_dir():
+        return
+    references = dict(session.exec(select(UploadedFile.sha256, func.count(UploadedFile.id))
+                                   .group_by(UploadedFile.sha256)).all())
+    pending = set(session.exec(select(ImportJobFile.sha256).where(ImportJobFile.status == 'pending')).all())
+    for path in sorted(LEGACY_DIR.glob('*.csv')):
+        if path.stem not in references and path.stem not in pending:
+            continue
+        with path.open('rb') as source:
+            blob = write_stream(source)
+        register(session, blob)
+        if blob.sha256 != path.stem:
+            # Копия без ссылок уйдет при следующей сборке мусора
+            session.commit()
+            print(f'Содержимое {path} не совпадает с хэшем в имени, файл оставлен в data/csv')
+            continue
+        session.execute(update(Blob).where(Blob.sha256 == blob.sha256)
+                        .values(refcount=references.get(blob.sha256, 0)))
+        session.commit()
+        path.unlink()
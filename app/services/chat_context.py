@@ -0,0 +1,91 @@
+import asyncio
+from datetime import datetime
+
+from sqlalchemy import func
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.config import COACH_HISTORY_MESSAGES, COACH_SUMMARY_WORDS
+from app.db import async_engine
+from app.models.models import ChatMessage, ChatSummary
+from app.services.llm_limiter import llm_limiter
+
+_tasks: dict[int, asyncio.Task] = {}  # пересчет резюме, не больше одного на пользователя
+
+
+def load_history(session: Session, user_id: int) -> tuple[str | None, list[ChatMessage]]:
+    """Резюме старой части диалога и последние еще не сжатые сообщения. LIMIT выполняет SQLite."""
+    summary = session.exec(select(ChatSummary).where(ChatSummary.user_id == user_id)).first()
+    last_message_id = summary.last_message_id if summary else 0
+    recent = session.exec(select(ChatMessage).where(ChatMessage.user_id == user_id,
+                                                    ChatMessage.id > last_message_id)
+                          .order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc())
+                          .limit(COACH_HISTORY_MESSAGES)).all()
+    return (summary.content if summary else None), list(reversed(recent))
+
+
+def _pending_messages(session: Session, user_id: int) -> tuple[ChatSummary, list[ChatMessage]]:
+    """Сообщения для сжатия: все несжатые, кроме последней половины окна истории, не больше окна за раз"""
+    summary = session.exec(select(ChatSummary).where(ChatSummary.user_id == user_id)).first() \
+        or ChatSummary(user_id=user_id)
+    unsummarized = session.exec(select(func.count(ChatMessage.id)).where(
+        ChatMessage.user_id == user_id, ChatMessage.id > summary.last_message_id)).one()
+    if unsummarized <= COACH_HISTORY_MESSAGES:
+        return summary, []
+    count = min(unsummarized - COACH_HISTORY_MESSAGES // 2, COACH_HISTORY_MESSAGES)
+    messages = session.exec(select(ChatMessage).where(ChatMessage.user_id == user_id,
+                                                      ChatMessage.id > summary.last_message_id)
+                            .order_by(ChatMessage.id).limit(count)).all()
+    return summary, messages
+
+
+async def summarize_history(user_id: int, service) -> None:
+    """Сворачивает старые сообщения в резюме, пока несжатая часть больше окна истории.
+    Сессия не держится открытой во время генерации."""
+    while True:
+        async with AsyncSession(async_engine) as session:
+            summary, messages = await session.run_sync(_pending_messages, user_id)
+            if not messages:
+                return
+            previous = summary.content
+            last_message_id = messages[-1].id
+            text = '\n'.join(f'{message.role}: {message.content}' for message in messages)
+        prompt = service.conversation_summary.format(max_words=COACH_SUMMARY_WORDS, previous_summary=previous or '-',
+                                                     messages=text)
+        ticket = llm_limiter.admit(user_id, rate_limited=False)
+        try:
+            await ticket.wait()
+            content = await service.generate(prompt, timeout=120, tier='fast')
+        finally:
+            ticket.release()
+        async with AsyncSession(async_engine) as session:
+            summary = (await session.exec(select(ChatSummary).where(ChatSummary.user_id == user_id))).first() \
+                or ChatSummary(user_id=user_id)
+            summary.content = content.strip()
+            summary.last_message_id = last_message_id
+            summary.updated_at = datetime.now()
+            session.add(summary)
+            await session.commit()
+
+
+async def _run_summary(user_id: int, service) -> None:
+    try:
+        await summarize_history(user_id, service)
+    except Exception as e:
+        # Без резюме чат продолжает работать с обрезанной историей, попробуем после следующего ответа
+        print(f'Ошибка резюме диалога пользователя {user_id}: {e}')
+    finally:
+        _tasks.pop(user_id, None)
+
+
+def schedule_summary(user_id: int, service) -> None:
+    """Запускает пересчет резюме в фоне после ответа тренера"""
+    if user_id not in _tasks:
+        _tasks[user_id] = asyncio.create_task(_run_summary(user_id, service))
+
+
+async def stop_summaries() -> None:
+    tasks = list(_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
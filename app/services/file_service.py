@@ -1,9 +1,8 @@
-import hashlib
-import datetime
-from pathlib import Path
 from sqlmodel import select, Session
 from app.models.models import UploadedFile
 
+CHECK_BATCH_SIZE = 500  # хэшей в одном IN (...), меньше лимита переменных SQLite
+
 
 class FileValidationError(Exception):
     """Выбрасывается когда тип файла не подходит"""
@@ -24,16 +23,21 @@ def validate_file_type(filename: str, content_type: str) -> None:
         raise FileValidationError('Можно загружать только CSV-файлы!')
 
 
-def save_file_with_hash(content: bytes, session: Session, user_id: int) -> tuple[str, str]:
-    hash_value = hashlib.sha256(content).hexdigest()
-    filename = f"{hash_value}.csv"
-    path = Path('data/csv') / f'{filename}'
-    existing = session.exec(select(UploadedFile).where(UploadedFile.sha256 == hash_value,
-                                                       UploadedFile.user_id == user_id)).first()
+def find_duplicate(hash_value: str, session: Session, user_id: int, exclude_id: int | None = None) -> None:
+    """exclude_id — только что вставленный, еще не закоммиченный файл, который не считается дубликатом"""
+    query = select(UploadedFile.id).where(UploadedFile.sha256 == hash_value, UploadedFile.user_id == user_id)
+    if exclude_id is not None:
+        query = query.where(UploadedFile.id != exclude_id)
+    existing = session.exec(query).first()
     if existing:
         raise FileAlreadyExistsError('Файл с таким содержимым уже существует')
-    try:
-        path.write_bytes(content)
-    except (PermissionError, OSError) as e:
-        raise OSError(f"Не удалось сохранить файл: {e}")
-    return str(path), hash_value
+
+
+def uploaded_hashes(session: Session, user_id: int, hashes: list[str]) -> set[str]:
+    """Хэши из списка, которые пользователь уже загружал. Чужие файлы не учитываются:
+    иначе по хэшу можно узнать о чужом файле или получить его содержимое."""
+    found = set()
+    for start in range(0, len(hashes), CHECK_BATCH_SIZE):
+        found.update(session.exec(select(UploadedFile.sha256).where(
+            UploadedFile.user_id == user_id, UploadedFile.sha256.in_(hashes[start:start + CHECK_BATCH_SIZE]))).all())
+    return found
@@ -0,0 +1,109 @@
+import math
+from datetime import date, timedelta
+
+from sqlalchemy import delete, insert
+from sqlmodel import Session, select
+
+from app.models.models import FitnessDay, WorkoutRollup
+
+CTL_DAYS = 42  # постоянная времени хронической нагрузки (форма)
+ATL_DAYS = 7  # постоянная времени острой нагрузки (усталость)
+_CTL_DECAY = math.exp(-1 / CTL_DAYS)
+_ATL_DECAY = math.exp(-1 / ATL_DAYS)
+
+
+def _step(ctl: float, atl: float, tss: float) -> tuple[float, float, float]:
+    """Один день экспоненциально взвешенной модели. TSB дня — разница формы и усталости на его начало."""
+    tsb = ctl - atl
+    ctl = ctl * _CTL_DECAY + tss * (1 - _CTL_DECAY)
+    atl = atl * _ATL_DECAY + tss * (1 - _ATL_DECAY)
+    return ctl, atl, tsb
+
+
+def _decay(row: FitnessDay, day: date) -> dict:
+    """Значения на day, если после row тренировок не было: нагрузка только затухает, без цикла по дням"""
+    gap = (day - row.day).days
+    ctl = row.ctl * _CTL_DECAY ** gap
+    atl = row.atl * _ATL_DECAY ** gap
+    # TSB дня считается от значений на конец предыдущего дня
+    previous_ctl = row.ctl * _CTL_DECAY ** (gap - 1)
+    previous_atl = row.atl * _ATL_DECAY ** (gap - 1)
+    return {'day': day, 'tss': 0.0, 'ctl': ctl, 'atl': atl, 'tsb': previous_ctl - previous_atl}
+
+
+def recompute_from(session: Session, user_id: int, start: date, end: date | None = None) -> int:
+    """Пересчитывает ряд с даты изменения до сегодня. Дни до start не трогаются: стартовое состояние
+    берется из последней сохраненной строки, поэтому задним числом пересчитывается только хвост истории."""
+    end = max(end or date.today(), start)
+    previous = session.exec(select(FitnessDay).where(FitnessDay.user_id == user_id, FitnessDay.day < start)
+                            .order_by(FitnessDay.day.desc()).limit(1)).first()
+    ctl = atl = 0.0
+    if previous is not None:
+        state = _decay(previous, start - timedelta(days=1)) if previous.day < start - timedelta(days=1) \
+            else {'ctl': previous.ctl, 'atl': previous.atl}
+        ctl, atl = state['ctl'], state['atl']
+
+    daily_tss = dict(session.exec(select(WorkoutRollup.period_start, WorkoutRollup.training_stress_score).where(
+        WorkoutRollup.user_id == user_id, WorkoutRollup.period == 'day', WorkoutRollup.period_start >= start,
+        WorkoutRollup.period_start <= end)).all())
+
+    rows = []
+    day = start
+    while day <= end:
+        tss = float(daily_tss.get(day) or 0)
+        ctl, atl, tsb = _step(ctl, atl, tss)
+        rows.append({'user_id': user_id, 'day': day, 'tss': tss, 'ctl': ctl, 'atl': atl, 'tsb': tsb})
+        day += timedelta(days=1)
+
+    session.execute(delete(FitnessDay).where(FitnessDay.user_id == user_id, FitnessDay.day >= start))
+    session.execute(insert(FitnessDay), rows)
+    return len(rows)
+
+
+def rebuild_user(session: Session, user_id: int) -> None:
+    first_day = session.exec(select(WorkoutRollup.period_start).where(
+        WorkoutRollup.user_id == user_id, WorkoutRollup.period == 'day').order_by(WorkoutRollup.period_start)
+                             .limit(1)).first()
+    if first_day is None:
+        session.execute(delete(FitnessDay).where(FitnessDay.user_id == user_id))
+    else:
+        recompute_from(session, user_id, first_day)
+
+
+def backfill(session: Session) -> None:
+    """Строит ряды для существующих пользователей при первом запуске, роллапы должны быть уже заполнены"""
+    if session.exec(select(FitnessDay.id).limit(1)).first() is not None:
+        return
+    user_ids = session.exec(select(WorkoutRollup.user_id).distinct()).all()
+    for user_id in user_ids:
+        rebuild_user(session, user_id)
+    session.commit()
+
+
+def series(session: Session, user_id: int, since: date, until: date | None = None) -> list[dict]:
+    """Ряд по дням за период. Дни после последнего пересчета достраиваются затуханием без записи в базу."""
+    until = until or date.today()
+    rows = session.exec(select(FitnessDay).where(FitnessDay.user_id == user_id, FitnessDay.day >= since,
+                                                 FitnessDay.day <= until).order_by(FitnessDay.day)).all()
+    result = [{'day': row.day, 'tss': row.tss, 'ctl': row.ctl, 'atl': row.atl, 'tsb': row.tsb} for row in rows]
+    last = rows[-1] if rows else session.exec(select(FitnessDay).where(
+        FitnessDay.user_id == user_id, FitnessDay.day < since).order_by(FitnessDay.day.desc()).limit(1)).first()
+    if last is None:
+        return result
+    day = max(last.day + timedelta(days=1), since)
+    while day <= until:
+        result.append(_decay(last, day))
+        day += timedelta(days=1)
+    return result
+
+
+def current(session: Session, user_id: int, day: date | None = None) -> dict | None:
+    """Значения на сегодня: последняя строка до day, затухшая до нужной даты"""
+    day = day or date.today()
+    last = session.exec(select(FitnessDay).where(FitnessDay.user_id == user_id, FitnessDay.day <= day)
+                        .order_by(FitnessDay.day.desc()).limit(1)).first()
+    if last is None:
+        return None
+    if last.day == day:
+        return {'day': day, 'tss': last.tss, 'ctl': last.ctl, 'atl': last.atl, 'tsb': last.tsb}
+    return _decay(last, day)
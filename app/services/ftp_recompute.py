@@ -0,0 +1,229 @@
+import asyncio
+from datetime import date, datetime
+
+import numpy as np
+from sqlalchemy import Integer, cast, func, update
+from sqlmodel import Session, select
+
+from app.core.config import RECOMPUTE_BATCH_SIZE
+from app.db import engine
+from app.models.models import FtpHistory, RecomputeJob, UploadedFile, Workout
+from app.services import analytics, fitness, rollups
+from app.services.ingest import run_in_thread
+from app.services.response_cache import response_cache
+from app.services.stream_store import StreamNotFoundError, load_streams
+
+
+def record_ftp(session: Session, user_id: int, ftp: int, effective_from: date) -> date | None:
+    """Записывает FTP в историю и возвращает дату, с которой нужно пересчитать тренировки.
+    None — пересчитать всю историю: запись стала самой ранней и действует и на прошлые тренировки."""
+    entry = session.exec(select(FtpHistory).where(FtpHistory.user_id == user_id,
+                                                  FtpHistory.effective_from == effective_from)).first() \
+        or FtpHistory(user_id=user_id, effective_from=effective_from, ftp=ftp)
+    entry.ftp = ftp
+    session.add(entry)
+    earlier = session.exec(select(FtpHistory.id).where(FtpHistory.user_id == user_id,
+                                                       FtpHistory.effective_from < effective_from).limit(1)).first()
+    return effective_from if earlier is not None else None
+
+
+def ftp_schedule(session: Session, user_id: int) -> tuple[np.ndarray, np.ndarray]:
+    """История FTP в виде двух массивов: даты начала действия по возрастанию и значения"""
+    rows = session.exec(select(FtpHistory.effective_from, FtpHistory.ftp).where(FtpHistory.user_id == user_id)
+                        .order_by(FtpHistory.effective_from)).all()
+    return (np.array([row[0] for row in rows], dtype='datetime64[D]'),
+            np.array([row[1] for row in rows], dtype=np.float64))
+
+
+def ftp_for_days(schedule: tuple[np.ndarray, np.ndarray], days: np.ndarray) -> np.ndarray:
+    """FTP на каждую дату: последняя запись, начавшая действовать не позже дня, до первой записи — первая"""
+    starts, values = schedule
+    index = np.searchsorted(starts, days, side='right') - 1
+    return values[np.clip(index, 0, None)]
+
+
+def ftp_on(session: Session, user_id: int, day: date) -> int | None:
+    entry = session.exec(select(FtpHistory.ftp).where(FtpHistory.user_id == user_id,
+                                                      FtpHistory.effective_from <= day)
+                         .order_by(FtpHistory.effective_from.desc()).limit(1)).first()
+    if entry is None:
+        entry = session.exec(select(FtpHistory.ftp).where(FtpHistory.user_id == user_id)
+                             .order_by(FtpHistory.effective_from).limit(1)).first()
+    return entry
+
+
+def derive_load(normalized_power: np.ndarray, moving_seconds: np.ndarray,
+                ftp: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """IF и TSS по формулам и с округлением как при импорте (parse_cvs._metrics), для всей пачки сразу"""
+    intensity_factor = np.round(normalized_power / ftp, 3)
+    training_stress_score = np.round(moving_seconds * normalized_power * intensity_factor / (ftp * 3600) * 100, 1)
+    return intensity_factor, training_stress_score
+
+
+def _normalized_power_from_streams(workout_id: int) -> float:
+    """NP для старых записей, где его не сохранили: считается по потокам, CSV не перечитывается"""
+    try:
+        streams = load_streams(workout_id, columns=['watts', 'moving'])
+    except StreamNotFoundError:
+        return np.nan
+    watts = streams['watts']
+    if 'moving' in streams:
+        watts = watts[np.asarray(streams['moving'], dtype=bool)]
+    value = analytics.normalized_power(watts)
+    return np.nan if value is None else round(value, 1)
+
+
+def _affected(statement, job: RecomputeJob):
+    statement = statement.select_from(Workout).join(UploadedFile).where(Workout.user_id == job.user_id)
+    if job.since is not None:
+        statement = statement.where(UploadedFile.uploaded_at >= datetime.combine(job.since, datetime.min.time()))
+    return statement
+
+
+def recompute_batch(session: Session, job: RecomputeJob, schedule: tuple[np.ndarray, np.ndarray],
+                    batch_size: int = RECOMPUTE_BATCH_SIZE) -> int:
+    """Пересчитывает следующую пачку тренировок после контрольной точки задачи, возвращает ее размер"""
+    moving_seconds = cast(func.strftime('%s', Workout.moving_time), Integer)
+    rows = session.execute(_affected(select(Workout.id, UploadedFile.uploaded_at, Workout.normalized_power,
+                                            moving_seconds), job)
+                           .where(Workout.id > job.last_workout_id).order_by(Workout.id).limit(batch_size)).all()
+    if not rows:
+        return 0
+
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    days = np.array([row[1].date() for row in rows], dtype='datetime64[D]')
+    normalized_power = np.array([np.nan if row[2] is None else row[2] for row in rows], dtype=np.float64)
+    seconds = np.array([row[3] or 0 for row in rows], dtype=np.float64)
+    for position in np.flatnonzero(np.isnan(normalized_power)):
+        normalized_power[position] = _normalized_power_from_streams(int(ids[position]))
+
+    intensity_factor, training_stress_score = derive_load(normalized_power, seconds, ftp_for_days(schedule, days))
+    known = ~np.isnan(normalized_power)
+    session.execute(update(Workout), [
+        {'id': int(workout_id),
+         'normalized_power': float(np_value) if has_value else None,
+         'intensity_factor': float(if_value) if has_value else None,
+         'training_stress_score': float(tss_value) if has_value else None}
+        for workout_id, np_value, if_value, tss_value, has_value
+        in zip(ids, normalized_power, intensity_factor, training_stress_score, known)])
+
+    job.last_workout_id = int(ids[-1])
+    job.done += len(rows)
+    session.add(job)
+    return len(rows)
+
+
+def job_status(job: RecomputeJob) -> dict:
+    """Прогресс пересчета в формате для GET /recompute/{job_id}"""
+    return {'id': job.id, 'status': job.status, 'since': job.since, 'total': job.total, 'done': job.done}
+
+
+def enqueue_recompute(session: Session, user_id: int, since: date | None) -> RecomputeJob:
+    """Создает задачу пересчета. Еще не начатая задача пользователя расширяется, а не дублируется."""
+    job = session.exec(select(RecomputeJob).where(RecomputeJob.user_id == user_id,
+                                                  RecomputeJob.status == 'queued')).first()
+    if job is None:
+        job = RecomputeJob(user_id=user_id, since=since)
+    elif job.since is not None:
+        job.since = None if since is None else min(job.since, since)
+    session.add(job)
+    return job
+
+
+def change_ftp(session: Session, user_id: int, ftp: int, effective_from: date) -> RecomputeJob:
+    """Новое значение FTP в истории и задача пересчета затронутых тренировок"""
+    since = record_ftp(session, user_id, ftp, effective_from)
+    return enqueue_recompute(session, user_id, since)
+
+
+def _start_job(job_id: int) -> tuple[int, tuple[np.ndarray, np.ndarray]] | None:
+    """Считает затронутые тренировки при первом запуске и возвращает пользователя и историю FTP"""
+    with Session(engine) as session:
+        job = session.get(RecomputeJob, job_id)
+        if job is None or job.status == 'done':
+            return None
+        if job.status == 'queued':
+            job.total = session.exec(_affected(select(func.count(Workout.id)), job)).one()
+            job.status = 'running'
+            session.add(job)
+            session.commit()
+        return job.user_id, ftp_schedule(session, job.user_id)
+
+
+def _recompute_next(job_id: int, schedule: tuple[np.ndarray, np.ndarray]) -> int:
+    """Одна пачка с контрольной точкой в своей транзакции"""
+    with Session(engine) as session:
+        job = session.get(RecomputeJob, job_id)
+        count = recompute_batch(session, job, schedule)
+        session.commit()
+        return count
+
+
+def _finish_job(job_id: int) -> None:
+    with Session(engine) as session:
+        job = session.get(RecomputeJob, job_id)
+        rollups.rebuild_user(session, job.user_id)
+        if job.since is None:
+            fitness.rebuild_user(session, job.user_id)
+        else:
+            fitness.recompute_from(session, job.user_id, job.since)
+        job.status = 'done'
+        job.finished_at = datetime.now()
+        session.add(job)
+        session.commit()
+
+
+async def process_job(job_id: int) -> None:
+    """Пересчитывает IF/TSS пачками, после каждой пачки коммит с контрольной точкой.
+    Роллапы и ряд нагрузки строятся заново один раз в конце. Вся работа с базой идет в пуле потоков."""
+    started = await run_in_thread(_start_job, job_id)
+    if started is None:
+        return
+    user_id, schedule = started
+    while schedule[0].size and await run_in_thread(_recompute_next, job_id, schedule):
+        pass
+    await run_in_thread(_finish_job, job_id)
+    # Сводка для тренера изменилась вместе с TSS
+    response_cache.invalidate_user(user_id)
+
+
+def _unfinished_jobs() -> list[int]:
+    with Session(engine) as session:
+        return list(session.exec(select(RecomputeJob.id).where(RecomputeJob.status != 'done')
+                                 .order_by(RecomputeJob.id)).all())
+
+
+class RecomputeQueue:
+    """Очередь задач пересчета с одним воркером, как у импорта: состояние в SQLite,
+    незавершенные задачи подхватываются после перезапуска."""
+
+    def __init__(self):
+        self._queue: asyncio.Queue[int] = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+
+    def put(self, job_id: int) -> None:
+        self._queue.put_nowait(job_id)
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await process_job(job_id)
+            except Exception as e:
+                print(f'Ошибка пересчета {job_id}: {e}')
+            finally:
+                self._queue.task_done()
+
+    async def start(self) -> None:
+        for job_id in await run_in_thread(_unfinished_jobs):
+            self.put(job_id)
+        self._task = asyncio.create_task(self._worker())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+recompute_queue = RecomputeQueue()
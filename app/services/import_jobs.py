@@ -0,0 +1,256 @@
+import asyncio
+from datetime import date, datetime, UTC
+from pathlib import Path
+
+from fastapi import UploadFile
+from sqlalchemy import update
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.config import IMPORT_JOB_WORKERS
+from app.db import engine, write_and_commit
+from app.models.models import ImportJob, ImportJobFile, UploadedFile, Workout
+from app.services.file_service import (
+    validate_file_type,
+    find_duplicate,
+    uploaded_hashes,
+    FileValidationError,
+    FileAlreadyExistsError
+)
+from app.services.ingest import run_in_thread, run_in_process
+from app.services import blob_store, rollups, fitness
+from app.services.ftp_recompute import ftp_on
+from app.services.response_cache import response_cache
+from app.services.parse_cvs import parse_ride, ParseCsvError
+from app.services.stream_store import stage_streams, publish_streams, discard_staged
+
+
+async def enqueue_import(files: list[UploadFile], session: AsyncSession, user_id: int,
+                         known: list[tuple[str, str]] = ()) -> ImportJob:
+    """Сохраняет загруженные файлы в хранилище и создает задачу импорта. Парсинг идет в фоне.
+    known — (sha256, имя) файлов, которые клиент не отправил, потому что пользователь их уже загружал."""
+    # Сначала весь I/O: пока идут await, транзакция записи в SQLite не должна быть открыта
+    job_files = []
+    blobs = []
+    for position, file in enumerate(files):
+        job_file = ImportJobFile(position=position, original_name=file.filename)
+        try:
+            validate_file_type(filename=file.filename, content_type=file.content_type)
+            # Загрузка целиком в память не читается: хэш и сжатие идут потоком по кускам
+            blob = await run_in_thread(blob_store.write_stream, file.file)
+            job_file.sha256 = blob.sha256
+            job_file.file_path = str(blob_store.blob_path(blob.sha256))
+            blobs.append(blob)
+        except (FileValidationError, OSError) as e:
+            job_file.status = 'err'
+            job_file.error = str(e)
+        job_files.append(job_file)
+
+    # Без содержимого принимаются только файлы, которые пользователь уже загружал: в отчете они дубликаты
+    owned = await session.run_sync(uploaded_hashes, user_id, [sha256 for sha256, _ in known])
+    for sha256, name in known:
+        job_file = ImportJobFile(position=len(job_files), original_name=name, sha256=sha256)
+        if sha256 in owned:
+            job_file.status = 'dup'
+            job_file.error = 'Файл с таким содержимым уже существует'
+        else:
+            job_file.status = 'err'
+            job_file.error = 'Файл не найден среди ваших загрузок, загрузите его заново'
+        job_files.append(job_file)
+
+    job = ImportJob(user_id=user_id, files=job_files)
+    await session.run_sync(write_and_commit, _save_job, job, blobs)
+    import_queue.put(job.id)
+    return job
+
+
+def _save_job(session: Session, job: ImportJob, blobs: list[blob_store.StoredBlob]) -> None:
+    session.add(job)
+    for blob in blobs:
+        blob_store.register(session, blob)
+
+
+def job_status(job: ImportJob) -> dict:
+    """Прогресс задачи по файлам в формате для GET /imports/{job_id}"""
+    files = sorted(job.files, key=lambda f: f.position)
+    counts = {'success': 0, 'dup': 0, 'err': 0, 'pending': 0}
+    for job_file in files:
+        counts[job_file.status] += 1
+    return {'id': job.id, 'status': job.status, 'total': len(files), 'done': len(files) - counts['pending'],
+            'success': counts['success'], 'dup': counts['dup'], 'err': counts['err'],
+            'files': [{'name': f.original_name, 'status': f.status, 'error': f.error} for f in files]}
+
+
+def _claim_files(job_id: int) -> tuple[int, int | None, list[tuple[ImportJobFile, Path]]] | None:
+    """Переводит задачу в работу, отсекает дубликаты (в базе и внутри самой задачи)
+    и возвращает файлы для разбора. Выполняется в пуле потоков, как и остальная работа с базой.
+    Проверка здесь только экономит разбор: файл из параллельной задачи того же пользователя она не видит,
+    окончательно дубликат отсекает _save_workout."""
+    with Session(engine, expire_on_commit=False) as session:
+        job = session.get(ImportJob, job_id)
+        if job is None or job.status == 'done':
+            return None
+        job.status = 'running'
+        session.add(job)
+
+        # Тренировка датируется загрузкой, поэтому FTP берется из истории на сегодня
+        ftp = ftp_on(session, job.user_id, date.today())
+        pending = session.exec(select(ImportJobFile).where(ImportJobFile.job_id == job_id,
+                                                           ImportJobFile.status == 'pending')
+                               .order_by(ImportJobFile.position)).all()
+        files = []
+        seen = set()
+        for job_file in pending:
+            try:
+                if job_file.sha256 in seen:
+                    raise FileAlreadyExistsError('Файл с таким содержимым уже существует')
+                find_duplicate(job_file.sha256, session, job.user_id)
+            except FileAlreadyExistsError as e:
+                job_file.status = 'dup'
+                job_file.error = str(e)
+                session.add(job_file)
+                continue
+            path = blob_store.find(job_file.sha256)
+            if path is None:
+                job_file.status = 'err'
+                job_file.error = 'Исходный файл не найден'
+                session.add(job_file)
+                continue
+            seen.add(job_file.sha256)
+            files.append((job_file, path))
+        session.commit()
+        return job.user_id, ftp, files
+
+
+def _save_workout(job_file: ImportJobFile, user_id: int, metrics: dict, staged: Path) -> bool:
+    """Записывает тренировку и ее итоги одной транзакцией. False — тот же файл пользователя уже сохранил
+    другой воркер, тренировка не записана."""
+    with Session(engine) as session:
+        uploaded_file = UploadedFile(original_name=job_file.original_name, sha256=job_file.sha256,
+                                     uploaded_at=datetime.now(UTC), user_id=user_id)
+        session.add(uploaded_file)
+        # Вставка — первая команда транзакции: SQLite уже держит блокировку записи, поэтому проверка видит
+        # все закоммиченные файлы, а параллельный воркер не вставит такой же, пока мы не закончим
+        session.flush()
+        try:
+            find_duplicate(job_file.sha256, session, user_id, exclude_id=uploaded_file.id)
+        except FileAlreadyExistsError as e:
+            session.rollback()
+            _set_file_status(session, job_file.id, 'dup', str(e))
+            session.commit()
+            discard_staged(staged)
+            return False
+        workout = Workout(source_file_id=uploaded_file.id, user_id=user_id, **metrics)
+        session.add(workout)
+        session.flush()
+        workout_id = workout.id
+        blob_store.acquire(session, uploaded_file.sha256)
+        rollups.add_workout(session, workout, uploaded_file.uploaded_at.date())
+        fitness.recompute_from(session, user_id, uploaded_file.uploaded_at.date())
+        _set_file_status(session, job_file.id, 'success')
+        try:
+            session.commit()
+        except BaseException:
+            # Тренировка не записана, и ее id может достаться следующей: ряды под ним не публикуются
+            discard_staged(staged)
+            raise
+    # Сырые ряды сохраняем сразу, чтобы новые метрики не требовали повторного парсинга CSV.
+    # Тренировка уже записана: без рядов она показывается как старые, без расширенной аналитики
+    try:
+        publish_streams(staged, workout_id)
+    except OSError as e:
+        discard_staged(staged)
+        print(f'Не удалось сохранить ряды тренировки {workout_id}: {e}')
+    return True
+
+
+def _set_file_status(session: Session, file_id: int, status: str, error: str | None = None) -> None:
+    session.execute(update(ImportJobFile).where(ImportJobFile.id == file_id).values(status=status, error=error))
+
+
+def _fail_file(job_file: ImportJobFile, error: str, staged: Path | None) -> None:
+    if staged is not None:
+        discard_staged(staged)
+    with Session(engine) as session:
+        _set_file_status(session, job_file.id, 'err', error)
+        session.commit()
+
+
+def _finish_job(job_id: int) -> None:
+    with Session(engine) as session:
+        session.execute(update(ImportJob).where(ImportJob.id == job_id)
+                        .values(status='done', finished_at=datetime.now()))
+        session.commit()
+
+
+async def process_job(job_id: int) -> None:
+    """Парсит файлы задачи параллельно в пуле процессов и сохраняет результаты в порядке загрузки.
+    Запросы к базе синхронные и идут в пуле потоков: цикл событий не ждет блокировку записи SQLite."""
+    claimed = await run_in_thread(_claim_files, job_id)
+    if claimed is None:
+        return
+    user_id, ftp, files = claimed
+    tasks = [(job_file, asyncio.ensure_future(run_in_process(parse_ride, path, ftp))) for job_file, path in files]
+
+    # Сохраняем по порядку, прогресс виден после каждого файла
+    for job_file, task in tasks:
+        staged = None
+        try:
+            metrics, streams = await task
+            # Ряды пишем до начала транзакции: ожидание I/O с открытой записью блокирует остальных писателей
+            staged = await run_in_thread(stage_streams, f'{job_id}-{job_file.position}', streams)
+            if await run_in_thread(_save_workout, job_file, user_id, metrics, staged):
+                # Новая тренировка меняет сводку для тренера: закэшированные ответы устарели
+                response_cache.invalidate_user(user_id)
+            continue
+        except (ParseCsvError, OSError) as e:
+            error = str(e)
+        except Exception as e:
+            error = 'Неизвестная ошибка'
+            print(f"Неизвестная ошибка при загрузке {job_file.original_name}: {e}")  # Для дебага в консоли
+        await run_in_thread(_fail_file, job_file, error, staged)
+
+    await run_in_thread(_finish_job, job_id)
+
+
+def _unfinished_jobs() -> list[int]:
+    with Session(engine) as session:
+        return list(session.exec(select(ImportJob.id).where(ImportJob.status != 'done').order_by(ImportJob.id)).all())
+
+
+class ImportQueue:
+    """Очередь задач импорта с пулом asyncio-воркеров. Состояние задач хранится в SQLite,
+    поэтому незавершенные задачи подхватываются после перезапуска."""
+
+    def __init__(self, workers: int = IMPORT_JOB_WORKERS):
+        self.workers = workers
+        self._queue: asyncio.Queue[int] = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+
+    def put(self, job_id: int) -> None:
+        self._queue.put_nowait(job_id)
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await process_job(job_id)
+            except Exception as e:
+                print(f'Ошибка задачи импорта {job_id}: {e}')
+            finally:
+                self._queue.task_done()
+
+    async def start(self) -> None:
+        # Возвращаем в очередь задачи, прерванные остановкой приложения
+        for job_id in await run_in_thread(_unfinished_jobs):
+            self.put(job_id)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+import_queue = ImportQueue()
@@ -0,0 +1,48 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from app.core.config import INGEST_PROCESS_WORKERS, INGEST_THREAD_WORKERS
+
+_process_pool: ProcessPoolExecutor | None = None
+_thread_pool: ThreadPoolExecutor | None = None
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Пул процессов для парсинга CSV (pandas держит GIL)"""
+    global _process_pool
+    if _process_pool is None:
+        # spawn: не копируем в воркеры потоки и соединения с БД родительского процесса
+        _process_pool = ProcessPoolExecutor(max_workers=INGEST_PROCESS_WORKERS,
+                                            mp_context=multiprocessing.get_context('spawn'))
+    return _process_pool
+
+
+def get_thread_pool() -> ThreadPoolExecutor:
+    """Пул потоков для хэширования и дискового I/O"""
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=INGEST_THREAD_WORKERS, thread_name_prefix='ingest-io')
+    return _thread_pool
+
+
+def shutdown_executors() -> None:
+    global _process_pool, _thread_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=True, cancel_futures=True)
+        _process_pool = None
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=True, cancel_futures=True)
+        _thread_pool = None
+
+
+async def run_in_thread(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_thread_pool(), partial(func, *args, **kwargs))
+
+
+async def run_in_process(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), partial(func, *args, **kwargs))
+
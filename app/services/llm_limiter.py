@@ -0,0 +1,121 @@
+import asyncio
+import math
+import time
+from collections import deque
+
+from fastapi import HTTPException
+
+from app.core.config import LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT, LLM_USER_RATE_PER_MINUTE
+from app.core.metrics import metrics
+
+RATE_WINDOW = 60  # секунд, окно для лимита запросов пользователя
+
+
+class Ticket:
+    """Место запроса в очереди к модели. Освобождать нужно всегда, в том числе при обрыве соединения."""
+
+    def __init__(self, limiter: 'LLMLimiter', user_id: int):
+        self.limiter = limiter
+        self.user_id = user_id
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.released = False
+        self._changed = asyncio.Event()
+
+    @property
+    def position(self) -> int:
+        """0 — запрос уже выполняется, иначе номер в очереди начиная с 1"""
+        if self.granted:
+            return 0
+        return self.limiter.waiting.index(self) + 1
+
+    def _notify(self) -> None:
+        self._changed.set()
+
+    async def positions(self):
+        """Отдает позицию в очереди при каждом ее изменении, пока не подойдет очередь"""
+        deadline = self.enqueued_at + self.limiter.queue_timeout
+        while not self.granted:
+            yield self.position
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                if not self.granted:
+                    self.release()
+                    metrics.increment('llm_queue_timeouts')
+                    raise HTTPException(status_code=429, detail='ИИ-тренер перегружен, попробуйте позже',
+                                        headers={'Retry-After': '30'})
+
+    async def wait(self) -> None:
+        async for _ in self.positions():
+            pass
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.limiter._release(self)
+
+
+class LLMLimiter:
+    """Допуск запросов к модели: не больше concurrency генераций одновременно, остальные ждут в FIFO-очереди.
+    Переполненная очередь и превышение лимита пользователя сразу получают 429, а не 504 через минуту."""
+
+    def __init__(self, concurrency: int = LLM_MAX_CONCURRENCY, max_queue: int = LLM_MAX_QUEUE,
+                 queue_timeout: int = LLM_QUEUE_TIMEOUT, user_rate: int = LLM_USER_RATE_PER_MINUTE):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.user_rate = user_rate
+        self.active = 0
+        self.waiting: deque[Ticket] = deque()
+        self._requests: dict[int, deque[float]] = {}
+
+    def _check_rate(self, user_id: int) -> None:
+        now = time.monotonic()
+        recent = self._requests.setdefault(user_id, deque())
+        while recent and recent[0] <= now - RATE_WINDOW:
+            recent.popleft()
+        if len(recent) >= self.user_rate:
+            metrics.increment('llm_rejected_rate_limit')
+            retry_after = math.ceil(recent[0] + RATE_WINDOW - now)
+            raise HTTPException(status_code=429, detail=f'Слишком много вопросов, повторите через {retry_after} с',
+                                headers={'Retry-After': str(retry_after)})
+        recent.append(now)
+
+    def admit(self, user_id: int, rate_limited: bool = True) -> Ticket:
+        """Ставит запрос в очередь или отказывает сразу, пока пользователь еще ничего не ждал.
+        Фоновые запросы (rate_limited=False) занимают общую очередь, но не расходуют лимит пользователя."""
+        if len(self.waiting) >= self.max_queue:
+            metrics.increment('llm_rejected_queue_full')
+            raise HTTPException(status_code=429, detail='ИИ-тренер перегружен, попробуйте позже',
+                                headers={'Retry-After': '30'})
+        if rate_limited:
+            self._check_rate(user_id)
+        ticket = Ticket(self, user_id)
+        self.waiting.append(ticket)
+        self._dispatch()
+        return ticket
+
+    def _dispatch(self) -> None:
+        while self.waiting and self.active < self.concurrency:
+            ticket = self.waiting.popleft()
+            ticket.granted = True
+            self.active += 1
+            metrics.observe('llm_queue_wait_seconds', time.monotonic() - ticket.enqueued_at)
+            ticket._notify()
+        # Оставшимся сообщаем, что очередь сдвинулась
+        for ticket in self.waiting:
+            ticket._notify()
+        metrics.set_gauge('llm_queue_depth', len(self.waiting))
+        metrics.set_gauge('llm_active', self.active)
+
+    def _release(self, ticket: Ticket) -> None:
+        if ticket.granted:
+            self.active -= 1
+        elif ticket in self.waiting:
+            self.waiting.remove(ticket)
+        self._dispatch()
+
+
+llm_limiter = LLMLimiter()
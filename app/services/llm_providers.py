@@ -0,0 +1,382 @@
+import asyncio
+import json
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import AsyncIterator, List
+
+import httpx
+from fastapi import HTTPException
+
+from app.core.config import LLM_PROVIDERS, LLM_ROUTING, LLM_FAILOVER_COOLDOWN, OLLAMA_EMBED_MODEL, \
+    OLLAMA_MAX_CONNECTIONS, OLLAMA_KEEPALIVE_CONNECTIONS, OLLAMA_KEEP_ALIVE, COACH_CONTEXT_TOKENS
+from app.core.metrics import metrics
+
+TIERS = ('fast', 'large')
+# Признаки запроса на план: такие вопросы отправляем большой модели
+PLAN_WORDS = ('план', 'недел', 'програм', 'расписан', 'plan', 'week', 'schedule')
+FAST_QUESTION_CHARS = 200
+LATENCY_SMOOTHING = 0.3  # вес нового замера в скользящем среднем задержки
+
+
+class LLMConfigError(Exception):
+    """Ошибка в настройке провайдеров модели"""
+    pass
+
+
+def _smooth(previous: float | None, seconds: float) -> float:
+    return seconds if previous is None else LATENCY_SMOOTHING * seconds + (1 - LATENCY_SMOOTHING) * previous
+
+
+def choose_tier(question: str) -> str:
+    """Короткие вопросы — быстрой модели, планы тренировок и длинные вопросы — большой"""
+    text = question.lower()
+    if len(text) > FAST_QUESTION_CHARS or any(word in text for word in PLAN_WORDS):
+        return 'large'
+    return 'fast'
+
+
+class LLMProvider(ABC):
+    """Один бэкенд модели. Ошибки переводятся в HTTPException 503/504/500, как и раньше в OllamaService.
+    Задержки две: полного ответа (chat, generate) и до первого токена (chat_stream), сравнивать их нельзя."""
+    kind = ''
+
+    def __init__(self, name: str | None = None, model: str = '', tier: str | None = None, timeout: int = 60):
+        self.name = name or f'{self.kind}:{model}'
+        self.model = model
+        self.tier = tier
+        self.timeout = timeout
+        self.latency: float | None = None
+        self.first_token_latency: float | None = None
+        self.failed_until = 0.0
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.failed_until
+
+    def record_success(self, seconds: float) -> None:
+        self.latency = _smooth(self.latency, seconds)
+        metrics.observe(f'llm_provider_{self.name}_seconds', seconds)
+
+    def record_first_token(self, seconds: float) -> None:
+        self.first_token_latency = _smooth(self.first_token_latency, seconds)
+        metrics.observe(f'llm_provider_{self.name}_first_token_seconds', seconds)
+
+    def record_failure(self) -> None:
+        self.failed_until = time.monotonic() + LLM_FAILOVER_COOLDOWN
+        metrics.increment(f'llm_provider_{self.name}_failures')
+
+    @abstractmethod
+    async def chat(self, messages: List[dict], timeout: int | None = None) -> str:
+        ...
+
+    @abstractmethod
+    def chat_stream(self, messages: List[dict], timeout: int | None = None) -> AsyncIterator[str]:
+        ...
+
+    async def generate(self, prompt: str, timeout: int | None = None) -> str:
+        return await self.chat([{'role': 'user', 'content': prompt}], timeout)
+
+    async def embed(self, text: str) -> list[float] | None:
+        return None
+
+    async def warm_up(self) -> None:
+        pass
+
+    async def aclose(self) -> None:
+        pass
+
+
+class HttpProvider(LLMProvider):
+    """Провайдер поверх HTTP: один пул соединений с keep-alive на провайдера"""
+
+    def __init__(self, url: str, client: httpx.AsyncClient | None = None, **kwargs):
+        super().__init__(**kwargs)
+        self.url = url
+        self.client = client or httpx.AsyncClient(
+            base_url=url, timeout=self.timeout,
+            limits=httpx.Limits(max_connections=OLLAMA_MAX_CONNECTIONS,
+                                max_keepalive_connections=OLLAMA_KEEPALIVE_CONNECTIONS))
+
+    async def _post(self, path: str, payload: dict, timeout: int | None) -> dict:
+        try:
+            response = await self.client.post(path, json=payload, timeout=timeout or self.timeout)
+            response.raise_for_status()
+            return response.json()
+        except httpx.ConnectError:
+            raise HTTPException(503, detail='Сервис ИИ не доступен')
+        except httpx.TimeoutException:
+            raise HTTPException(504, detail='Превышено время ожидания')
+        except Exception as e:
+            print(f'Ошибка {self.name}: {e}')
+            raise HTTPException(500, detail='Внутренняя ошибка ИИ')
+
+    async def _stream_lines(self, path: str, payload: dict, timeout: int | None) -> AsyncIterator[str]:
+        """Строки потокового ответа. Таймаут действует на ожидание каждой следующей порции, а не на весь ответ."""
+        try:
+            async with self.client.stream('POST', path, json=payload, timeout=timeout or self.timeout) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if line:
+                        yield line
+        except httpx.ConnectError:
+            raise HTTPException(503, detail='Сервис ИИ не доступен')
+        except httpx.TimeoutException:
+            raise HTTPException(504, detail='Превышено время ожидания')
+        except HTTPException:
+            raise
+        except Exception as e:
+            print(f'Ошибка {self.name}: {e}')
+            raise HTTPException(500, detail='Внутренняя ошибка ИИ')
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+class OllamaProvider(HttpProvider):
+    """Нативный API Ollama: /api/chat, /api/generate, /api/embed"""
+    kind = 'ollama'
+
+    def __init__(self, embed_model: str = OLLAMA_EMBED_MODEL, keep_alive: str = OLLAMA_KEEP_ALIVE, **kwargs):
+        super().__init__(**kwargs)
+        self.embed_model = embed_model
+        self.keep_alive = keep_alive
+
+    def _payload(self, **fields) -> dict:
+        # num_ctx одинаковый во всех запросах: другое значение заставит Ollama перезагрузить модель
+        return {'model': self.model, 'keep_alive': self.keep_alive, 'options': {'num_ctx': COACH_CONTEXT_TOKENS},
+                **fields}
+
+    async def chat(self, messages: List[dict], timeout: int | None = None) -> str:
+        data = await self._post('/api/chat', self._payload(messages=messages, stream=False), timeout)
+        return data.get('message', {}).get('content', '')
+
+    async def chat_stream(self, messages: List[dict], timeout: int | None = None) -> AsyncIterator[str]:
+        async for line in self._stream_lines('/api/chat', self._payload(messages=messages, stream=True), timeout):
+            data = json.loads(line)
+            if data.get('error'):
+                print(f'Ошибка {self.name}: {data["error"]}')
+                raise HTTPException(500, detail='Внутренняя ошибка ИИ')
+            content = data.get('message', {}).get('content', '')
+            if content:
+                yield content
+            if data.get('done'):
+                break
+
+    async def generate(self, prompt: str, timeout: int | None = None) -> str:
+        data = await self._post('/api/generate', self._payload(prompt=prompt, stream=False), timeout)
+        return data.get('response', '')
+
+    async def embed(self, text: str) -> list[float] | None:
+        data = await self._post('/api/embed', {'model': self.embed_model, 'input': text}, 10)
+        return (data.get('embeddings') or [None])[0]
+
+    async def warm_up(self) -> None:
+        # Запрос без промпта только загружает модель и продлевает keep_alive
+        await self._post('/api/generate', self._payload(), 300)
+
+
+class OpenAICompatibleProvider(HttpProvider):
+    """/v1/chat/completions: vLLM, llama.cpp server, LM Studio и другие локальные серверы"""
+    kind = 'openai'
+
+    def __init__(self, api_key: str | None = None, embed_model: str | None = None, **kwargs):
+        super().__init__(**kwargs)
+        self.embed_model = embed_model
+        if api_key:
+            self.client.headers['Authorization'] = f'Bearer {api_key}'
+
+    async def chat(self, messages: List[dict], timeout: int | None = None) -> str:
+        data = await self._post('/v1/chat/completions', {'model': self.model, 'messages': messages}, timeout)
+        choices = data.get('choices') or [{}]
+        return choices[0].get('message', {}).get('content') or ''
+
+    async def chat_stream(self, messages: List[dict], timeout: int | None = None) -> AsyncIterator[str]:
+        payload = {'model': self.model, 'messages': messages, 'stream': True}
+        async for line in self._stream_lines('/v1/chat/completions', payload, timeout):
+            if not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                break
+            choices = json.loads(data).get('choices') or [{}]
+            content = choices[0].get('delta', {}).get('content')
+            if content:
+                yield content
+
+    async def embed(self, text: str) -> list[float] | None:
+        if not self.embed_model:
+            return None
+        data = await self._post('/v1/embeddings', {'model': self.embed_model, 'input': text}, 10)
+        return (data.get('data') or [{}])[0].get('embedding')
+
+
+class LlamaCppProvider(LLMProvider):
+    """Модель GGUF прямо в процессе через llama-cpp-python. Экземпляр Llama не потокобезопасен,
+    поэтому вызовы идут в свой пул из одного потока и по одному, под блокировкой."""
+    kind = 'llama_cpp'
+
+    def __init__(self, model_path: str, n_ctx: int = COACH_CONTEXT_TOKENS, **kwargs):
+        try:
+            from llama_cpp import Llama
+        except ImportError as e:
+            raise LLMConfigError('Для провайдера llama_cpp установите пакет llama-cpp-python') from e
+        kwargs.setdefault('model', model_path.rsplit('/', 1)[-1])
+        super().__init__(**kwargs)
+        self.llama = Llama(model_path=model_path, n_ctx=n_ctx, verbose=False)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='llama-cpp')
+        self._lock = asyncio.Lock()
+
+    def _submit(self, func, *args, **kwargs) -> asyncio.Future:
+        return asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    def _release_after(self, future: asyncio.Future) -> None:
+        """Блокировка снимается, когда поток закончит работу с моделью, даже если по таймауту ответ уже не ждут"""
+        def release(done: asyncio.Future) -> None:
+            if not done.cancelled():
+                done.exception()  # ошибка брошенного вызова никому не нужна, но должна быть прочитана
+            self._lock.release()
+
+        future.add_done_callback(release)
+
+    async def chat(self, messages: List[dict], timeout: int | None = None) -> str:
+        await self._lock.acquire()
+        future = self._submit(self.llama.create_chat_completion, messages=messages)
+        self._release_after(future)
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(504, detail='Превышено время ожидания')
+        return result['choices'][0]['message'].get('content') or ''
+
+    async def chat_stream(self, messages: List[dict], timeout: int | None = None) -> AsyncIterator[str]:
+        await self._lock.acquire()
+        step = self._submit(self.llama.create_chat_completion, messages=messages, stream=True)
+        chunks = None
+        try:
+            chunks = await asyncio.shield(step)
+            while True:
+                step = self._submit(next, chunks, None)
+                try:
+                    chunk = await asyncio.wait_for(asyncio.shield(step), timeout or self.timeout)
+                except asyncio.TimeoutError:
+                    raise HTTPException(504, detail='Превышено время ожидания')
+                if chunk is None:
+                    break
+                content = chunk['choices'][0].get('delta', {}).get('content')
+                if content:
+                    yield content
+        finally:
+            # Недочитанную генерацию закрываем в том же потоке после текущего шага, затем снимаем блокировку
+            if chunks is not None:
+                step = self._submit(chunks.close)
+            self._release_after(step)
+
+    async def aclose(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+PROVIDER_TYPES = {'ollama': OllamaProvider, 'openai': OpenAICompatibleProvider, 'llama_cpp': LlamaCppProvider}
+
+
+def build_provider(config: dict) -> LLMProvider:
+    config = dict(config)
+    kind = config.pop('type', 'ollama')
+    if kind not in PROVIDER_TYPES:
+        raise LLMConfigError(f'Неизвестный тип провайдера модели: {kind}')
+    return PROVIDER_TYPES[kind](**config)
+
+
+class LLMRouter:
+    """Выбирает провайдера для запроса: сначала нужного уровня (fast / large), затем остальные.
+    Упавший провайдер уходит в конец списка на LLM_FAILOVER_COOLDOWN секунд, запрос повторяется на следующем.
+    При routing='latency' среди доступных первым идет тот, у кого меньше скользящая задержка того же вида запроса."""
+
+    def __init__(self, providers: list[LLMProvider], routing: str = LLM_ROUTING):
+        if not providers:
+            raise LLMConfigError('Не настроен ни один провайдер модели')
+        self.providers = providers
+        self.routing = routing
+
+    def candidates(self, tier: str | None = None, stream: bool = False) -> list[LLMProvider]:
+        """Потоковые запросы сравнивают провайдеров по времени до первого токена, остальные — полного ответа"""
+        def rank(item):
+            position, provider = item
+            latency = provider.first_token_latency if stream else provider.latency
+            if self.routing != 'latency' or latency is None:
+                latency = 0
+            return (not provider.available, tier is not None and provider.tier not in (tier, None), latency, position)
+
+        return [provider for _, provider in sorted(enumerate(self.providers), key=rank)]
+
+    async def _call(self, method: str, tier: str | None, *args, **kwargs):
+        error = None
+        for provider in self.candidates(tier):
+            started = time.perf_counter()
+            try:
+                result = await getattr(provider, method)(*args, **kwargs)
+            except HTTPException as e:
+                provider.record_failure()
+                metrics.increment('llm_failovers')
+                error = e
+                continue
+            provider.record_success(time.perf_counter() - started)
+            return result
+        raise error
+
+    async def chat(self, messages: List[dict], tier: str | None = None, timeout: int | None = None) -> str:
+        return await self._call('chat', tier, messages, timeout)
+
+    async def generate(self, prompt: str, tier: str | None = None, timeout: int | None = None) -> str:
+        return await self._call('generate', tier, prompt, timeout)
+
+    async def chat_stream(self, messages: List[dict], tier: str | None = None,
+                          timeout: int | None = None) -> AsyncIterator[str]:
+        """Переключение на другой провайдер возможно только до первого токена: начатый ответ не склеить"""
+        error = None
+        for provider in self.candidates(tier, stream=True):
+            started = time.perf_counter()
+            first = True
+            try:
+                async for token in provider.chat_stream(messages, timeout):
+                    if first:
+                        provider.record_first_token(time.perf_counter() - started)
+                        first = False
+                    yield token
+            except HTTPException as e:
+                provider.record_failure()
+                if not first:
+                    raise
+                metrics.increment('llm_failovers')
+                error = e
+                continue
+            return
+        raise error
+
+    async def embed(self, text: str) -> list[float] | None:
+        """Эмбеддинг нужен только кэшу, поэтому ошибки не пробрасываются"""
+        for provider in self.candidates():
+            try:
+                embedding = await provider.embed(text)
+            except HTTPException as e:
+                print(f'Ошибка эмбеддинга {provider.name}: {e.detail}')
+                continue
+            if embedding is not None:
+                return embedding
+        return None
+
+    async def warm_up(self) -> None:
+        for provider in self.providers:
+            try:
+                await provider.warm_up()
+            except HTTPException as e:
+                print(f'Не удалось прогреть модель {provider.name}: {e.detail}')
+
+    async def aclose(self) -> None:
+        for provider in self.providers:
+            await provider.aclose()
+
+
+def build_router(configs: list[dict] = LLM_PROVIDERS) -> LLMRouter:
+    return LLMRouter([build_provider(config) for config in configs])
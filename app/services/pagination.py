@@ -0,0 +1,23 @@
+import base64
+import json
+from datetime import datetime
+
+
+class CursorError(Exception):
+    """Курсор страницы поврежден или подделан"""
+    pass
+
+
+def encode_cursor(uploaded_at: datetime, workout_id: int) -> str:
+    """Непрозрачный токен позиции в списке: (uploaded_at, id) граничной тренировки"""
+    raw = json.dumps([uploaded_at.isoformat(), workout_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token: str) -> tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        uploaded_at, workout_id = json.loads(raw)
+        return datetime.fromisoformat(uploaded_at), int(workout_id)
+    except (ValueError, TypeError) as e:
+        raise CursorError(f'Некорректный курсор: {e}')
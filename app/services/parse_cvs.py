@@ -1,9 +1,21 @@
 from pathlib import Path
-from sqlmodel import Session, select
+import numpy as np
 import pandas as pd
 from datetime import timedelta
 
-from app.models.models import UserProfile, Workout, AthleteProfile
+# Колонки, которые реально нужны для расчета метрик, и их компактные типы
+CSV_COLUMNS = {
+    'time': 'float32',
+    'watts': 'float32',
+    'velocity_smooth': 'float32',
+    'distance': 'float32',
+    'heartrate': 'float32',
+    'cadence': 'float32',
+    'moving': 'boolean',
+}
+REQUIRED_COLUMNS = ('time', 'watts', 'velocity_smooth', 'distance')
+CHUNK_SIZE = 20_000  # строк в одном чанке, ~5.5 часов записи при 1 Гц
+NP_WINDOW = 30  # окно скользящего среднего для NP, секунд
 
 
 class ParseCsvError(Exception):
@@ -24,53 +36,188 @@ def get_metric_or_none(df, column: str, aggregation='mean'):
     return None
 
 
-def parse_csv_to_workout(file_path: Path, user_id: int, uf_id: int, session: Session) -> None:
-    df = pd.read_csv(file_path)
+class _RunningMean:
+    """Среднее по потоку значений, пропуски (NaN) не учитываются"""
 
-    # Маска движения
-    if 'moving' in df.columns:
-        moving_mask = df['moving'] == True
-    else:
-        moving_mask = df['velocity_smooth'] > 1
+    def __init__(self):
+        self.total = 0.0
+        self.count = 0
 
+    def add(self, values: np.ndarray) -> None:
+        values = values[~np.isnan(values)]
+        self.total += float(values.sum(dtype=np.float64))
+        self.count += values.size
+
+    @property
+    def value(self):
+        return self.total / self.count if self.count else None
+
+
+class RideAggregator:
+    """Считает метрики заезда по чанкам за один проход с ограниченной памятью.
+
+    Скользящее окно NP переносится между чанками: от предыдущего чанка хранятся
+    только последние NP_WINDOW - 1 значений мощности в движении.
+    """
+
+    def __init__(self, has_moving: bool, window: int = NP_WINDOW, keep_streams: bool = False):
+        self.has_moving = has_moving
+        self.window = window
+        # Посекундные ряды в компактных типах для хранилища потоков, колонка -> список кусков
+        self.streams: dict[str, list[np.ndarray]] | None = {} if keep_streams else None
+        self.max_time = None
+        self.max_distance = None
+        self.max_heartrate = None
+        self.moving_count = 0
+        self.watts = _RunningMean()
+        self.speed = _RunningMean()
+        self.speed_without_stop = _RunningMean()
+        self.cadence = _RunningMean()
+        self.heartrate = _RunningMean()
+        self.p30_pow4 = _RunningMean()
+        self._tail = np.empty(0, dtype=np.float64)
+
+    @staticmethod
+    def _max(current, values: np.ndarray):
+        if values.size == 0 or np.isnan(values).all():
+            return current
+        chunk_max = float(np.nanmax(values))
+        return chunk_max if current is None else max(current, chunk_max)
+
+    def _keep(self, chunk: pd.DataFrame, moving: np.ndarray) -> None:
+        for column in chunk.columns:
+            if column != 'moving':
+                values = chunk[column].to_numpy(dtype=np.float32, na_value=np.nan)
+                self.streams.setdefault(column, []).append(values)
+        # Храним уже вычисленную маску движения, чтобы метрики по потокам совпадали с импортом
+        self.streams.setdefault('moving', []).append(moving)
+
+    def collect_streams(self) -> dict[str, np.ndarray]:
+        return {column: np.concatenate(parts) for column, parts in (self.streams or {}).items()}
+
+    def update(self, chunk: pd.DataFrame) -> None:
+        velocity = chunk['velocity_smooth'].to_numpy(dtype=np.float32, na_value=np.nan)
+        # Маска движения
+        if self.has_moving:
+            moving = chunk['moving'].fillna(False).to_numpy(dtype=bool)
+        else:
+            moving = velocity > 1
+
+        self.moving_count += int(moving.sum())
+        if self.streams is not None:
+            self._keep(chunk, moving)
+        self.max_time = self._max(self.max_time, chunk['time'].to_numpy(dtype=np.float32, na_value=np.nan))
+        self.max_distance = self._max(self.max_distance,
+                                      chunk['distance'].to_numpy(dtype=np.float32, na_value=np.nan))
+        self.speed.add(velocity)
+        self.speed_without_stop.add(velocity[velocity > 2])
+
+        if 'cadence' in chunk.columns:
+            self.cadence.add(chunk['cadence'].to_numpy(dtype=np.float32, na_value=np.nan))
+        if 'heartrate' in chunk.columns:
+            heartrate = chunk['heartrate'].to_numpy(dtype=np.float32, na_value=np.nan)
+            self.heartrate.add(heartrate)
+            self.max_heartrate = self._max(self.max_heartrate, heartrate)
+
+        # Мощность в движении: среднее и 30-секундное окно для NP с учетом хвоста прошлого чанка
+        moving_watts = chunk['watts'].to_numpy(dtype=np.float64, na_value=np.nan)[moving]
+        self.watts.add(moving_watts)
+        series = np.concatenate([self._tail, moving_watts])
+        p_30 = pd.Series(series).rolling(self.window).mean().to_numpy()[self._tail.size:]
+        self.p30_pow4.add(p_30 ** 4)
+        self._tail = series[-(self.window - 1):] if self.window > 1 else series[:0]
+
+
+def iter_csv_chunks(file_path: Path, chunk_size: int = CHUNK_SIZE):
+    """Читает из CSV только нужные колонки чанками фиксированного размера"""
+    try:
+        header = pd.read_csv(file_path, nrows=0).columns
+    except (pd.errors.EmptyDataError, pd.errors.ParserError, UnicodeDecodeError) as e:
+        raise ParseCsvError(f'Не удалось прочитать CSV: {e}')
+    missing = [column for column in REQUIRED_COLUMNS if column not in header]
+    if missing:
+        raise ParseCsvError(f'В файле нет обязательных колонок: {", ".join(missing)}')
+
+    usecols = [column for column in CSV_COLUMNS if column in header]
+    dtype = {column: CSV_COLUMNS[column] for column in usecols}
+    try:
+        with pd.read_csv(file_path, usecols=usecols, dtype=dtype, chunksize=chunk_size) as reader:
+            for chunk in reader:
+                yield chunk
+    except (pd.errors.ParserError, ValueError, TypeError) as e:
+        raise ParseCsvError(f'Некорректные данные в CSV: {e}')
+
+
+def _aggregate(file_path: Path, chunk_size: int, keep_streams: bool = False) -> RideAggregator:
+    aggregator = None
+    for chunk in iter_csv_chunks(file_path, chunk_size):
+        if aggregator is None:
+            aggregator = RideAggregator(has_moving='moving' in chunk.columns, keep_streams=keep_streams)
+        aggregator.update(chunk)
+
+    if aggregator is None or aggregator.watts.value is None:
+        raise ParseCsvError('В файле нет данных о мощности в движении')
+    if aggregator.max_time is None or aggregator.max_distance is None:
+        raise ParseCsvError('В файле нет данных о времени или дистанции')
+    return aggregator
+
+
+def compute_ride_metrics(file_path: Path, ftp: int | None, chunk_size: int = CHUNK_SIZE) -> dict:
+    """Считает все метрики заезда за один потоковый проход по файлу.
+    Args:
+        file_path: Путь к CSV
+        ftp: FTP атлета или None
+    Returns:
+        Словарь с полями для модели Workout
+    """
+    return _metrics(_aggregate(file_path, chunk_size), ftp)
+
+
+def parse_ride(file_path: Path, ftp: int | None, chunk_size: int = CHUNK_SIZE) -> tuple[dict, dict[str, np.ndarray]]:
+    """То же, что compute_ride_metrics, но дополнительно возвращает посекундные ряды для хранилища потоков"""
+    aggregator = _aggregate(file_path, chunk_size, keep_streams=True)
+    return _metrics(aggregator, ftp), aggregator.collect_streams()
+
+
+def _metrics(aggregator: RideAggregator, ftp: int | None) -> dict:
     # Базовые показатели
-    p_30 = df.loc[moving_mask, 'watts'].rolling(30).mean()
-    ftp = session.exec(select(AthleteProfile.current_ftp).where((AthleteProfile.id == user_id))).first()
-    duration = timedelta(seconds=df['time'].max())
-    moving_time = timedelta(seconds=int(moving_mask.sum()))
-    distance_km = round(df['distance'].max() / 1000, 2)
-    avg_cadence = get_metric_or_none(df, 'cadence', 'mean')
+    moving_seconds = aggregator.moving_count
+    duration = timedelta(seconds=aggregator.max_time)
+    moving_time = timedelta(seconds=moving_seconds)
+    distance_km = round(aggregator.max_distance / 1000, 2)
+    avg_cadence = aggregator.cadence.value
     if avg_cadence is not None:
         avg_cadence = int(avg_cadence)
-    avg_heartrate = get_metric_or_none(df, 'heartrate', 'mean')
+    avg_heartrate = aggregator.heartrate.value
     if avg_heartrate is not None:
         avg_heartrate = int(avg_heartrate)
-    max_heartrate = get_metric_or_none(df, 'heartrate', 'max')
+    max_heartrate = aggregator.max_heartrate
     if max_heartrate is not None:
         max_heartrate = int(max_heartrate)
 
-    avg_speed = float(round(df['velocity_smooth'].mean() * 3.6, 1))
-    avg_speed_without_stop = float(round(df.loc[df['velocity_smooth'] > 2, 'velocity_smooth'].mean() * 3.6, 1))
+    avg_speed = float(round(aggregator.speed.value * 3.6, 1)) if aggregator.speed.value is not None else None
+    avg_speed_without_stop = aggregator.speed_without_stop.value
+    if avg_speed_without_stop is not None:
+        avg_speed_without_stop = float(round(avg_speed_without_stop * 3.6, 1))
 
     # Метрики
-    avg_watts = int(df.loc[moving_mask, 'watts'].mean())
-    if ftp:
-        normalized_power = round(((p_30 ** 4).mean()) ** 0.25, 1)
-        intensity_factor = round(normalized_power / ftp, 3)
-        training_stress_score = round(((moving_mask.sum() * normalized_power * intensity_factor) / (ftp * 3600)) * 100, 1)
-    else:
-        normalized_power = 'нет данных'
-        intensity_factor = 'нет данных'
-        training_stress_score = 'нет данных'
+    avg_watts = int(aggregator.watts.value)
+    # NP от FTP не зависит и сохраняется всегда: IF/TSS потом пересчитываются из него при смене FTP
+    normalized_power = None
+    intensity_factor = None
+    training_stress_score = None
+    if aggregator.p30_pow4.value is not None:
+        normalized_power = round(aggregator.p30_pow4.value ** 0.25, 1)
+        if ftp:
+            intensity_factor = round(normalized_power / ftp, 3)
+            training_stress_score = round(moving_seconds * normalized_power * intensity_factor / (ftp * 3600) * 100, 1)
 
     # Калории
-    calories_burned = int(avg_watts * (moving_mask.sum() / 3600) * 3.6)
-
-    # Запись в базу данных
-    workout = Workout(source_file_id=uf_id, duration=duration, moving_time=moving_time, distance_km=distance_km,
-                      avg_watts=avg_watts, normalized_power=normalized_power, intensity_factor=intensity_factor,
-                      training_stress_score=training_stress_score, avg_cadence=avg_cadence, avg_speed=avg_speed,
-                      avg_speed_without_stop=avg_speed_without_stop, avg_heartrate=avg_heartrate,
-                      max_heartrate=max_heartrate, calories_burned=calories_burned)
-    session.add(workout)
-    session.flush()
+    calories_burned = int(avg_watts * (moving_seconds / 3600) * 3.6)
+
+    return {'duration': duration, 'moving_time': moving_time, 'distance_km': distance_km, 'avg_watts': avg_watts,
+            'normalized_power': normalized_power, 'intensity_factor': intensity_factor,
+            'training_stress_score': training_stress_score, 'avg_cadence': avg_cadence, 'avg_speed': avg_speed,
+            'avg_speed_without_stop': avg_speed_without_stop, 'avg_heartrate': avg_heartrate,
+            'max_heartrate': max_heartrate, 'calories_burned': calories_burned}
+
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from app.core.config import COACH_CACHE_SIZE, COACH_CACHE_TTL, COACH_CACHE_EMBEDDINGS, COACH_CACHE_SIMILARITY
+from app.core.metrics import metrics
+
+
+def normalize(text: str) -> str:
+    """Регистр и лишние пробелы не влияют на ключ"""
+    return ' '.join(text.lower().split())
+
+
+# Вопрос ссылается на прошлые реплики: ответ зависит от диалога, а не только от профиля и тренировок
+_FOLLOW_UP = re.compile(
+    r'^(а|и|но|тогда|а если|а как)\b'
+    r'|\b(это|этот|эта|эти|этого|этому|этим|этой|такое|такой|выше|ранее|предыдущ\w*|подробнее|еще раз|ещё раз'
+    r'|ты (сказал|написал|советовал|предложил|ответил)\w*|твой совет|твоему совету'
+    r'|that|this|it|above|earlier|previous|you said|more detail)\b')
+
+
+def is_follow_up(question: str) -> bool:
+    return _FOLLOW_UP.search(normalize(question)) is not None
+
+
+def context_hash(messages: list[dict]) -> str:
+    """Хэш стабильного контекста без вопроса: персона, профиль, сводка тренировок и CTL/ATL/TSB"""
+    normalized = [{'role': message['role'], 'content': normalize(message['content'])} for message in messages]
+    return hashlib.sha256(json.dumps(normalized, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+
+class _Entry:
+    def __init__(self, user_id: int, context: str, embedding, answer: str):
+        self.user_id = user_id
+        self.context = context
+        self.embedding = embedding
+        self.answer = answer
+        self.created_at = time.monotonic()
+
+
+class CachedQuery:
+    """Результат поиска в кэше: answer заполнен при попадании, store() сохраняет новый ответ"""
+
+    def __init__(self, cache: 'ResponseCache', user_id: int, context: str, key: str | None, embedding,
+                 answer: str | None):
+        self.cache = cache
+        self.user_id = user_id
+        self.context = context
+        self.key = key
+        self.embedding = embedding
+        self.answer = answer
+
+    def store(self, answer: str) -> None:
+        if answer and self.key is not None:
+            self.cache._put(self.key, _Entry(self.user_id, self.context, self.embedding, answer))
+
+
+class ResponseCache:
+    """LRU-кэш ответов тренера с TTL. Ключ — пользователь, стабильный контекст (профиль, сводка тренировок,
+    CTL/ATL/TSB) и нормализованный вопрос. История диалога в ключ не входит, иначе повторный вопрос
+    никогда не совпадал бы с прежним, поэтому уточняющие вопросы, которые ссылаются на прошлые реплики,
+    в кэш не попадают. С эмбеддингами ответ отдается и на перефразированный вопрос при том же контексте."""
+
+    def __init__(self, size: int = COACH_CACHE_SIZE, ttl: int = COACH_CACHE_TTL,
+                 embeddings: bool = COACH_CACHE_EMBEDDINGS, similarity: float = COACH_CACHE_SIMILARITY):
+        self.size = size
+        self.ttl = ttl
+        self.embeddings = embeddings
+        self.similarity = similarity
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._hits = 0
+        self._lookups = 0
+
+    def _expired(self, entry: _Entry) -> bool:
+        return time.monotonic() - entry.created_at > self.ttl
+
+    def _put(self, key: str, entry: _Entry) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        metrics.set_gauge('coach_cache_size', len(self._entries))
+
+    def _record(self, hit: str | None) -> None:
+        self._lookups += 1
+        if hit:
+            self._hits += 1
+            metrics.increment(f'coach_cache_{hit}_hits')
+        else:
+            metrics.increment('coach_cache_misses')
+        metrics.set_gauge('coach_cache_hit_rate', self._hits / self._lookups)
+
+    def _similar(self, user_id: int, context: str, embedding) -> _Entry | None:
+        vector = np.asarray(embedding, dtype=np.float64)
+        norm = np.linalg.norm(vector)
+        best, best_score = None, self.similarity
+        for entry in self._entries.values():
+            if entry.user_id != user_id or entry.context != context or entry.embedding is None \
+                    or self._expired(entry):
+                continue
+            other = np.asarray(entry.embedding, dtype=np.float64)
+            score = float(vector @ other / (norm * np.linalg.norm(other) or 1))
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    async def lookup(self, user_id: int, context_messages: list[dict], question: str, service) -> CachedQuery:
+        context = context_hash(context_messages)
+        if is_follow_up(question):
+            # Без ключа ответ не сохраняется, эмбеддинг не нужен
+            metrics.increment('coach_cache_skipped_follow_ups')
+            return CachedQuery(self, user_id, context, None, None, None)
+        key = hashlib.sha256(f'{user_id}:{context}:{normalize(question)}'.encode()).hexdigest()
+        entry = self._entries.get(key)
+        if entry is not None and self._expired(entry):
+            del self._entries[key]
+            entry = None
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self._record('exact')
+            return CachedQuery(self, user_id, context, key, entry.embedding, entry.answer)
+
+        embedding = await service.embed(normalize(question)) if self.embeddings else None
+        if embedding is not None:
+            entry = self._similar(user_id, context, embedding)
+            if entry is not None:
+                self._record('semantic')
+                return CachedQuery(self, user_id, context, key, embedding, entry.answer)
+        self._record(None)
+        return CachedQuery(self, user_id, context, key, embedding, None)
+
+    def invalidate_user(self, user_id: int) -> None:
+        """Новая тренировка или правка профиля меняют контекст: старые ответы пользователя больше не годятся"""
+        for key in [key for key, entry in self._entries.items() if entry.user_id == user_id]:
+            del self._entries[key]
+        metrics.set_gauge('coach_cache_size', len(self._entries))
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,215 @@
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import case, delete, func, cast, Integer
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import Session, select
+
+from app.models.models import Workout, WorkoutRollup, UploadedFile
+
+PERIODS = ('day', 'week', 'month')
+
+# Поле Workout -> (сумма, количество) в роллапе для средних
+_AVERAGES = {
+    'avg_watts': ('watts_sum', 'watts_count'),
+    'avg_speed': ('speed_sum', 'speed_count'),
+    'avg_heartrate': ('heartrate_sum', 'heartrate_count'),
+    'avg_cadence': ('cadence_sum', 'cadence_count'),
+}
+# Поле Workout -> максимум в роллапе
+_MAXIMA = {
+    'distance_km': 'max_distance_km',
+    'max_heartrate': 'max_heartrate',
+    'normalized_power': 'max_normalized_power',
+    'intensity_factor': 'max_intensity_factor',
+    'calories_burned': 'max_calories',
+}
+
+
+def _number(value):
+    """В старых записях вместо чисел может лежать строка 'нет данных'"""
+    return value if isinstance(value, (int, float)) else None
+
+
+def bucket_start(day: date, period: str) -> date:
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    if period == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def bucket_end(start: date, period: str) -> date:
+    if period == 'week':
+        return start + timedelta(days=7)
+    if period == 'month':
+        return (start + timedelta(days=32)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def _workout_delta(workout: Workout) -> dict:
+    """Вклад одной тренировки в строку роллапа"""
+    delta = {'count': 1,
+             'distance_km': _number(workout.distance_km) or 0,
+             'moving_seconds': int(workout.moving_time.total_seconds()) if workout.moving_time else 0,
+             'training_stress_score': _number(workout.training_stress_score) or 0,
+             'calories_burned': _number(workout.calories_burned) or 0}
+    for field, (sum_column, count_column) in _AVERAGES.items():
+        value = _number(getattr(workout, field))
+        delta[sum_column] = value or 0
+        delta[count_column] = 0 if value is None else 1
+    for field, max_column in _MAXIMA.items():
+        delta[max_column] = _number(getattr(workout, field))
+    return delta
+
+
+def _merge(rows: list[dict]) -> dict:
+    total = {'count': 0, 'distance_km': 0, 'moving_seconds': 0, 'training_stress_score': 0, 'calories_burned': 0}
+    for sum_column, count_column in _AVERAGES.values():
+        total[sum_column] = 0
+        total[count_column] = 0
+    for max_column in _MAXIMA.values():
+        total[max_column] = None
+    for row in rows:
+        for column, value in row.items():
+            if column in _MAXIMA.values():
+                if value is not None and (total[column] is None or value > total[column]):
+                    total[column] = value
+            else:
+                total[column] += value
+    return total
+
+
+def _numeric(column):
+    """Только числовые значения: строки 'нет данных' в старых записях превращаются в NULL"""
+    return case((func.typeof(column).in_(['integer', 'real']), column))
+
+
+def _workout_aggregates() -> list:
+    """Агрегаты по Workout с именами колонок роллапа, NULL не учитываются в средних и максимумах"""
+    moving_seconds = cast(func.strftime('%s', Workout.moving_time), Integer)
+    columns = [func.count(Workout.id).label('count'),
+               func.coalesce(func.sum(_numeric(Workout.distance_km)), 0).label('distance_km'),
+               func.coalesce(func.sum(moving_seconds), 0).label('moving_seconds'),
+               func.coalesce(func.sum(_numeric(Workout.training_stress_score)), 0).label('training_stress_score'),
+               func.coalesce(func.sum(_numeric(Workout.calories_burned)), 0).label('calories_burned')]
+    for field, (sum_column, count_column) in _AVERAGES.items():
+        value = _numeric(getattr(Workout, field))
+        columns.append(func.coalesce(func.sum(value), 0).label(sum_column))
+        columns.append(func.count(value).label(count_column))
+    for field, max_column in _MAXIMA.items():
+        columns.append(func.max(_numeric(getattr(Workout, field))).label(max_column))
+    return columns
+
+
+def add_workout(session: Session, workout: Workout, day: date) -> None:
+    """Добавляет тренировку во все роллапы пользователя одним атомарным upsert на период"""
+    delta = _workout_delta(workout)
+    for period in PERIODS:
+        statement = insert(WorkoutRollup).values(user_id=workout.user_id, period=period,
+                                                 period_start=bucket_start(day, period), **delta)
+        table = WorkoutRollup.__table__.c
+        excluded = statement.excluded
+        update = {column: table[column] + excluded[column] for column in delta if column not in _MAXIMA.values()}
+        for column in _MAXIMA.values():
+            # max() в SQLite возвращает NULL, если хоть один аргумент NULL
+            update[column] = func.max(func.coalesce(table[column], excluded[column]),
+                                      func.coalesce(excluded[column], table[column]))
+        session.execute(statement.on_conflict_do_update(index_elements=['user_id', 'period', 'period_start'],
+                                                        set_=update))
+
+
+def rebuild_bucket(session: Session, user_id: int, period: str, start: date) -> None:
+    """Пересчитывает одну строку роллапа с нуля (нужно при удалении: максимум нельзя вычесть)"""
+    end = bucket_end(start, period)
+    totals = session.execute(select(*_workout_aggregates()).select_from(Workout).join(UploadedFile).where(
+        Workout.user_id == user_id,
+        UploadedFile.uploaded_at >= datetime.combine(start, datetime.min.time()),
+        UploadedFile.uploaded_at < datetime.combine(end, datetime.min.time()))).mappings().one()
+    session.execute(delete(WorkoutRollup).where(WorkoutRollup.user_id == user_id, WorkoutRollup.period == period,
+                                                WorkoutRollup.period_start == start))
+    if totals['count']:
+        session.add(WorkoutRollup(user_id=user_id, period=period, period_start=start, **totals))
+
+
+def remove_workout(session: Session, user_id: int, day: date) -> None:
+    """Вызывается после удаления тренировки из сессии: пересчитывает затронутые роллапы"""
+    session.flush()
+    for period in PERIODS:
+        rebuild_bucket(session, user_id, period, bucket_start(day, period))
+
+
+def rebuild_user(session: Session, user_id: int) -> None:
+    """Полный пересчет роллапов пользователя: дни считает SQL, недели и месяцы собираются из дней"""
+    session.execute(delete(WorkoutRollup).where(WorkoutRollup.user_id == user_id))
+    day_column = func.date(UploadedFile.uploaded_at).label('day')
+    rows = session.execute(select(day_column, *_workout_aggregates()).select_from(Workout).join(UploadedFile)
+                           .where(Workout.user_id == user_id).group_by(day_column)).mappings().all()
+    buckets: dict[tuple[str, date], list[dict]] = {}
+    for row in rows:
+        totals = dict(row)
+        day = date.fromisoformat(totals.pop('day'))
+        for period in PERIODS:
+            buckets.setdefault((period, bucket_start(day, period)), []).append(totals)
+    for (period, start), day_rows in buckets.items():
+        session.add(WorkoutRollup(user_id=user_id, period=period, period_start=start, **_merge(day_rows)))
+
+
+def backfill(session: Session) -> None:
+    """Заполняет роллапы для уже существующих тренировок при первом запуске"""
+    if session.exec(select(WorkoutRollup.id).limit(1)).first() is not None:
+        return
+    user_ids = session.exec(select(Workout.user_id).where(Workout.user_id.is_not(None)).distinct()).all()
+    for user_id in user_ids:
+        rebuild_user(session, user_id)
+    session.commit()
+
+
+def period_totals(session: Session, user_id: int, since: date) -> dict:
+    """Итоги периода одним агрегирующим запросом по дневным роллапам"""
+    rollup = WorkoutRollup
+
+    def average(sum_column, count_column):
+        return func.sum(sum_column) / func.nullif(func.sum(count_column), 0)
+
+    statement = select(
+        func.coalesce(func.sum(rollup.count), 0).label('count'),
+        func.coalesce(func.sum(rollup.distance_km), 0).label('distance_km'),
+        func.coalesce(func.sum(rollup.moving_seconds), 0).label('moving_seconds'),
+        func.coalesce(func.sum(rollup.training_stress_score), 0).label('training_stress_score'),
+        func.coalesce(func.sum(rollup.calories_burned), 0).label('calories_burned'),
+        func.coalesce(average(rollup.watts_sum, rollup.watts_count), 0).label('avg_watts'),
+        func.coalesce(average(rollup.speed_sum, rollup.speed_count), 0).label('avg_speed'),
+        func.coalesce(average(rollup.heartrate_sum, rollup.heartrate_count), 0).label('avg_heartrate'),
+        func.coalesce(average(rollup.cadence_sum, rollup.cadence_count), 0).label('avg_cadence'),
+        func.coalesce(func.max(rollup.max_distance_km), 0).label('max_distance_km'),
+        func.coalesce(func.max(rollup.max_heartrate), 0).label('max_heartrate'),
+        func.coalesce(func.max(rollup.max_normalized_power), 0).label('max_normalized_power'),
+        func.coalesce(func.max(rollup.max_intensity_factor), 0).label('max_intensity_factor'),
+        func.coalesce(func.max(rollup.max_calories), 0).label('max_calories'),
+    ).where(rollup.user_id == user_id, rollup.period == 'day', rollup.period_start >= since)
+    return dict(session.execute(statement).mappings().one())
+
+
+def period_series(session: Session, user_id: int, period: str, since: date) -> list:
+    """Ряды для графиков: одна строка на день / неделю / месяц, средние считает SQL"""
+    rollup = WorkoutRollup
+    statement = select(
+        rollup.period_start,
+        rollup.training_stress_score,
+        (rollup.watts_sum / func.nullif(rollup.watts_count, 0)).label('avg_watts'),
+        (rollup.speed_sum / func.nullif(rollup.speed_count, 0)).label('avg_speed'),
+        (rollup.heartrate_sum / func.nullif(rollup.heartrate_count, 0)).label('avg_heartrate'),
+        (rollup.cadence_sum / func.nullif(rollup.cadence_count, 0)).label('avg_cadence'),
+    ).where(rollup.user_id == user_id, rollup.period == period,
+            rollup.period_start >= bucket_start(since, period)).order_by(rollup.period_start)
+    return session.execute(statement).all()
+
+
+def workout_count(session: Session, user_id: int, since: date | None = None) -> int:
+    """Количество тренировок из счетчиков роллапов вместо COUNT(*) по всей истории"""
+    period = 'day' if since else 'month'
+    statement = select(func.coalesce(func.sum(WorkoutRollup.count), 0)).where(WorkoutRollup.user_id == user_id,
+                                                                              WorkoutRollup.period == period)
+    if since:
+        statement = statement.where(WorkoutRollup.period_start >= since)
+    return session.exec(statement).one()
@@ -1,13 +1,49 @@
+import asyncio
 import copy
 import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import jwt
 from passlib.context import CryptContext
 
+from app.core.config import BCRYPT_ROUNDS, PASSWORD_HASH_WORKERS
+from app.core.metrics import metrics
+
 SECRET_KEY = 'Mysecretkey2131jbvadjladvbcvabaljfghdvbcnxcnmbvxcnmxbvxmbnvc'
 ALGORITHM = 'HS256'
 
-my_cc = CryptContext(schemes=['bcrypt'], deprecated='auto')
+# Хэши с другим числом раундов считаются устаревшими и пересчитываются при входе
+my_cc = CryptContext(schemes=['bcrypt'], deprecated='auto', bcrypt__rounds=BCRYPT_ROUNDS,
+                     bcrypt__min_rounds=BCRYPT_ROUNDS, bcrypt__max_rounds=BCRYPT_ROUNDS)
+
+_password_pool: ThreadPoolExecutor | None = None
+
+
+def get_password_pool() -> ThreadPoolExecutor:
+    """Отдельный ограниченный пул под bcrypt: C-реализация отпускает GIL, а всплеск входов
+    не занимает потоки импорта и не растет больше PASSWORD_HASH_WORKERS одновременных хэшей"""
+    global _password_pool
+    if _password_pool is None:
+        _password_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='password')
+    return _password_pool
+
+
+def shutdown_password_pool() -> None:
+    global _password_pool
+    if _password_pool is not None:
+        _password_pool.shutdown(wait=True, cancel_futures=True)
+        _password_pool = None
+
+
+async def _run_in_password_pool(func, *args):
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(get_password_pool(), partial(func, *args))
+    finally:
+        metrics.observe('password_hash_seconds', time.perf_counter() - started)
 
 
 def get_password_hash(password: str) -> str:
@@ -20,6 +56,15 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return result
 
 
+async def hash_password_async(password: str) -> str:
+    return await _run_in_password_pool(get_password_hash, password)
+
+
+async def verify_and_update_password(plain_password: str, hashed_password: str) -> tuple[bool, str | None]:
+    """Проверяет пароль; если хэш посчитан с устаревшими параметрами, возвращает новый для сохранения"""
+    return await _run_in_password_pool(my_cc.verify_and_update, plain_password, hashed_password)
+
+
 def create_access_token(data: dict) -> str:
     # Время жизни токена
     exp = datetime.datetime.now(datetime.UTC) + datetime.timedelta(minutes=30)
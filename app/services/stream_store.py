@@ -0,0 +1,57 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+# Посекундные ряды тренировки: data/streams/<workout_id>/<колонка>.npy
+STREAMS_DIR = Path('data/streams')
+
+
+class StreamNotFoundError(Exception):
+    """Для тренировки нет сохраненных потоков"""
+    pass
+
+
+def streams_path(workout_id: int) -> Path:
+    return STREAMS_DIR / str(workout_id)
+
+
+def stage_streams(key: str, streams: dict[str, np.ndarray]) -> Path:
+    """Записывает ряды во временную папку до того, как известен id тренировки"""
+    staged = STREAMS_DIR / '.staging' / key
+    shutil.rmtree(staged, ignore_errors=True)
+    staged.mkdir(parents=True)
+    for column, values in streams.items():
+        np.save(staged / f'{column}.npy', values, allow_pickle=False)
+    return staged
+
+
+def publish_streams(staged: Path, workout_id: int) -> None:
+    """Переименование атомарно: читатель никогда не увидит недописанный набор файлов"""
+    target = streams_path(workout_id)
+    shutil.rmtree(target, ignore_errors=True)
+    staged.rename(target)
+
+
+def discard_staged(staged: Path) -> None:
+    shutil.rmtree(staged, ignore_errors=True)
+
+
+def save_streams(workout_id: int, streams: dict[str, np.ndarray]) -> None:
+    """Записывает ряды один раз при импорте"""
+    publish_streams(stage_streams(f'workout-{workout_id}', streams), workout_id)
+
+
+def load_streams(workout_id: int, columns: list[str] | None = None) -> dict[str, np.ndarray]:
+    """Открывает ряды через memmap: данные не копируются и читаются с диска по мере обращения"""
+    path = streams_path(workout_id)
+    if not path.is_dir():
+        raise StreamNotFoundError(f'Потоки тренировки {workout_id} не найдены')
+    files = sorted(path.glob('*.npy'))
+    if columns is not None:
+        files = [file for file in files if file.stem in columns]
+    return {file.stem: np.load(file, mmap_mode='r', allow_pickle=False) for file in files}
+
+
+def delete_streams(workout_id: int) -> None:
+    shutil.rmtree(streams_path(workout_id), ignore_errors=True)
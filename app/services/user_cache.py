@@ -0,0 +1,69 @@
+import time
+
+import jwt
+from sqlalchemy.orm import joinedload
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.config import USER_CACHE_TTL
+from app.core.metrics import metrics
+from app.db import async_engine
+from app.models.models import Users
+from app.services.security import SECRET_KEY, ALGORITHM
+
+
+def select_user():
+    """Пользователь сразу с обоими профилями одним запросом: ленивой загрузки в асинхронной сессии нет"""
+    return select(Users).options(joinedload(Users.user_profile), joinedload(Users.athlete_profile))
+
+
+class UserCache:
+    """Пользователи с профилями по id на ttl секунд. Объекты отсоединены от сессии и только читаются:
+    для изменений профиль нужно загрузить в сессию запроса и после коммита вызвать invalidate()."""
+
+    def __init__(self, ttl: int = USER_CACHE_TTL):
+        self.ttl = ttl
+        self._users: dict[int, tuple[float, Users]] = {}
+
+    async def _load(self, statement) -> Users | None:
+        async with AsyncSession(async_engine) as session:
+            return (await session.exec(statement)).first()
+
+    async def get(self, user_id: int) -> Users | None:
+        cached = self._users.get(user_id)
+        if cached is not None and cached[0] > time.monotonic():
+            metrics.increment('user_cache_hits')
+            return cached[1]
+        metrics.increment('user_cache_misses')
+        user = await self._load(select_user().where(Users.id == user_id))
+        if user is None:
+            self._users.pop(user_id, None)
+        else:
+            self._users[user_id] = (time.monotonic() + self.ttl, user)
+        return user
+
+    async def get_by_email(self, email: str) -> Users | None:
+        """Для токенов, выданных до перехода на id в sub"""
+        user = await self._load(select_user().where(Users.email == email))
+        if user is not None:
+            self._users[user.id] = (time.monotonic() + self.ttl, user)
+        return user
+
+    async def from_token(self, token: str | None) -> Users | None:
+        if not token:
+            return None
+        try:
+            # Пробует декодировать подпись токена с помощью секретного ключа
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except jwt.InvalidTokenError:
+            return None
+        subject = str(payload.get('sub', ''))
+        if subject.isdigit():
+            return await self.get(int(subject))
+        return await self.get_by_email(subject)
+
+    def invalidate(self, user_id: int) -> None:
+        self._users.pop(user_id, None)
+
+
+user_cache = UserCache()
@@ -0,0 +1,227 @@
+"""Общие помощники бенчмарков: изолированная рабочая папка, синтетические заезды, замеры памяти и перцентили.
+Бенчмарки запускаются из корня репозитория: python -m bench.<имя>"""
+import asyncio
+import atexit
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import httpx
+import numpy as np
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+# Колонки экспорта Strava, которые парсер не читает, но которые есть в реальных файлах
+EXTRA_COLUMNS = ('temp', 'grade_smooth', 'lat', 'lng', 'left_right_balance', 'torque', 'smo2', 'thb')
+
+
+class StubOllama:
+    """Локальный HTTP-сервер в формате Ollama на свободном порту: отвечает сразу, запросы сохраняет в requests,
+    число принятых TCP-соединений — в connections.
+    respond(path, payload) может вернуть свой ответ; по умолчанию — короткий ответ модели."""
+
+    def __init__(self, respond=None):
+        self.requests: list[tuple[str, dict]] = []
+        self.connections = 0
+        self.respond = respond or (lambda path, payload: {'message': {'role': 'assistant', 'content': 'ok'},
+                                                          'response': 'ok', 'done': True})
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, как у настоящего Ollama
+            disable_nagle_algorithm = True  # заголовки и тело уходят разными пакетами, без этого +40 мс на ответ
+
+            def setup(self):
+                stub.connections += 1
+                super().setup()
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                stub.requests.append((self.path, payload))
+                body = json.dumps(stub.respond(self.path, payload)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def use_workdir(root: Path = ROOT) -> Path:
+    """Как в тестах: приложение работает во временной папке со ссылкой на app, data/ создается там же.
+    root — другая копия репозитория (git worktree), чтобы сравнить с прежней версией.
+    Вызывать до импорта app.db и app.main."""
+    if root != ROOT:
+        sys.path.insert(0, str(root))
+    workdir = Path(tempfile.mkdtemp(prefix='bike-tracker-bench-'))
+    (workdir / 'app').symlink_to(root / 'app', target_is_directory=True)
+    os.chdir(workdir)
+    atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    return workdir
+
+
+def ride_frame(seconds: int, seed: int = 0, extra_columns: bool = True) -> pd.DataFrame:
+    """Заезд с частотой 1 Гц: мощность с интервалами, остановки, пульс с дрейфом"""
+    rng = np.random.default_rng(seed)
+    time_s = np.arange(seconds)
+    watts = np.clip(180 + 60 * np.sin(time_s / 300) + rng.normal(0, 40, seconds), 0, None).round()
+    moving = rng.random(seconds) > 0.03
+    velocity = np.where(moving, 7.5 + rng.normal(0, 1.2, seconds), 0).clip(0)
+    frame = pd.DataFrame({
+        'time': time_s,
+        'watts': np.where(moving, watts, 0),
+        'velocity_smooth': velocity,
+        'distance': np.cumsum(velocity),
+        'heartrate': (120 + watts / 6 + time_s / seconds * 8).round(),
+        'cadence': np.where(moving, rng.normal(88, 6, seconds), 0).round(),
+        'moving': moving,
+        'altitude': 100 + np.cumsum(rng.normal(0, 0.1, seconds)),
+        'latlng': '[55.75, 37.61]',
+    })
+    if extra_columns:
+        for column in EXTRA_COLUMNS:
+            frame[column] = rng.normal(0, 1, seconds)
+    return frame
+
+
+def write_ride(path: Path, seconds: int, seed: int = 0, extra_columns: bool = True) -> Path:
+    ride_frame(seconds, seed, extra_columns).to_csv(path, index=False)
+    return path
+
+
+PROFILE = dict(name='Bench', weight_kg=70, current_ftp=250, limitations='-', weekly_hours=8, gear='шоссе',
+               environment_location='город')
+
+
+@asynccontextmanager
+async def app_client(email: str = 'bench@example.com'):
+    """Приложение в текущем цикле событий, как в одном воркере uvicorn, и клиент с вошедшим пользователем.
+    Перед вызовом нужен use_workdir()."""
+    from app import db
+    from app.main import app
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench.local',
+                                     timeout=600) as client:
+            await client.post('/register', data={'email': email, 'password': 'secret'})
+            await client.post('/login', data={'username': email, 'password': 'secret'})
+            await client.post('/profile/create', data=PROFILE)
+            yield client
+    # Соединения aiosqlite закрываются в этом же цикле, пока он жив; в версиях до async_engine его нет
+    if hasattr(db, 'async_engine'):
+        await db.async_engine.dispose()
+
+
+def seed_history(user_id: int, workouts: int, days: int = 5 * 365, seed: int = 0) -> None:
+    """Записывает тренировки пользователя прямо в базу, равномерно за последние days дней,
+    и строит по ним роллапы и ряд CTL/ATL/TSB, как после обычного импорта"""
+    from sqlmodel import Session
+    from app.db import engine
+    from app.models.models import UploadedFile, Workout
+    from app.services import fitness, rollups
+
+    rng = np.random.default_rng(seed)
+    now = datetime.now()
+    with Session(engine) as session:
+        files = [UploadedFile(original_name=f'history{number}.csv', sha256=f'{seed:08x}{number:056x}',
+                              uploaded_at=now - timedelta(days=days * number / workouts), user_id=user_id)
+                 for number in range(workouts)]
+        session.add_all(files)
+        session.flush()
+        for file in files:
+            minutes = int(rng.integers(30, 240))
+            normalized_power = float(rng.normal(200, 25))
+            session.add(Workout(
+                source_file_id=file.id, user_id=user_id, duration=timedelta(minutes=minutes + 5),
+                moving_time=timedelta(minutes=minutes), distance_km=round(minutes * 0.5, 2),
+                avg_watts=int(normalized_power * 0.9), normalized_power=round(normalized_power, 1),
+                intensity_factor=round(normalized_power / 250, 3),
+                training_stress_score=round(minutes / 60 * (normalized_power / 250) ** 2 * 100, 1),
+                avg_cadence=int(rng.integers(75, 95)), avg_speed=30.0, avg_speed_without_stop=31,
+                avg_heartrate=int(rng.integers(120, 160)), max_heartrate=float(rng.integers(160, 190)),
+                calories_burned=minutes * 12))
+        session.flush()
+        rollups.rebuild_user(session, user_id)
+        fitness.rebuild_user(session, user_id)
+        session.commit()
+
+
+async def wait_done(client: httpx.AsyncClient, url: str, poll: float = 0.2) -> dict:
+    status = (await client.get(url)).json()
+    while status['status'] != 'done':
+        await asyncio.sleep(poll)
+        status = (await client.get(url)).json()
+    return status
+
+
+async def import_rides(client: httpx.AsyncClient, rides: dict[str, bytes]) -> dict:
+    """Загружает файлы через /imports и ждет окончания задачи импорта"""
+    response = await client.post('/imports', files=[('files', (name, content, 'text/csv'))
+                                                     for name, content in rides.items()])
+    return await wait_done(client, f'/imports/{response.headers["location"].rsplit("=", 1)[1]}')
+
+
+async def timed_requests(client: httpx.AsyncClient, url: str, until: asyncio.Event | None = None,
+                         count: int = 100) -> list[float]:
+    """Задержки GET url подряд: count запросов или пока не установлено событие until"""
+    latencies = []
+    while (until is not None and not until.is_set()) or (until is None and len(latencies) < count):
+        started = time.perf_counter()
+        response = await client.get(url)
+        latencies.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.status_code
+    return latencies
+
+
+def _measure(func, args):
+    func(*args)  # прогрев: импорты и кэш файловой системы не попадают в замер
+    started = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - started
+    # NumPy и pandas сообщают о своих буферах в tracemalloc, поэтому пик включает данные DataFrame
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak / 2 ** 20
+
+
+def in_fresh_process(func, *args):
+    """Запускает func в новом процессе: (результат, секунды, пик выделенной памяти в МБ).
+    Время меряется отдельным прогоном без tracemalloc."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(_measure, func, args).result()
+
+
+def percentile(values, p: float) -> float:
+    return float(np.percentile(values, p)) if len(values) else float('nan')
+
+
+def latency_summary(seconds: list[float]) -> str:
+    if not seconds:
+        return 'n=0'
+    ms = [value * 1000 for value in seconds]
+    return f'n={len(ms)} p50={percentile(ms, 50):.1f} мс p99={percentile(ms, 99):.1f} мс max={max(ms):.1f} мс'
@@ -0,0 +1,48 @@
+"""Пик памяти и время разбора длинного заезда: потоковый парсер против чтения CSV целиком.
+
+    python -m bench.csv_ingest [часов]
+
+Вариант 'read_csv целиком' повторяет прежний parse_csv_to_workout без записи в базу."""
+import sys
+import tempfile
+from datetime import timedelta
+from pathlib import Path
+
+import pandas as pd
+
+from bench._common import in_fresh_process, write_ride
+from app.services.parse_cvs import compute_ride_metrics
+
+
+def full_read_metrics(file_path: Path, ftp: int) -> dict:
+    df = pd.read_csv(file_path)
+    moving_mask = df['moving'] == True  # noqa: E712
+    p_30 = df.loc[moving_mask, 'watts'].rolling(30).mean()
+    normalized_power = round(((p_30 ** 4).mean()) ** 0.25, 1)
+    return {'duration': timedelta(seconds=float(df['time'].max())),
+            'avg_watts': int(df.loc[moving_mask, 'watts'].mean()),
+            'normalized_power': normalized_power, 'max_heartrate': int(df['heartrate'].max()),
+            'distance_km': round(df['distance'].max() / 1000, 2)}
+
+
+def streaming_metrics(file_path: Path, ftp: int) -> dict:
+    return compute_ride_metrics(file_path, ftp)
+
+
+def main() -> None:
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 6
+    with tempfile.TemporaryDirectory() as folder:
+        path = write_ride(Path(folder) / 'ride.csv', int(hours * 3600))
+        print(f'Заезд {hours:g} ч при 1 Гц, {path.stat().st_size / 2 ** 20:.1f} МБ CSV, '
+              f'{len(pd.read_csv(path, nrows=0).columns)} колонок')
+        results = {}
+        for name, func in (('read_csv целиком', full_read_metrics), ('потоковый парсер', streaming_metrics)):
+            result, seconds, peak_mb = in_fresh_process(func, path, 250)
+            results[name] = result
+            print(f'{name:18} {seconds * 1000:8.0f} мс  пик памяти {peak_mb:6.1f} МБ  NP {result["normalized_power"]}')
+        old, new = results.values()
+        assert abs(old['normalized_power'] - new['normalized_power']) < 0.5, (old, new)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Стоимость пересчета CTL/ATL/TSB при добавлении тренировки задним числом в пятилетнюю историю.
+
+    python -m bench.fitness_recompute [тренировок в истории]
+
+Тренировка записывается так же, как при импорте: файл, тренировка, роллапы и ряд с даты тренировки,
+одной транзакцией. Для сравнения — полный пересчет ряда, который пришлось бы делать без материализации."""
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bench._common import seed_history, use_workdir
+
+OFFSETS = {'вчера': 1, 'месяц назад': 30, 'год назад': 365, '4 года назад': 4 * 365}
+REPEATS = 5
+
+
+def insert_back_dated(user_id: int, days_ago: int, number: int) -> tuple[float, int]:
+    from sqlmodel import Session
+    from app.db import engine
+    from app.models.models import UploadedFile, Workout
+    from app.services import fitness, rollups
+
+    uploaded_at = datetime.now() - timedelta(days=days_ago)
+    started = time.perf_counter()
+    with Session(engine) as session:
+        uploaded_file = UploadedFile(original_name=f'late{number}.csv', sha256=f'{number:064x}',
+                                     uploaded_at=uploaded_at, user_id=user_id)
+        session.add(uploaded_file)
+        session.flush()
+        workout = Workout(source_file_id=uploaded_file.id, user_id=user_id, duration=timedelta(hours=2),
+                          moving_time=timedelta(hours=2), distance_km=60, avg_watts=180, normalized_power=200,
+                          intensity_factor=0.8, training_stress_score=128, avg_cadence=88, avg_speed=30,
+                          avg_speed_without_stop=31, avg_heartrate=140, max_heartrate=170, calories_burned=1400)
+        session.add(workout)
+        session.flush()
+        rollups.add_workout(session, workout, uploaded_at.date())
+        rows = fitness.recompute_from(session, user_id, uploaded_at.date())
+        session.commit()
+    return time.perf_counter() - started, rows
+
+
+def full_rebuild(user_id: int) -> float:
+    from sqlmodel import Session
+    from app.db import engine
+    from app.services import fitness
+
+    started = time.perf_counter()
+    with Session(engine) as session:
+        fitness.rebuild_user(session, user_id)
+        session.commit()
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    workouts = int(sys.argv[1]) if len(sys.argv) > 1 else 1500
+    use_workdir()
+    from sqlmodel import Session, func, select
+    from app.db import create_db_and_tables, engine
+    from app.models.models import FitnessDay, Users
+    from app.services import fitness
+
+    create_db_and_tables()
+    with Session(engine) as session:
+        user = Users(email='bench@example.com', hashed_password='-')
+        session.add(user)
+        session.commit()
+        user_id = user.id
+    seed_history(user_id, workouts)
+    with Session(engine) as session:
+        days = session.exec(select(func.count()).select_from(FitnessDay).where(FitnessDay.user_id == user_id)).one()
+    print(f'История: {workouts} тренировок за 5 лет, {days} дней в ряду')
+
+    number = 0
+    for name, days_ago in OFFSETS.items():
+        timings = []
+        for _ in range(REPEATS):
+            seconds, rows = insert_back_dated(user_id, days_ago, number)
+            timings.append(seconds)
+            number += 1
+        print(f'  вставка {name:>13}: {statistics.median(timings) * 1000:7.1f} мс, пересчитано дней: {rows}')
+    timings = [full_rebuild(user_id) for _ in range(REPEATS)]
+    print(f'  полный пересчет ряда: {statistics.median(timings) * 1000:7.1f} мс')
+    with Session(engine) as session:
+        started = time.perf_counter()
+        for _ in range(100):
+            fitness.current(session, user_id)
+        print(f'  чтение текущих значений: {(time.perf_counter() - started) * 10:.2f} мс')
+
+
+if __name__ == '__main__':
+    main()
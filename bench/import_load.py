@@ -0,0 +1,45 @@
+"""Задержка GET /workouts, пока идет импорт 50 файлов, против задержки без нагрузки.
+
+    python -m bench.import_load [файлов] [минут в файле]
+
+Приложение и клиент работают в одном цикле событий, как один воркер uvicorn: любая синхронная
+работа в обработчике или фоновой задаче сразу видна в задержке остальных запросов."""
+import asyncio
+import sys
+import time
+
+from bench._common import app_client, import_rides, latency_summary, ride_frame, timed_requests, use_workdir
+
+
+async def scenario(files: int, minutes: int) -> None:
+    rides = [ride_frame(minutes * 60, seed=number).to_csv(index=False).encode() for number in range(files + 3)]
+    warm, rides = rides[files:], rides[:files]
+    async with app_client() as client:
+        # Несколько тренировок, чтобы список не был пустым
+        await import_rides(client, {f'warm{number}.csv': ride for number, ride in enumerate(warm)})
+        idle = await timed_requests(client, '/workouts', count=200)
+
+        finished = asyncio.Event()
+
+        async def run_import() -> float:
+            started = time.perf_counter()
+            status = await import_rides(client, {f'ride{number}.csv': ride for number, ride in enumerate(rides)})
+            finished.set()
+            assert status['success'] == files, status
+            return time.perf_counter() - started
+
+        import_seconds, busy = await asyncio.gather(run_import(), timed_requests(client, '/workouts', finished))
+    print(f'Импорт {files} файлов по {minutes} мин: {import_seconds:.1f} с')
+    print(f'GET /workouts без нагрузки: {latency_summary(idle)}')
+    print(f'GET /workouts во время импорта: {latency_summary(busy)}')
+
+
+def main() -> None:
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    minutes = int(sys.argv[2]) if len(sys.argv) > 2 else 90
+    use_workdir()
+    asyncio.run(scenario(files, minutes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Утренний всплеск входов: пропускная способность /login и p99 при конкурентных входах.
+
+    python -m bench.login_burst [входов одновременно] [всего входов] [путь к другой копии репозитория]
+
+Параллельно с входами клиент опрашивает /me: его задержка показывает, не занят ли bcrypt цикл событий.
+Стоимость bcrypt задается переменной BCRYPT_ROUNDS; пользователи регистрируются с тем же значением."""
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+from bench._common import ROOT, app_client, latency_summary, use_workdir
+
+USERS = 20
+
+
+async def login(client: httpx.AsyncClient, email: str, latencies: list[float]) -> None:
+    started = time.perf_counter()
+    response = await client.post('/login', data={'username': email, 'password': 'secret'})
+    latencies.append(time.perf_counter() - started)
+    assert response.status_code == 303, response.status_code
+
+
+async def scenario(concurrency: int, total: int) -> None:
+    from app.main import app
+
+    async with app_client() as client:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench.local') as guest:
+            emails = [f'rider{number}@example.com' for number in range(USERS)]
+            for email in emails:
+                await guest.post('/register', data={'email': email, 'password': 'secret'})
+            await login(guest, emails[0], [])  # прогрев пула
+
+            latencies: list[float] = []
+            limit = asyncio.Semaphore(concurrency)
+
+            async def limited(number: int) -> None:
+                async with limit:
+                    await login(guest, emails[number % USERS], latencies)
+
+            done = asyncio.Event()
+            heartbeat = asyncio.create_task(probe(client, done))
+            started = time.perf_counter()
+            await asyncio.gather(*(limited(number) for number in range(total)))
+            seconds = time.perf_counter() - started
+            done.set()
+            probes = await heartbeat
+    print(f'BCRYPT_ROUNDS={os.environ.get("BCRYPT_ROUNDS", "по умолчанию")}, {concurrency} одновременно, '
+          f'{total} входов за {seconds:.1f} с: {total / seconds:.1f} входов/с')
+    print(f'  /login {latency_summary(latencies)}')
+    print(f'  /me    {latency_summary(probes)}')
+
+
+async def probe(client: httpx.AsyncClient, done: asyncio.Event) -> list[float]:
+    latencies = []
+    while not done.is_set():
+        started = time.perf_counter()
+        await client.get('/me')
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(0.05)
+    return latencies
+
+
+def main() -> None:
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    total = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    os.environ.setdefault('OLLAMA_WARMUP', '0')
+    use_workdir(Path(sys.argv[3]).resolve() if len(sys.argv) > 3 else ROOT)
+    asyncio.run(scenario(concurrency, total))
+
+
+if __name__ == '__main__':
+    main()
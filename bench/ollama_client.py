@@ -0,0 +1,80 @@
+"""Накладные расходы одного обращения к модели: прежний OllamaService против общего сервиса с пулом соединений.
+
+    python -m bench.ollama_client [вызовов] [одновременно]
+
+Модель заменена локальным сервером-заглушкой, который отвечает сразу, поэтому замер — чистые
+накладные расходы клиента: создание httpx.AsyncClient, TCP-соединение и чтение файлов промптов.
+Прежний путь повторяет старый код: на каждый запрос новый сервис читает три файла промптов,
+на каждый вызов открывается новый AsyncClient."""
+import asyncio
+import os
+import sys
+import time
+
+import httpx
+
+from bench._common import StubOllama, latency_summary
+
+MESSAGES = [{'role': 'user', 'content': 'Как ехать завтра?'}]
+
+
+async def per_call_client(url: str, prompts_dir) -> None:
+    for name in ('System_Persona.txt', 'User_Profile.txt', 'Current_Content.txt'):
+        (prompts_dir / name).read_text(encoding='utf-8')
+    async with httpx.AsyncClient(timeout=60) as client:
+        response = await client.post(f'{url}/api/chat', json={'model': 'llama3.1', 'messages': MESSAGES,
+                                                               'stream': False, 'options': {'num_ctx': 8192}})
+        response.raise_for_status()
+
+
+async def shared_service() -> None:
+    from app.services.ai_coach import get_ollama_service
+    service = get_ollama_service()
+    service.system_prompt, service.user_profile, service.current_content  # noqa: B018  проверка mtime файлов
+    await service.chat(MESSAGES)
+
+
+async def measure(call, calls: int, concurrency: int) -> tuple[list[float], float]:
+    latencies = []
+
+    async def worker(count: int) -> None:
+        for _ in range(count):
+            started = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(calls // concurrency) for _ in range(concurrency)))
+    return latencies, time.perf_counter() - started
+
+
+async def scenario(stub: StubOllama, calls: int, concurrency: int) -> None:
+    from app.services.ai_coach import PROMPTS_DIR, close_ollama_service
+
+    variants = (('новый клиент на вызов', lambda: per_call_client(stub.url, PROMPTS_DIR)),
+                ('общий сервис и пул', shared_service))
+    for name, call in variants:
+        await call()  # прогрев: импорт, первое соединение
+        connections = stub.connections
+        latencies, seconds = await measure(call, calls, concurrency)
+        print(f'{name}: {len(latencies) / seconds:.0f} вызовов/с, TCP-соединений: {stub.connections - connections}')
+        print(f'    {latency_summary(latencies)}')
+    await close_ollama_service()
+
+
+def main() -> None:
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    stub = StubOllama()
+    # Настройки читаются при импорте app.core.config: адрес заглушки задается до него
+    os.environ['OLLAMA_URL'] = stub.url
+    os.environ['OLLAMA_WARMUP'] = '0'
+    print(f'{calls} вызовов, {concurrency} одновременно')
+    try:
+        asyncio.run(scenario(stub, calls, concurrency))
+    finally:
+        stub.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Сколько токенов промпта модель пересчитывает на каждом ходе диалога из 20 вопросов.
+
+    python -m bench.prompt_prefix [ходов] [токенов/с]
+
+Вопросы идут через настоящий POST /coach/chat, модель заменена заглушкой, которая записывает промпты.
+Ollama держит KV-кэш последнего промпта и заново вычисляет только часть после общего префикса,
+поэтому для каждого хода считается общий префикс с предыдущим промптом. Прежняя раскладка
+(профиль, история и вопрос одним сообщением пользователя, последние 10 реплик) собирается из тех же
+частей. Время — оценка по скорости обработки промпта, заданной вторым аргументом."""
+import asyncio
+import os
+import sys
+
+from bench._common import StubOllama, app_client, seed_history, use_workdir
+
+ANSWER = 'Держи ровный темп в Z2 и добавь два интервала по 8 минут в Z4. ' * 6
+OLD_HISTORY_MESSAGES = 10
+
+
+def render(messages: list[dict]) -> str:
+    """Промпт после шаблона чата: префикс сравнивается по тексту, как KV-кэш по токенам"""
+    return ''.join(f'<|{message["role"]}|>{message["content"]}<|end|>' for message in messages)
+
+
+def common_prefix(left: str, right: str) -> int:
+    length = min(len(left), len(right))
+    for position in range(length):
+        if left[position] != right[position]:
+            return position
+    return length
+
+
+def old_layout(system_prompt: str, messages: list[dict], history: list[dict]) -> list[dict]:
+    """Прежний build_chat_messages: вся изменчивая часть в одном сообщении, история со скользящим окном"""
+    profile_section = messages[0]['content'][len(system_prompt):].strip()
+    history_text = '### ПРЕДЫДУЩИЕ СООБЩЕНИЯ\n' + ''.join(
+        f'{message["role"]}: {message["content"]}\n' for message in history[-OLD_HISTORY_MESSAGES:])
+    return [{'role': 'system', 'content': system_prompt},
+            {'role': 'user', 'content': f'{profile_section}\n\n{history_text}\n\n{messages[-1]["content"]}'}]
+
+
+def evaluated_tokens(prompts: list[str]) -> list[tuple[int, int]]:
+    from app.services.ai_coach import count_tokens
+
+    result, previous = [], ''
+    for prompt in prompts:
+        reused = common_prefix(previous, prompt)
+        result.append((count_tokens(prompt), count_tokens(prompt[reused:])))
+        previous = prompt
+    return result
+
+
+async def scenario(stub: StubOllama, turns: int) -> None:
+    from app.services.ai_coach import get_ollama_service
+
+    async with app_client() as client:
+        seed_history((await client.get('/me')).json()['id'], workouts=10, days=7)
+        for turn in range(turns):
+            response = await client.post('/coach/chat', data={'user_question': f'Вопрос {turn + 1}: как ехать завтра?'})
+            assert response.status_code == 303, response.status_code
+            await asyncio.sleep(0.1)  # пауза между вопросами: фоновое резюме успевает обновиться
+        system_prompt = get_ollama_service().system_prompt.format(sport='cycling')
+
+    chats = [payload['messages'] for path, payload in stub.requests if path == '/api/chat']
+    new_prompts = [render(messages) for messages in chats]
+    old_prompts, history = [], []
+    for messages in chats:
+        old_prompts.append(render(old_layout(system_prompt, messages, history)))
+        question = messages[-1]['content'].rsplit('User Question:', 1)[-1].strip()
+        history += [{'role': 'user', 'content': question}, {'role': 'assistant', 'content': ANSWER}]
+    return evaluated_tokens(old_prompts), evaluated_tokens(new_prompts)
+
+
+def main() -> None:
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 100
+    stub = StubOllama(lambda path, payload: {'message': {'role': 'assistant', 'content': ANSWER},
+                                             'response': 'Атлет спрашивает про завтрашнюю тренировку.', 'done': True})
+    os.environ.update(OLLAMA_URL=stub.url, OLLAMA_WARMUP='0', LLM_USER_RATE_PER_MINUTE='1000')
+    use_workdir()
+    try:
+        old, new = asyncio.run(scenario(stub, turns))
+    finally:
+        stub.close()
+
+    print(f'{"ход":>4}   {"прежняя раскладка":>24}   {"стабильный префикс":>24}')
+    print(f'{"":>4}   {"всего":>7} {"пересчет":>8} {"с":>7}   {"всего":>7} {"пересчет":>8} {"с":>7}')
+    for turn, ((old_total, old_eval), (new_total, new_eval)) in enumerate(zip(old, new), start=1):
+        print(f'{turn:>4}   {old_total:>7} {old_eval:>8} {old_eval / rate:>7.1f}   '
+              f'{new_total:>7} {new_eval:>8} {new_eval / rate:>7.1f}')
+    old_sum, new_sum = sum(value for _, value in old), sum(value for _, value in new)
+    print(f'Пересчитано за {len(old)} ходов: {old_sum} против {new_sum} токенов, '
+          f'при {rate:g} ток/с {old_sum / rate:.0f} с против {new_sum / rate:.0f} с')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Пропускная способность смешанных GET-запросов при конкурентных клиентах.
+
+    python -m bench.read_throughput [клиентов] [секунд] [путь к другой копии репозитория]
+
+Приложение работает в одном цикле событий, как воркер uvicorn. Сначала только чтение, потом то же
+чтение, пока 20 вопросов тренеру ждут модель (заглушка отвечает через 1 с). Для сравнения с прежней
+синхронной сессией третьим аргументом передается git worktree нужного коммита."""
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+from bench._common import ROOT, StubOllama, app_client, import_rides, latency_summary, ride_frame, use_workdir
+
+URLS = ('/', '/workouts', '/workouts?period=30', '/statistics', '/coach', '/profile')
+CHATS = 20
+MODEL_DELAY = 1.0
+
+
+async def reader(client, number: int, until: float, latencies: list[float]) -> None:
+    position = number
+    while time.perf_counter() < until:
+        started = time.perf_counter()
+        response = await client.get(URLS[position % len(URLS)])
+        latencies.append(time.perf_counter() - started)
+        assert response.status_code == 200, (URLS[position % len(URLS)], response.status_code)
+        position += 1
+
+
+async def read_phase(client, clients: int, seconds: float) -> list[float]:
+    latencies: list[float] = []
+    until = time.perf_counter() + seconds
+    await asyncio.gather(*(reader(client, number, until, latencies) for number in range(clients)))
+    return latencies
+
+
+async def held_connections(until: asyncio.Event, peak: list[int]) -> None:
+    """Наибольшее число соединений, взятых из пулов синхронного и асинхронного движков"""
+    from app import db
+    pools = [db.engine.pool] + ([db.async_engine.pool] if hasattr(db, 'async_engine') else [])
+    while not until.is_set():
+        peak[0] = max(peak[0], sum(pool.checkedout() for pool in pools))
+        await asyncio.sleep(0.01)
+
+
+async def scenario(clients: int, seconds: float) -> None:
+    async with app_client() as client:
+        rides = {f'ride{number}.csv': ride_frame(3600, seed=number).to_csv(index=False).encode()
+                 for number in range(20)}
+        await import_rides(client, rides)
+        await read_phase(client, clients, 1)  # прогрев
+
+        latencies = await read_phase(client, clients, seconds)
+        print(f'только чтение:      {len(latencies) / seconds:6.0f} запр/с  {latency_summary(latencies)}')
+
+        chats = [asyncio.create_task(client.post('/coach/chat', data={'user_question': f'Вопрос {number}'}))
+                 for number in range(CHATS)]
+        await asyncio.sleep(0.5)
+        done, peak = asyncio.Event(), [0]
+        sampler = asyncio.create_task(held_connections(done, peak))
+        await asyncio.sleep(1)  # без чтения: видно только соединения, которые держат ждущие модель чаты
+        done.set()
+        await sampler
+        print(f'{CHATS} чатов ждут модель, соединений БД занято: {peak[0]}')
+        latencies = await read_phase(client, clients, seconds)
+        print(f'чтение + {CHATS} чатов: {len(latencies) / seconds:6.0f} запр/с  {latency_summary(latencies)}')
+        statuses = [response.status_code for response in await asyncio.gather(*chats)]
+        print(f'ответы чатов: {sorted(set(statuses))}')
+
+
+def main() -> None:
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    root = Path(sys.argv[3]).resolve() if len(sys.argv) > 3 else ROOT
+
+    def respond(path, payload):
+        time.sleep(MODEL_DELAY if path == '/api/chat' else 0)
+        return {'message': {'role': 'assistant', 'content': 'ok'}, 'response': 'ok', 'done': True}
+
+    stub = StubOllama(respond)
+    os.environ.update(OLLAMA_URL=stub.url, OLLAMA_WARMUP='0', LLM_USER_RATE_PER_MINUTE='1000')
+    use_workdir(root)
+    try:
+        asyncio.run(scenario(clients, seconds))
+    finally:
+        stub.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Время расчета аналитики заезда: каждая метрика отдельно и analyze_ride целиком.
+
+    python -m bench.ride_analytics [часов]
+
+Бюджет — 200 мс на 6-часовой заезд при 1 Гц. Если analyze_ride не укладывается, скрипт
+завершается с кодом 1, поэтому его можно запускать как проверку. Время — медиана из RUNS прогонов."""
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from bench._common import ride_frame
+from app.services import analytics
+
+RUNS = 20
+BUDGET_MS = 200
+BUDGET_HOURS = 6
+FTP = 250
+MAX_HEARTRATE = 190.0
+
+
+def median_ms(func, *args) -> float:
+    func(*args)
+    samples = []
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        func(*args)
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1000
+
+
+def main() -> None:
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET_HOURS
+    frame = ride_frame(int(hours * 3600), extra_columns=False)
+    streams = {column: frame[column].to_numpy() for column in ('watts', 'heartrate', 'moving')}
+    watts = streams['watts'][streams['moving']].astype(np.float64)
+    heartrate = streams['heartrate'][streams['moving']].astype(np.float64)
+    print(f'Заезд {hours:g} ч при 1 Гц, {watts.size} сэмплов в движении, точек кривой мощности: '
+          f'{analytics.curve_durations(watts.size).size}')
+
+    parts = {
+        'power_curve': (analytics.power_curve, watts),
+        'normalized_power': (analytics.normalized_power, watts),
+        'variability_index': (analytics.variability_index, watts),
+        'power_zones': (analytics.power_zones, watts, FTP),
+        'heartrate_zones': (analytics.heartrate_zones, heartrate, MAX_HEARTRATE),
+        'aerobic_decoupling': (analytics.aerobic_decoupling, watts, heartrate),
+        'w_prime_balance': (analytics.w_prime_balance, watts, FTP),
+    }
+    for name, (func, *args) in parts.items():
+        print(f'{name:20} {median_ms(func, *args):8.2f} мс')
+    total = median_ms(analytics.analyze_ride, streams, FTP, MAX_HEARTRATE)
+    print(f'{"analyze_ride":20} {total:8.2f} мс')
+
+    if hours <= BUDGET_HOURS and total > BUDGET_MS:
+        print(f'Превышен бюджет {BUDGET_MS} мс на {BUDGET_HOURS}-часовой заезд')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
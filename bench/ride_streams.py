@@ -0,0 +1,64 @@
+"""Размер на диске и время загрузки посекундных рядов: хранилище .npy против повторного чтения CSV.
+
+    python -m bench.ride_streams [часов]
+
+Загрузка меряется медианой из нескольких прогонов на прогретом кэше файловой системы,
+для memmap в замер входит чтение всех значений."""
+import statistics
+import sys
+import time
+
+import pandas as pd
+
+from bench._common import use_workdir, write_ride
+
+RUNS = 20
+
+
+def median_ms(func) -> float:
+    func()
+    samples = []
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1000
+
+
+def folder_size(path) -> int:
+    return sum(file.stat().st_size for file in path.rglob('*') if file.is_file())
+
+
+def main() -> None:
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 6
+    workdir = use_workdir()
+    from app.services import blob_store
+    from app.services.parse_cvs import CSV_COLUMNS, parse_ride
+    from app.services.stream_store import load_streams, save_streams, streams_path
+
+    csv_path = write_ride(workdir / 'ride.csv', int(hours * 3600))
+    with open(csv_path, 'rb') as source:
+        blob = blob_store.write_stream(source)
+    gz_path = blob_store.blob_path(blob.sha256)
+    _, streams = parse_ride(csv_path, ftp=250)
+    save_streams(1, streams)
+
+    print(f'Заезд {hours:g} ч при 1 Гц, ряды: {", ".join(sorted(streams))}')
+    print(f'{"CSV":28} {csv_path.stat().st_size / 2 ** 20:7.2f} МБ')
+    print(f'{"CSV.gz в хранилище файлов":28} {gz_path.stat().st_size / 2 ** 20:7.2f} МБ')
+    print(f'{"ряды .npy":28} {folder_size(streams_path(1)) / 2 ** 20:7.2f} МБ')
+
+    usecols = list(CSV_COLUMNS)
+    variants = {
+        'read_csv, все колонки': lambda: pd.read_csv(csv_path),
+        'read_csv, нужные колонки': lambda: pd.read_csv(csv_path, usecols=usecols, dtype=CSV_COLUMNS),
+        'read_csv из .gz': lambda: pd.read_csv(gz_path, usecols=usecols, dtype=CSV_COLUMNS),
+        'load_streams, все ряды': lambda: [values.sum() for values in load_streams(1).values()],
+        'load_streams, только watts': lambda: load_streams(1, ['watts'])['watts'].sum(),
+    }
+    for name, load in variants.items():
+        print(f'{name:28} {median_ms(load):7.2f} мс')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Параллельные записи и чтения SQLite: настроенный движок приложения против прежнего create_engine.
+
+    python -m bench.sqlite_concurrency [писателей] [читателей] [транзакций на писателя]
+
+Писатель повторяет коммит импорта: файл и тренировка в одной транзакции. Читатель в цикле выполняет
+запрос списка тренировок, пока пишут писатели. Прежний движок: журнал DELETE, synchronous=FULL,
+таймаут блокировки 5 с, echo=True (вывод SQL уходит в /dev/null, но форматирование остается)."""
+import contextlib
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from bench._common import latency_summary, use_workdir
+
+
+def make_engine(path, tuned: bool):
+    from sqlalchemy import event
+    from sqlalchemy.pool import QueuePool
+    from sqlmodel import SQLModel, create_engine
+    from app import db
+    from app.models import models  # noqa: F401  таблицы регистрируются в SQLModel.metadata при импорте
+    from app.core.config import DB_BUSY_TIMEOUT, DB_MAX_OVERFLOW, DB_POOL_SIZE
+
+    url = f'sqlite:///{path}'
+    if tuned:
+        engine = create_engine(url, poolclass=QueuePool, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                               connect_args={'check_same_thread': False, 'timeout': DB_BUSY_TIMEOUT})
+        event.listen(engine, 'connect', db._set_sqlite_pragmas)
+    else:
+        # Обработчик логов echo создается вместе с движком и пишет в тогдашний stdout
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            engine = create_engine(url, echo=True, connect_args={'check_same_thread': False})
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+
+def run(engine, writers: int, readers: int, transactions: int) -> dict:
+    from sqlalchemy.exc import OperationalError
+    from sqlmodel import Session, select
+    from app.models.models import UploadedFile, Workout
+
+    write_latencies, read_latencies, errors = [], [], []
+    writing = threading.Event()
+    writing.set()
+
+    def write(writer: int) -> None:
+        for number in range(transactions):
+            started = time.perf_counter()
+            try:
+                with Session(engine) as session:
+                    file = UploadedFile(original_name='ride.csv', sha256=f'{writer:08x}{number:056x}',
+                                        uploaded_at=datetime.now(), user_id=1)
+                    session.add(file)
+                    session.flush()
+                    session.add(Workout(source_file_id=file.id, user_id=1, duration=timedelta(hours=1),
+                                        moving_time=timedelta(minutes=55), distance_km=30, avg_watts=180,
+                                        normalized_power=200, intensity_factor=0.8, training_stress_score=60,
+                                        avg_cadence=85, avg_speed=30, avg_speed_without_stop=31,
+                                        calories_burned=700))
+                    session.commit()
+            except OperationalError as e:
+                errors.append(str(e.orig))
+                continue
+            write_latencies.append(time.perf_counter() - started)
+
+    def read() -> None:
+        while writing.is_set():
+            started = time.perf_counter()
+            try:
+                with Session(engine) as session:
+                    session.exec(select(Workout).join(UploadedFile).where(UploadedFile.user_id == 1)
+                                 .order_by(UploadedFile.uploaded_at.desc(), Workout.id.desc()).limit(10)).all()
+            except OperationalError as e:
+                errors.append(str(e.orig))
+                continue
+            read_latencies.append(time.perf_counter() - started)
+
+    reader_threads = [threading.Thread(target=read) for _ in range(readers)]
+    writer_threads = [threading.Thread(target=write, args=(number,)) for number in range(writers)]
+    started = time.perf_counter()
+    for thread in reader_threads + writer_threads:
+        thread.start()
+    for thread in writer_threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+    writing.clear()
+    for thread in reader_threads:
+        thread.join()
+    return {'seconds': seconds, 'writes': write_latencies, 'reads': read_latencies, 'errors': errors}
+
+
+def main() -> None:
+    writers, readers, transactions = (int(value) for value in (sys.argv[1:] + ['4', '4', '250'][len(sys.argv) - 1:]))
+    workdir = use_workdir()
+    print(f'{writers} писателей по {transactions} транзакций, {readers} читателей')
+    for name, tuned in (('прежний движок', False), ('WAL и настройки', True)):
+        engine = make_engine(workdir / f'{"tuned" if tuned else "default"}.db', tuned)
+        result = run(engine, writers, readers, transactions)
+        engine.dispose()
+        print(f'{name}: {len(result["writes"]) / result["seconds"]:.0f} записей/с, '
+              f'{len(result["reads"]) / result["seconds"]:.0f} чтений/с, ошибок блокировки: {len(result["errors"])}')
+        print(f'    запись {latency_summary(result["writes"])}')
+        print(f'    чтение {latency_summary(result["reads"])}')
+        for error in sorted(set(result['errors'])):
+            print(f'    ошибка: {error}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""GET /statistics на истории из 10 000 тренировок: число SQL-запросов и время, прежняя реализация против роллапов.
+
+    python -m bench.statistics [тренировок]
+
+'Циклы Python' повторяет прежний main_stat: все тренировки периода одним запросом, дата загрузки
+ленивой загрузкой source_file у каждой, затем суммы и максимумы в цикле. Для него меряется только
+работа с базой и расчет, для нового обработчика — весь HTTP-запрос вместе с шаблоном."""
+import asyncio
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bench._common import app_client, seed_history, use_workdir
+
+PERIODS = (7, 90, 365, 5 * 365)
+RUNS = 5
+
+
+def python_loop_statistics(session, user_id: int, period: int) -> dict:
+    from sqlmodel import select
+    from app.models.models import UploadedFile, Workout
+
+    since = datetime.now() - timedelta(days=period)
+    workouts = session.exec(select(Workout).join(UploadedFile).where(UploadedFile.uploaded_at >= since,
+                                                                     UploadedFile.user_id == user_id)).all()
+    chart_dates, distance, tss, watts, max_heartrate = [], [], [], [], []
+    moving_time = timedelta()
+    for workout in workouts:
+        chart_dates.append(workout.source_file.uploaded_at.strftime('%d.%m'))
+        distance.append(workout.distance_km)
+        tss.append(workout.training_stress_score)
+        watts.append(workout.avg_watts)
+        max_heartrate.append(workout.max_heartrate)
+        moving_time += workout.duration
+    return {'count': len(workouts), 'tss': sum(value for value in tss if value is not None),
+            'avg_watts': sum(watts) / len(watts) if watts else 0, 'max_distance': max(distance, default=0),
+            'max_heartrate': max(max_heartrate, default=0), 'moving_time': moving_time}
+
+
+def measure_python_loop(user_id: int, period: int) -> tuple[float, int, int]:
+    from sqlmodel import Session
+    from app.db import count_queries, engine
+
+    samples = []
+    for _ in range(RUNS):
+        with Session(engine) as session, count_queries() as counter:
+            started = time.perf_counter()
+            result = python_loop_statistics(session, user_id, period)
+            samples.append(time.perf_counter() - started)
+    return statistics.median(samples), counter[0], result['count']
+
+
+async def measure_handler(client, period: int) -> tuple[float, int]:
+    from app.core.metrics import metrics
+
+    observed = []
+    observe = metrics.observe
+
+    def record(name, value):
+        if name == 'db_queries_per_request':
+            observed.append(value)
+        observe(name, value)
+
+    metrics.observe = record
+    samples = []
+    try:
+        for _ in range(RUNS):
+            started = time.perf_counter()
+            response = await client.get('/statistics', params={'period': period})
+            samples.append(time.perf_counter() - started)
+            assert response.status_code == 200
+    finally:
+        metrics.observe = observe
+    return statistics.median(samples), observed[-1]
+
+
+async def scenario(workouts: int) -> None:
+    async with app_client() as client:
+        user_id = (await client.get('/me')).json()['id']
+        started = time.perf_counter()
+        seed_history(user_id, workouts)
+        print(f'{workouts} тренировок за 5 лет записаны за {time.perf_counter() - started:.1f} с')
+        print(f'{"период":>8} {"тренировок":>10}   {"циклы Python":>22}   {"роллапы, HTTP":>22}')
+        for period in PERIODS:
+            old_seconds, old_queries, count = measure_python_loop(user_id, period)
+            new_seconds, new_queries = await measure_handler(client, period)
+            print(f'{period:>6} д {count:>10}   {old_seconds * 1000:9.1f} мс {old_queries:>5} запр.'
+                  f'   {new_seconds * 1000:9.1f} мс {new_queries:>5} запр.')
+
+
+def main() -> None:
+    workouts = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    use_workdir()
+    asyncio.run(scenario(workouts))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""Место на диске и пик памяти на одну загрузку: прежнее сохранение целиком и потоковое хранилище блобов.
+
+    python -m bench.upload_store [часов через запятую]
+
+Загрузка читается из файла на диске, как SpooledTemporaryFile Starlette после 1 МБ. Прежний путь:
+await file.read(), sha256 от всех байтов и запись несжатого CSV в data/csv. Новый: blob_store.write_stream."""
+import hashlib
+import sys
+from pathlib import Path
+
+from bench._common import in_fresh_process, use_workdir, write_ride
+
+
+def read_whole(upload: Path) -> int:
+    """save_file_with_hash до хранилища блобов"""
+    with upload.open('rb') as source:
+        content = source.read()
+    hash_value = hashlib.sha256(content).hexdigest()
+    path = Path('data/csv') / f'{hash_value}.csv'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return path.stat().st_size
+
+
+def stream_to_store(upload: Path) -> int:
+    from app.services import blob_store
+
+    with upload.open('rb') as source:
+        return blob_store.write_stream(source).stored_size
+
+
+def main() -> None:
+    hours = [float(value) for value in sys.argv[1].split(',')] if len(sys.argv) > 1 else [1, 6, 24]
+    workdir = use_workdir()
+    print(f'{"заезд":>6} {"CSV":>9}   {"прежде: диск / пик / время":>30}   {"хранилище: диск / пик / время":>32}')
+    for value in hours:
+        upload = write_ride(workdir / f'ride{value:g}h.csv', int(value * 3600), seed=int(value))
+        size = upload.stat().st_size / 2 ** 20
+        old_disk, old_seconds, old_peak = in_fresh_process(read_whole, upload)
+        new_disk, new_seconds, new_peak = in_fresh_process(stream_to_store, upload)
+        print(f'{value:>5g}ч {size:>7.1f} МБ   '
+              f'{old_disk / 2 ** 20:>7.1f} МБ {old_peak:>6.1f} МБ {old_seconds * 1000:>6.0f} мс'
+              f'   {new_disk / 2 ** 20:>9.1f} МБ {new_peak:>6.1f} МБ {new_seconds * 1000:>6.0f} мс'
+              f'   ({new_disk / old_disk:.0%} места)')
+
+
+if __name__ == '__main__':
+    main()
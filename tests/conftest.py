@@ -0,0 +1,88 @@
+import atexit
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# База (data/app.db) и шаблоны (app/templates) задаются путями от текущей папки, а схема создается
+# при импорте app.main. Поэтому тесты работают во временной папке со ссылкой на app,
+# и рабочая база разработчика не трогается.
+WORKDIR = Path(tempfile.mkdtemp(prefix='bike-tracker-tests-'))
+(WORKDIR / 'app').symlink_to(ROOT / 'app', target_is_directory=True)
+os.chdir(WORKDIR)
+atexit.register(shutil.rmtree, WORKDIR, ignore_errors=True)
+sys.path.insert(0, str(ROOT))
+os.environ['OLLAMA_WARMUP'] = '0'
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.main import app  # noqa: E402
+from app.services.ai_coach import OllamaService, get_ollama_service  # noqa: E402
+from app.services.llm_providers import LLMRouter  # noqa: E402
+from fake_llm import FakeOllama  # noqa: E402
+
+PROFILE = dict(name='Тест', weight_kg=70, current_ftp=250, limitations='-', weekly_hours=5, gear='шоссе',
+               environment_location='город')
+_emails = (f'rider{number}@example.com' for number in itertools.count())
+
+
+@pytest.fixture(scope='session')
+def client():
+    # Один клиент на все тесты: очереди импорта и пересчета живут в цикле событий приложения
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def user(client):
+    """Новый пользователь с профилем, клиент авторизован от его имени"""
+    email = next(_emails)
+    client.cookies.clear()
+    client.post('/register', data={'email': email, 'password': 'secret'})
+    client.post('/login', data={'username': email, 'password': 'secret'}, follow_redirects=False)
+    client.post('/profile/create', data=PROFILE, follow_redirects=False)
+    return email
+
+
+@pytest.fixture
+def fake_ollama():
+    """Подменяет модель в приложении поддельным Ollama"""
+    server = FakeOllama()
+    service = OllamaService(LLMRouter([server.provider()]))
+    app.dependency_overrides[get_ollama_service] = lambda: service
+    yield server
+    app.dependency_overrides.pop(get_ollama_service)
+
+
+def workout_csv(seconds: int = 600, watts: float = 200.0) -> bytes:
+    """Небольшая поездка в формате экспорта потоков"""
+    rows = ['time,watts,velocity_smooth,distance,heartrate,cadence,moving,altitude,latlng']
+    rows += [f'{second},{watts + second % 7},8.0,{second * 8.0},130.0,85.0,True,1.0,x' for second in range(seconds)]
+    return '\n'.join(rows).encode()
+
+
+def wait_done(client, url: str, timeout: float = 10) -> dict:
+    """Ждет, пока фоновая задача импорта или пересчета перейдет в статус done"""
+    deadline = time.monotonic() + timeout
+    status = client.get(url).json()
+    while status['status'] != 'done' and time.monotonic() < deadline:
+        time.sleep(0.05)
+        status = client.get(url).json()
+    assert status['status'] == 'done', status
+    return status
+
+
+def import_workouts(client, count: int = 1) -> dict:
+    """Загружает count разных поездок через /imports и ждет окончания импорта"""
+    files = [('files', (f'ride{number}.csv', workout_csv(watts=150.0 + number), 'text/csv'))
+             for number in range(count)]
+    response = client.post('/imports', files=files, follow_redirects=False)
+    job_id = response.headers['location'].rsplit('=', 1)[1]
+    return wait_done(client, f'/imports/{job_id}')
@@ -0,0 +1,95 @@
+"""Поддельные серверы моделей для тестов. httpx.MockTransport отвечает в формате настоящего API,
+поэтому провайдеры проходят весь путь через httpx, но без сети и без загруженной модели."""
+import asyncio
+import json
+
+import httpx
+
+from app.services.llm_providers import OllamaProvider, OpenAICompatibleProvider
+
+
+class FakeServer:
+    """Общее поведение поддельных серверов. Запросы записываются в requests.
+    down=True — сервер не принимает соединения, delay — задержка перед ответом и между токенами:
+    если она больше таймаута чтения клиента, запрос завершается ReadTimeout, как у настоящего сервера."""
+
+    def __init__(self, tokens=('Крути ', 'ровно ', 'в Z2.'), delay: float = 0, down: bool = False,
+                 error: str | None = None):
+        self.tokens = list(tokens)
+        self.delay = delay
+        self.down = down
+        self.error = error
+        self.requests: list[tuple[str, dict]] = []
+
+    @property
+    def answer(self) -> str:
+        return ''.join(self.tokens)
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        if self.down:
+            raise httpx.ConnectError('connection refused', request=request)
+        payload = json.loads(request.content or b'{}')
+        self.requests.append((request.url.path, payload))
+        read_timeout = request.extensions.get('timeout', {}).get('read')
+        if read_timeout is not None and self.delay > read_timeout:
+            raise httpx.ReadTimeout('timed out', request=request)
+        await asyncio.sleep(self.delay)
+        return self.respond(request.url.path, payload)
+
+    def respond(self, path: str, payload: dict) -> httpx.Response:
+        raise NotImplementedError
+
+
+class FakeOllama(FakeServer):
+    """/api/chat (целиком и NDJSON-потоком), /api/generate и /api/embed.
+    error — строка ошибки посреди потока, как ее отдает Ollama."""
+
+    def respond(self, path: str, payload: dict) -> httpx.Response:
+        if path == '/api/chat' and payload.get('stream'):
+            return httpx.Response(200, content=self._ndjson())
+        if path == '/api/chat':
+            return httpx.Response(200, json={'message': {'role': 'assistant', 'content': self.answer}, 'done': True})
+        if path == '/api/generate':
+            return httpx.Response(200, json={'response': self.answer, 'done': True})
+        if path == '/api/embed':
+            return httpx.Response(200, json={'embeddings': [[1.0, 0.0, 0.0]]})
+        return httpx.Response(404)
+
+    async def _ndjson(self):
+        for token in self.tokens:
+            yield json.dumps({'message': {'role': 'assistant', 'content': token}, 'done': False}).encode() + b'\n'
+            await asyncio.sleep(self.delay)
+        if self.error:
+            yield json.dumps({'error': self.error}).encode() + b'\n'
+        yield json.dumps({'message': {'role': 'assistant', 'content': ''}, 'done': True}).encode() + b'\n'
+
+    def provider(self, **kwargs) -> OllamaProvider:
+        client = httpx.AsyncClient(base_url='http://fake-ollama', transport=httpx.MockTransport(self.handler))
+        return OllamaProvider(url='http://fake-ollama', client=client, **{'model': 'fake', **kwargs})
+
+
+class FakeOpenAI(FakeServer):
+    """/v1/chat/completions (целиком и SSE-потоком) и /v1/embeddings, как у vLLM и llama.cpp server.
+    error — поток обрывается с ошибкой после отданных токенов."""
+
+    def respond(self, path: str, payload: dict) -> httpx.Response:
+        if path == '/v1/chat/completions' and payload.get('stream'):
+            return httpx.Response(200, content=self._sse(), headers={'content-type': 'text/event-stream'})
+        if path == '/v1/chat/completions':
+            return httpx.Response(200, json={'choices': [{'message': {'role': 'assistant', 'content': self.answer}}]})
+        if path == '/v1/embeddings':
+            return httpx.Response(200, json={'data': [{'embedding': [0.0, 1.0, 0.0]}]})
+        return httpx.Response(404)
+
+    async def _sse(self):
+        yield b'data: ' + json.dumps({'choices': [{'delta': {'role': 'assistant'}}]}).encode() + b'\n\n'
+        for token in self.tokens:
+            yield b'data: ' + json.dumps({'choices': [{'delta': {'content': token}}]}).encode() + b'\n\n'
+            await asyncio.sleep(self.delay)
+        if self.error:
+            raise httpx.ReadError(self.error)
+        yield b'data: [DONE]\n\n'
+
+    def provider(self, **kwargs) -> OpenAICompatibleProvider:
+        client = httpx.AsyncClient(base_url='http://fake-openai', transport=httpx.MockTransport(self.handler))
+        return OpenAICompatibleProvider(url='http://fake-openai', client=client, **{'model': 'fake', **kwargs})
@@ -0,0 +1,70 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+from app.core.metrics import metrics
+from fake_llm import FakeOllama
+
+
+def collect(stream) -> list[str]:
+    async def run():
+        return [token async for token in stream]
+
+    return asyncio.run(run())
+
+
+def sse_events(text: str) -> list[tuple[str, dict]]:
+    events = []
+    for block in text.strip().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines())
+        events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+
+def test_ollama_stream_yields_ndjson_tokens():
+    server = FakeOllama()
+    assert collect(server.provider().chat_stream([{'role': 'user', 'content': 'Привет'}])) == server.tokens
+    path, payload = server.requests[0]
+    assert path == '/api/chat'
+    assert payload['stream'] is True
+
+
+def test_ollama_stream_error_line_raises():
+    server = FakeOllama(error='model not found')
+    with pytest.raises(HTTPException) as error:
+        collect(server.provider().chat_stream([{'role': 'user', 'content': 'Привет'}]))
+    assert error.value.status_code == 500
+
+
+def test_ollama_stream_unavailable_raises_503():
+    server = FakeOllama(down=True)
+    with pytest.raises(HTTPException) as error:
+        collect(server.provider().chat_stream([{'role': 'user', 'content': 'Привет'}]))
+    assert error.value.status_code == 503
+
+
+def test_chat_stream_sends_tokens_and_saves_answer(client, user, fake_ollama):
+    before = metrics.snapshot()['histograms'].get('chat_time_to_first_token_seconds', {}).get('count', 0)
+    response = client.post('/coach/chat/stream', data={'user_question': 'Как ехать завтра?'})
+
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/event-stream')
+    events = sse_events(response.text)
+    assert [data['content'] for event, data in events if event == 'token'] == fake_ollama.tokens
+    assert events[-1] == ('done', {})
+    assert metrics.snapshot()['histograms']['chat_time_to_first_token_seconds']['count'] == before + 1
+    # Вопрос и ответ сохранены в историю после окончания потока
+    page = client.get('/coach').text
+    assert 'Как ехать завтра?' in page
+    assert fake_ollama.answer in page
+
+
+def test_chat_stream_error_saves_nothing(client, user, fake_ollama):
+    fake_ollama.error = 'out of memory'
+    response = client.post('/coach/chat/stream', data={'user_question': 'Что с пульсом?'})
+
+    events = sse_events(response.text)
+    assert events[-1][0] == 'error'
+    assert 'Что с пульсом?' not in client.get('/coach').text
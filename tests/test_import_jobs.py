@@ -0,0 +1,64 @@
+import uuid
+
+import pytest
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, func, select
+
+from app.db import engine
+from app.models.models import ImportJobFile, UploadedFile, Users
+from app.services import import_jobs
+from app.services.parse_cvs import parse_ride
+from app.services.stream_store import STREAMS_DIR, stage_streams
+from conftest import workout_csv
+
+
+@pytest.fixture
+def ride(tmp_path, user):
+    """id пользователя, файл задачи с новым хэшем и результат разбора поездки"""
+    path = tmp_path / 'ride.csv'
+    path.write_bytes(workout_csv())
+    metrics, streams = parse_ride(path, 250)
+    with Session(engine) as session:
+        user_id = session.exec(select(Users.id).where(Users.email == user)).one()
+    job_file = ImportJobFile(position=0, original_name='ride.csv', sha256=uuid.uuid4().hex * 2)
+    return user_id, job_file, metrics, streams
+
+
+def uploaded_count(user_id: int, sha256: str) -> int:
+    with Session(engine) as session:
+        return session.exec(select(func.count()).select_from(UploadedFile).where(
+            UploadedFile.user_id == user_id, UploadedFile.sha256 == sha256)).one()
+
+
+def published_streams() -> set[str]:
+    return {path.name for path in STREAMS_DIR.iterdir() if path.name != '.staging'} if STREAMS_DIR.is_dir() else set()
+
+
+def test_parallel_jobs_save_same_file_once(ride):
+    # Оба воркера уже прошли проверку в _claim_files: файла в базе еще не было
+    user_id, job_file, metrics, streams = ride
+    first = stage_streams(f'{job_file.sha256}-1', streams)
+    second = stage_streams(f'{job_file.sha256}-2', streams)
+
+    assert import_jobs._save_workout(job_file, user_id, metrics, first)
+    assert not import_jobs._save_workout(job_file, user_id, metrics, second)
+    assert uploaded_count(user_id, job_file.sha256) == 1
+    assert not second.exists()
+
+
+def test_failed_commit_publishes_no_streams(ride, monkeypatch):
+    user_id, job_file, metrics, streams = ride
+    staged = stage_streams(job_file.sha256, streams)
+    before = published_streams()
+
+    class LockedSession(Session):
+        def commit(self):
+            raise OperationalError('COMMIT', {}, Exception('database is locked'))
+
+    monkeypatch.setattr(import_jobs, 'Session', LockedSession)
+    with pytest.raises(OperationalError):
+        import_jobs._save_workout(job_file, user_id, metrics, staged)
+
+    assert published_streams() == before
+    assert not staged.exists()
+    assert uploaded_count(user_id, job_file.sha256) == 0
@@ -0,0 +1,167 @@
+import asyncio
+import sys
+import threading
+import time
+import types
+
+import pytest
+from fastapi import HTTPException
+
+from app.core.metrics import metrics
+from app.services.llm_providers import LLMConfigError, LLMRouter, LlamaCppProvider, OllamaProvider, \
+    OpenAICompatibleProvider, build_router, choose_tier
+from fake_llm import FakeOllama, FakeOpenAI
+
+MESSAGES = [{'role': 'user', 'content': 'Как ехать завтра?'}]
+
+
+async def collect(stream) -> list[str]:
+    return [token async for token in stream]
+
+
+def failovers() -> int:
+    return metrics.snapshot()['counters'].get('llm_failovers', 0)
+
+
+def test_choose_tier():
+    assert choose_tier('Какой у меня FTP?') == 'fast'
+    assert choose_tier('Составь план на неделю') == 'large'
+    assert choose_tier('x' * 300) == 'large'
+
+
+def test_build_router_from_config():
+    router = build_router([{'type': 'ollama', 'url': 'http://localhost:11434', 'model': 'llama3.1'},
+                           {'type': 'openai', 'url': 'http://localhost:8000', 'model': 'qwen', 'tier': 'fast'}])
+    assert [type(provider) for provider in router.providers] == [OllamaProvider, OpenAICompatibleProvider]
+    assert router.providers[1].tier == 'fast'
+    with pytest.raises(LLMConfigError):
+        build_router([{'type': 'unknown', 'model': 'x'}])
+    with pytest.raises(LLMConfigError):
+        build_router([])
+
+
+def test_openai_compatible_provider():
+    server = FakeOpenAI()
+
+    async def scenario():
+        provider = server.provider(api_key='secret', embed_model='embed')
+        assert provider.client.headers['Authorization'] == 'Bearer secret'
+        assert await provider.chat(MESSAGES) == server.answer
+        assert await collect(provider.chat_stream(MESSAGES)) == server.tokens
+        assert await provider.embed('текст') == [0.0, 1.0, 0.0]
+        await provider.aclose()
+
+    asyncio.run(scenario())
+    assert [path for path, _ in server.requests] == ['/v1/chat/completions'] * 2 + ['/v1/embeddings']
+
+
+def test_router_prefers_requested_tier():
+    fast, large = FakeOllama(tokens=['быстро']), FakeOpenAI(tokens=['подробно'])
+    router = LLMRouter([fast.provider(tier='fast'), large.provider(tier='large')], routing='order')
+
+    async def scenario():
+        assert await router.chat(MESSAGES, tier='large') == 'подробно'
+        assert await router.chat(MESSAGES, tier='fast') == 'быстро'
+
+    asyncio.run(scenario())
+
+
+def test_router_fails_over_to_next_provider():
+    down, backup = FakeOllama(down=True), FakeOpenAI()
+    router = LLMRouter([down.provider(name='down'), backup.provider(name='backup')], routing='order')
+    before = failovers()
+
+    async def scenario():
+        assert await router.chat(MESSAGES) == backup.answer
+        # Упавший провайдер на время паузы уходит в конец списка и не получает запросы
+        assert [provider.name for provider in router.candidates()] == ['backup', 'down']
+        assert await router.chat(MESSAGES) == backup.answer
+
+    asyncio.run(scenario())
+    assert failovers() == before + 1
+    assert len(backup.requests) == 2
+
+
+def test_provider_timeout_fails_over():
+    slow, backup = FakeOllama(delay=0.5), FakeOpenAI()
+    router = LLMRouter([slow.provider(name='slow', timeout=0.1), backup.provider(name='backup')], routing='order')
+
+    async def scenario():
+        with pytest.raises(HTTPException) as error:
+            await router.providers[0].chat(MESSAGES)
+        assert error.value.status_code == 504
+        assert await router.chat(MESSAGES) == backup.answer
+
+    asyncio.run(scenario())
+
+
+def test_stream_fails_over_only_before_first_token():
+    down, broken, backup = FakeOllama(down=True), FakeOpenAI(error='connection reset'), FakeOllama()
+
+    async def scenario():
+        router = LLMRouter([down.provider(), backup.provider()], routing='order')
+        assert await collect(router.chat_stream(MESSAGES)) == backup.tokens
+        # Начатый ответ не склеить с ответом другой модели: ошибка доходит до клиента
+        router = LLMRouter([broken.provider(), backup.provider()], routing='order')
+        with pytest.raises(HTTPException):
+            await collect(router.chat_stream(MESSAGES))
+
+    asyncio.run(scenario())
+
+
+def test_latency_routing_uses_matching_latency():
+    slow, quick = FakeOllama(delay=0.05), FakeOllama()
+    router = LLMRouter([slow.provider(name='latency-slow'), quick.provider(name='latency-quick')], routing='latency')
+
+    async def scenario():
+        # Пока задержка не измерена, порядок из настроек; после замеров первым идет быстрый
+        await router.chat(MESSAGES)
+        await router.chat(MESSAGES)
+        assert [provider.name for provider in router.candidates()] == ['latency-quick', 'latency-slow']
+        slow_provider, quick_provider = router.providers
+        assert slow_provider.latency > quick_provider.latency
+        # Полные ответы не влияют на выбор для потока: там сравнивается время до первого токена
+        assert slow_provider.first_token_latency is None and quick_provider.first_token_latency is None
+        assert [provider.name for provider in router.candidates(stream=True)] == ['latency-slow', 'latency-quick']
+        await collect(router.chat_stream(MESSAGES))
+        assert slow_provider.first_token_latency is not None
+
+    asyncio.run(scenario())
+    histograms = metrics.snapshot()['histograms']
+    assert histograms['llm_provider_latency-slow_seconds']['count'] == 1
+    assert histograms['llm_provider_latency-slow_first_token_seconds']['count'] == 1
+
+
+class FakeLlama:
+    """Модель llama-cpp-python: считает одновременные вызовы, ответ генерируется delay секунд"""
+    delay = 0.1
+
+    def __init__(self, model_path, n_ctx, verbose):
+        self.active = 0
+        self.max_active = 0
+        self.guard = threading.Lock()
+
+    def create_chat_completion(self, messages, stream=False):
+        with self.guard:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        with self.guard:
+            self.active -= 1
+        return {'choices': [{'message': {'role': 'assistant', 'content': 'ok'}}]}
+
+
+def test_llama_cpp_runs_one_call_at_a_time(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'llama_cpp', types.SimpleNamespace(Llama=FakeLlama))
+
+    async def scenario():
+        provider = LlamaCppProvider(model_path='/models/fake.gguf')
+        # Первый вызов обрывается по таймауту, но поток еще работает с моделью: следующий ждет его
+        with pytest.raises(HTTPException) as error:
+            await provider.chat(MESSAGES, timeout=0.02)
+        assert error.value.status_code == 504
+        assert await asyncio.gather(provider.chat(MESSAGES), provider.chat(MESSAGES)) == ['ok', 'ok']
+        await provider.aclose()
+        return provider.llama.max_active
+
+    assert asyncio.run(scenario()) == 1
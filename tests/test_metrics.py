@@ -0,0 +1,13 @@
+from app import main
+
+
+def test_metrics_hidden_by_default(client, user):
+    assert client.get('/metrics').status_code == 404
+
+
+def test_metrics_shown_to_admins(client, user, monkeypatch):
+    monkeypatch.setattr(main, 'METRICS_ADMINS', {user})
+    response = client.get('/metrics')
+
+    assert response.status_code == 200
+    assert set(response.json()) == {'counters', 'gauges', 'histograms'}
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+from sqlmodel import Session, select
+
+from app.core.metrics import metrics
+from app.db import count_queries, engine
+from app.models.models import Users, Workout
+from app.services.user_cache import user_cache
+from conftest import PROFILE, import_workouts
+
+# Сколько SQL-запросов допустимо на один HTTP-запрос, когда пользователь уже в кэше.
+# Рост числа — регрессия: вернулись ленивые загрузки профиля или запрос пользователя на каждый вызов.
+QUERY_BUDGET = {
+    '/': 0,
+    '/me': 0,
+    '/profile': 0,
+    '/imports': 0,
+    '/coach': 1,
+    '/fitness': 2,
+    '/workouts': 2,
+    '/statistics': 2,
+    '/workouts/{workout_id}': 3,
+}
+
+
+@pytest.fixture
+def request_queries(client, monkeypatch):
+    """Число SQL-запросов одного HTTP-запроса, как его считает middleware track_db_queries"""
+    observed = []
+    observe = metrics.observe
+
+    def record(name, value):
+        if name == 'db_queries_per_request':
+            observed.append(value)
+        observe(name, value)
+
+    monkeypatch.setattr(metrics, 'observe', record)
+
+    def send(method: str, url: str, **kwargs) -> int:
+        observed.clear()
+        client.request(method, url, follow_redirects=False, **kwargs)
+        return observed[-1]
+
+    return send
+
+
+def user_id(email: str) -> int:
+    with Session(engine) as session:
+        return session.exec(select(Users.id).where(Users.email == email)).one()
+
+
+def test_user_loaded_with_profiles_in_one_query(client, user):
+    token = client.cookies.get('access_token')
+    user_cache.invalidate(user_id(user))
+
+    async def scenario():
+        with count_queries() as first:
+            loaded = await user_cache.from_token(token)
+        with count_queries() as second:
+            cached = await user_cache.from_token(token)
+            # Профили загружены тем же запросом: обращение к ним не идет в базу
+            names = (cached.user_profile.name, cached.athlete_profile.current_ftp)
+        return loaded, first[0], second[0], names
+
+    loaded, first, second, names = asyncio.run(scenario())
+    assert loaded.email == user
+    assert (first, second) == (1, 0)
+    assert names == (PROFILE['name'], PROFILE['current_ftp'])
+
+
+@pytest.mark.parametrize('url, budget', QUERY_BUDGET.items())
+def test_request_query_budget(client, user, request_queries, url, budget):
+    if '{workout_id}' in url:
+        import_workouts(client)
+        with Session(engine) as session:
+            workout_id = session.exec(select(Workout.id).where(Workout.user_id == user_id(user))).first()
+        url = url.format(workout_id=workout_id)
+    request_queries('GET', '/')  # пользователь попадает в кэш
+    assert request_queries('GET', url) <= budget
+
+
+def test_profile_edit_invalidates_cached_user(client, user, request_queries):
+    request_queries('GET', '/')
+    assert request_queries('GET', '/') == 0
+    request_queries('POST', '/profile/edit', data={**PROFILE, 'name': 'Новое имя'})
+    # После правки профиля пользователь загружается заново, уже с новым именем
+    assert request_queries('GET', '/') == 1
+    assert 'НОВОЕ ИМЯ' in client.get('/').text
@@ -0,0 +1,90 @@
+import re
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+from sqlmodel import Session
+
+from app.db import engine, async_engine
+from app.services.chat_context import load_history
+from app.services.file_service import find_duplicate, uploaded_hashes
+from conftest import PROFILE, import_workouts, wait_done
+
+# Таблицы, которые растут вместе с историей пользователя: полный проход по ним недопустим
+HOT_TABLES = ('uploadedfile', 'workout', 'chatmessage', 'importjobfile')
+FULL_SCAN = re.compile(rf'^SCAN ({"|".join(HOT_TABLES)})\b')
+
+
+@contextmanager
+def captured_selects():
+    """SELECT-запросы с параметрами, выполненные внутри блока, в том числе фоновыми задачами"""
+    statements = []
+
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, tuple(parameters)))
+
+    targets = (engine, async_engine.sync_engine)
+    for target in targets:
+        event.listen(target, 'before_cursor_execute', capture)
+    try:
+        yield statements
+    finally:
+        for target in targets:
+            event.remove(target, 'before_cursor_execute', capture)
+
+
+def query_plans(statements) -> list[list[str]]:
+    with engine.connect() as connection:
+        return [[row[-1] for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters)]
+                for statement, parameters in statements]
+
+
+def assert_indexed(statements, index: str) -> None:
+    """Ни один запрос не сканирует горячие таблицы целиком, и хотя бы один идет через index"""
+    assert statements, 'запросы не выполнялись'
+    plans = query_plans(statements)
+    scans = [(statement, plan) for (statement, _), plan in zip(statements, plans)
+             if any(FULL_SCAN.match(step) for step in plan)]
+    assert not scans, scans
+    assert any(index in step for plan in plans for step in plan), plans
+
+
+def test_duplicate_check_uses_user_hash_index(client, user):
+    with captured_selects() as statements:
+        client.post('/imports/check', json={'hashes': ['0' * 64]})
+        with Session(engine) as session:
+            find_duplicate('1' * 64, session, user_id=1)
+            uploaded_hashes(session, 1, ['2' * 64, '3' * 64])
+    assert_indexed(statements, 'ix_uploadedfile_user_id_sha256')
+
+
+@pytest.mark.parametrize('url', ['/workouts', '/workouts?period=30'])
+def test_workout_list_uses_upload_date_index(client, user, url):
+    import_workouts(client, 2)
+    with captured_selects() as statements:
+        assert client.get(url).status_code == 200
+    assert_indexed(statements, 'ix_uploadedfile_user_id_uploaded_at')
+    assert_indexed(statements, 'ix_workout_source_file_id')
+
+
+def test_chat_history_uses_user_date_index(client, user):
+    with captured_selects() as statements:
+        assert client.get('/coach').status_code == 200
+        with Session(engine) as session:
+            load_history(session, 1)
+    assert_indexed(statements, 'ix_chatmessage_user_id_created_at')
+
+
+def test_import_job_files_use_position_index(client, user):
+    with captured_selects() as statements:
+        import_workouts(client, 2)
+    assert_indexed(statements, 'ix_importjobfile_job_id_position')
+
+
+def test_ftp_recompute_uses_user_workout_index(client, user):
+    import_workouts(client, 2)
+    with captured_selects() as statements:
+        response = client.post('/profile/edit', data={**PROFILE, 'current_ftp': 280}, follow_redirects=False)
+        wait_done(client, f'/recompute/{response.headers["location"].rsplit("=", 1)[1]}')
+    assert_indexed(statements, 'ix_workout_user_id_id')
@@ -0,0 +1,27 @@
+from sqlmodel import Session, select
+
+from app import reingest
+from app.db import engine
+from app.models.models import ReingestRun, UploadedFile, Users
+from app.services import blob_store
+from conftest import wait_done, workout_csv
+
+
+def test_reingest_counts_unexpected_errors_and_finishes(client, user):
+    files = [('files', (f'reingest{number}.csv', workout_csv(watts=321.0 + number), 'text/csv'))
+             for number in range(2)]
+    response = client.post('/imports', files=files, follow_redirects=False)
+    assert wait_done(client, f'/imports/{response.headers["location"].rsplit("=", 1)[1]}')['success'] == 2
+    with Session(engine) as session:
+        user_id = session.exec(select(Users.id).where(Users.email == user)).one()
+        sha256 = session.exec(select(UploadedFile.sha256).where(UploadedFile.user_id == user_id)
+                              .order_by(UploadedFile.id)).first()
+    # Оборванный gzip: парсер падает с EOFError, а не с ParseCsvError
+    path = blob_store.blob_path(sha256)
+    path.write_bytes(path.read_bytes()[:200])
+
+    reingest.main(['--user', str(user_id), '--workers', '1'])
+
+    with Session(engine) as session:
+        run = session.exec(select(ReingestRun).where(ReingestRun.user_id == user_id)).one()
+    assert (run.status, run.files, run.errors) == ('done', 1, 1)
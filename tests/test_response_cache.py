@@ -0,0 +1,46 @@
+from app.core.metrics import metrics
+from app.services.response_cache import is_follow_up
+from conftest import PROFILE
+
+
+def chat_calls(server) -> int:
+    return sum(path == '/api/chat' for path, payload in server.requests)
+
+
+def ask(client, question: str) -> None:
+    response = client.post('/coach/chat', data={'user_question': question}, follow_redirects=False)
+    assert response.status_code == 303
+
+
+def test_follow_up_questions_are_detected():
+    assert is_follow_up('А если завтра дождь?')
+    assert is_follow_up('Распиши это подробнее')
+    assert is_follow_up('Ты советовал Z2, почему?')
+    assert not is_follow_up('Как ехать завтра?')
+    assert not is_follow_up('Сколько углеводов брать на 3 часа?')
+
+
+def test_repeated_question_is_answered_from_cache(client, user, fake_ollama):
+    hits = metrics.snapshot()['counters'].get('coach_cache_exact_hits', 0)
+    ask(client, 'Как ехать завтра?')
+    # История пополнилась, но регистр и пробелы в повторе не мешают попаданию
+    ask(client, '  как ехать   ЗАВТРА? ')
+
+    assert chat_calls(fake_ollama) == 1
+    assert metrics.snapshot()['counters']['coach_cache_exact_hits'] == hits + 1
+    assert client.get('/coach').text.count(fake_ollama.answer) == 2
+
+
+def test_follow_up_question_skips_cache(client, user, fake_ollama):
+    ask(client, 'А если завтра дождь?')
+    ask(client, 'А если завтра дождь?')
+
+    assert chat_calls(fake_ollama) == 2
+
+
+def test_profile_edit_invalidates_cached_answer(client, user, fake_ollama):
+    ask(client, 'Как ехать завтра?')
+    client.post('/profile/edit', data={**PROFILE, 'limitations': 'колено'}, follow_redirects=False)
+    ask(client, 'Как ехать завтра?')
+
+    assert chat_calls(fake_ollama) == 2